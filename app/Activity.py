@@ -1,64 +1,141 @@
 from __future__ import annotations
 
-import enum
+import bisect
 import json
+import math
+import sys
 
-from datetime import datetime
+from datetime import datetime, timezone
 from collections import OrderedDict
 
+import numpy
 
-class AggregationPeriod(enum.Enum):
-    DAY = 1
-    WEEK = 2
-    MONTH = 3
-    YEAR = 4
+from Calendar import AggregationPeriod, Calendar
 
-    def strToEnum(s: str):
-        try:
-            return getattr(AggregationPeriod, s.upper())
-        except AttributeError:
-            return AggregationPeriod.DAY
+EPOCH = datetime(1970, 1, 1)
 
 
 class Activity:
-    start_date = None
+    __slots__ = (
+        'start_date',
+        'average_watts',
+        'weighted_average_watts',
+        'average_speed',
+        'distance',
+        'moving_time',
+        'total_elevation_gain',
+        'sport',
+        'utc_offset',
+        '_timestamp',
+    )
+
+    # numeric fields that can be charted
+    metrics = (
+        'average_watts',
+        'weighted_average_watts',
+        'average_speed',
+        'distance',
+        'moving_time',
+        'total_elevation_gain',
+    )
+
+    def __init__(self):
+        self.start_date = None
+        self.average_watts = None
+        self.weighted_average_watts = None
+        self.average_speed = None
+        self.distance = None
+        self.moving_time = None
+        self.total_elevation_gain = None
+        self.sport = None
+        self.utc_offset = None
+        self._timestamp = None
 
     def newFromDict(d):
         ret = Activity()
-        if ('start_date' in d):
-            ret.start_date = d['start_date']
+        ret.start_date = d.get('start_date')
+        ret.average_watts = d.get('average_watts')
+        ret.weighted_average_watts = d.get('weighted_average_watts')
+        ret.average_speed = d.get('average_speed')
+        ret.distance = d.get('distance')
+        ret.moving_time = d.get('moving_time')
+        ret.total_elevation_gain = d.get('total_elevation_gain')
+        ret.utc_offset = d.get('utc_offset')
 
-        if ('average_watts' in d):
-            ret.average_watts = d['average_watts']
+        if ('type' in d):
+            ret.sport = sys.intern(d['type'].lower())
 
-        if ('weighted_average_watts' in d):
-            ret.weighted_average_watts = d['weighted_average_watts']
+        if (ret.start_date):
+            ret.getDateTimestamp()
 
-        if ('average_speed' in d):
-            ret.average_speed = d['average_speed']
+        return ret
 
-        if ('distance' in d):
-            ret.distance = d['distance']
+    def newFromColumns(count: int, columns: dict) -> list:
+        """
+        Create activities from columns of values (see ActivityCodec), which
+        is quicker than newFromDict() for each, as the sports are only
+        lowercased once each, and the start dates can be already parsed
 
-        if ('moving_time' in d):
-            ret.moving_time = d['moving_time']
+        :param count:   the number of activities
+        :param columns: dict of field name to list of values. The _timestamp
+                        column, if given, has each start_date as epoch
+                        seconds (or None, to parse the start_date)
 
-        if ('total_elevation_gain' in d):
-            ret.total_elevation_gain = d['total_elevation_gain']
+        :return list of Activity
+        """
+        none = [None] * count
+        sports = {
+            sport: sys.intern(sport.lower())
+            for sport in set(columns.get('type', ())) if sport
+        }
+        sports[None] = None
 
-        if ('type' in d):
-            ret.sport = d['type'].lower()
+        out = []
+        for (start_date, timestamp, sport, utc_offset, *metrics) in zip(
+                columns.get('start_date', none),
+                columns.get('_timestamp', none),
+                columns.get('type', none),
+                columns.get('utc_offset', none),
+                *[columns.get(metric, none) for metric in Activity.metrics]):
+            # every slot is set here, so __init__ is skipped
+            ret = Activity.__new__(Activity)
+            ret.start_date = start_date
+            (ret.average_watts, ret.weighted_average_watts,
+             ret.average_speed, ret.distance, ret.moving_time,
+             ret.total_elevation_gain) = metrics
+            ret.sport = sports[sport]
+            ret.utc_offset = utc_offset
+            ret._timestamp = timestamp
+
+            if (start_date and timestamp is None):
+                ret.getDateTimestamp()
+
+            out.append(ret)
 
-        return ret
+        return out
 
-    def getDateTime(self):
-        date_string = self.start_date.rstrip('Z')
-        date = datetime.fromisoformat(date_string)
+    def getDateTime(self) -> datetime:
+        """
+        Get the start date of the activity (in UTC, without tzinfo)
 
-        return date
+        :return datetime
+        """
+        return datetime.fromtimestamp(self.getDateTimestamp(), timezone.utc) \
+            .replace(tzinfo=None)
 
-    def getDateTimestamp(self):
-        return self.getDateTime().timestamp()
+    def getDateTimestamp(self) -> float:
+        """
+        Get the start date of the activity as seconds since the epoch. The
+        start_date string is only parsed on the first call
+
+        :return float
+        """
+        if (self._timestamp is None):
+            date_string = self.start_date.rstrip('Z')
+            self._timestamp = (
+                datetime.fromisoformat(date_string) - EPOCH).total_seconds()
+
+        return self._timestamp
 
     def getDateHumanReadable(self):
         date = self.getDateTime()
@@ -67,144 +144,323 @@ class Activity:
 
     def dump(self):
         out = {
-            'start_date': getattr(self, 'start_date', None),
-            'average_watts': getattr(self, 'average_watts', None),
-            'average_speed': getattr(self, 'average_speed', None),
-            'distance': getattr(self, 'distance', None),
-            'moving_time': getattr(self, 'moving_time', None),
-            'total_elevation_gain': getattr(self, 'total_elevation_gain',
-                                            None),
-            'sport': getattr(self, 'sport', None),
+            'start_date': self.start_date,
+            'average_watts': self.average_watts,
+            'average_speed': self.average_speed,
+            'distance': self.distance,
+            'moving_time': self.moving_time,
+            'total_elevation_gain': self.total_elevation_gain,
+            'sport': self.sport,
         }
         return out
 
 
-class ActivityList(list):
-    def sortByDate(self, reverse: bool = False):
-        return sorted(
-            self,
-            reverse=reverse,
-            key=lambda self: self.getDateTimestamp()
-        )
+class ActivityColumns:
+    """
+    Columnar representation of a list of activities: one numpy array per
+    metric, plus epoch seconds, UTC offset and sport code arrays. Rows are in
+    the same order as the activities they were built from
+    """
+    def __init__(self, activities: list):
+        timestamps = numpy.array([
+            activity.getDateTimestamp() if activity.start_date else numpy.nan
+            for activity in activities
+        ], dtype=numpy.float64)
+
+        self.dated = ~numpy.isnan(timestamps)
+        self.epoch = numpy.where(self.dated, timestamps, 0) \
+            .astype(numpy.int64)
+
+        # activities without an offset are taken to be in UTC
+        self.offset = numpy.array([
+            activity.utc_offset or 0 for activity in activities
+        ], dtype=numpy.int64)
+
+        sports = [activity.sport or '' for activity in activities]
+        self.sports, self.sport = numpy.unique(
+            numpy.array(sports, dtype=str), return_inverse=True)
+
+        self.metrics = {}
+        for metric in Activity.metrics:
+            self.metrics[metric] = numpy.array(
+                [getattr(activity, metric) for activity in activities],
+                dtype=numpy.float64
+            )
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def slice(self, start: int, stop: int) -> ActivityColumns:
+        """
+        Get the columns for a range of rows. The arrays are views of these
+        ones, so nothing is copied
 
-    def getMinDate(self):
-        return self.sortByDate()[0].getDateTime()
+        :param start: the first row
+        :param stop:  the row after the last
 
-    def getMaxDate(self):
-        return self.sortByDate()[len(self) - 1].getDateTime()
+        :return ActivityColumns
+        """
+        out = ActivityColumns.__new__(ActivityColumns)
+        out.dated = self.dated[start:stop]
+        out.epoch = self.epoch[start:stop]
+        out.offset = self.offset[start:stop]
+        out.sports = self.sports
+        out.sport = self.sport[start:stop]
+        out.metrics = {
+            metric: values[start:stop]
+            for (metric, values) in self.metrics.items()
+        }
 
-    def aggregateAverageMetricByPeriod(
-            self, metric: str, period: AggregationPeriod) -> OrderedDict:
+        return out
+
+    def getSportMask(self, sport: str) -> numpy.ndarray:
         """
-        Average the requested metric for the activities in the list over the
-        given time format
+        Determine which rows are for the given sport
 
-        :param metric: the metric to average
-        :param period: the time period to aggregate over
+        :param sport: the sport, in lower case (e.g. ride)
 
-        :return Dict of activies with activity keys set based on timef
+        :return boolean ndarray, one per row
         """
-        grouped_by_time = {}
+        codes = numpy.flatnonzero(self.sports == sport)
 
-        for activity in self:
-            time_key = self._getTimeKey(activity, period)
+        if (len(codes) == 0):
+            return numpy.zeros(len(self), dtype=bool)
 
-            if (time_key not in grouped_by_time):
-                grouped_by_time[time_key] = []
+        return self.sport == codes[0]
 
-            grouped_by_time[time_key].append(activity)
+    def getEpoch(self, local: bool = False) -> numpy.ndarray:
+        """
+        Get the start date of every row
 
-        ret = {}
-        for time in grouped_by_time:
-            out_total = 0
-            out_count = 0
-            for activity in grouped_by_time[time]:
-                try:
-                    value = getattr(activity, metric)
+        :param local: in the local time where the activity started
 
-                    if (value > 0):
-                        out_total += value
-                        out_count += 1
-                except AttributeError:
-                    pass
-                except TypeError:
-                    pass
+        :return ndarray of integer epoch seconds
+        """
+        return self.epoch + self.offset if local else self.epoch
 
-            if (out_count > 0):
-                ret[time] = (out_total / out_count)
 
-        return OrderedDict(sorted(ret.items(), key=lambda item: item[0]))
+class ActivityAggregation:
+    """
+    Aggregates (count, total, average, min and max) of every metric over every
+    aggregation period for a set of activities. Everything is computed up
+    front from the columns, so any number of charts can then be selected from
+    the result without re-grouping the activities
+    """
+    types = ('average', 'total', 'count', 'min', 'max')
 
-    def aggregateTotalMetricByPeriod(
-            self, metric: str, period: AggregationPeriod) -> OrderedDict:
+    def __init__(self, columns: ActivityColumns,
+                 include: numpy.ndarray = None, calendar: Calendar = None):
         """
-        Total the requested metric for the activities in the list over the
-        given time format
+        :param columns:  the activities to aggregate
+        :param include:  boolean mask of the rows to include. If None, all
+                         rows are included
+        :param calendar: how to bucket the activities into periods
+        """
+        self.results = {}
 
-        :param metric: the metric to average
-        :param period: the time period to aggregate over
+        if (calendar is None):
+            calendar = Calendar()
 
-        :return Dict of activies with activity keys set based on timef
+        rows = columns.dated
+        if (include is not None):
+            rows = rows & include
+
+        epoch = columns.getEpoch(calendar.local)[rows]
+
+        for period in AggregationPeriod:
+            codes = calendar.getPeriodCodes(epoch, period)
+            (keys, groups) = numpy.unique(codes, return_inverse=True)
+            labels = numpy.array(calendar.formatPeriodCodes(keys, period))
+
+            for metric in Activity.metrics:
+                values = columns.metrics[metric][rows]
+
+                # missing values are NaN, so they are excluded here too
+                include = values > 0
+
+                self.results[(metric, period)] = ActivityAggregation._reduce(
+                    labels, groups[include], values[include])
+
+    def get(self, type: str, metric: str,
+            period: AggregationPeriod) -> OrderedDict:
+        """
+        Select one aggregate series
+
+        :param type:   the aggregate to select, one of
+                       ActivityAggregation.types. Unknown types are treated
+                       as average
+        :param metric: the metric to select
+        :param period: the time period to select
+
+        :return Dict of aggregated values keyed by time key, in time order
+        """
+        if (type not in ActivityAggregation.types):
+            type = 'average'
+
+        if ((metric, period) not in self.results):
+            return OrderedDict()
+
+        result = self.results[(metric, period)]
+
+        return OrderedDict(zip(result['keys'], result[type].tolist()))
+
+    def _reduce(labels: numpy.ndarray, groups: numpy.ndarray,
+                values: numpy.ndarray) -> dict:
+        """
+        Reduce the values in each group
+
+        :param labels: the time key for each group
+        :param groups: the group index for each value
+        :param values: the values to reduce
+
+        :return dict of the time keys and each aggregate, for groups that have
+                at least one value
+        """
+        size = len(labels)
+
+        count = numpy.bincount(groups, minlength=size)
+        total = numpy.bincount(groups, weights=values, minlength=size)
+
+        minimum = numpy.full(size, numpy.inf)
+        numpy.minimum.at(minimum, groups, values)
+
+        maximum = numpy.full(size, -numpy.inf)
+        numpy.maximum.at(maximum, groups, values)
+
+        present = count > 0
+
+        return {
+            'keys': labels[present].tolist(),
+            'count': count[present],
+            'total': total[present],
+            'average': total[present] / count[present],
+            'min': minimum[present],
+            'max': maximum[present],
+        }
+
+
+class ActivityList(list):
+    _columns = None
+    _aggregations = None
+
+    def getColumns(self) -> ActivityColumns:
+        """
+        Get the columnar representation of this list, building it on first use
+
+        :return ActivityColumns
+        """
+        # activity lists are only appended to while they are being built, so
+        # a length change is enough to tell that the columns are stale
+        if (self._columns is None or len(self._columns) != len(self)):
+            self._columns = ActivityColumns(self)
+            self._aggregations = {}
+
+        return self._columns
+
+    def getAggregation(self, sport: str = None,
+                       calendar: Calendar = None) -> ActivityAggregation:
         """
-        grouped_by_time = {}
+        Get the aggregates of every metric over every period for this list,
+        computing them on first use
 
-        for activity in self:
-            time_key = self._getTimeKey(activity, period)
+        :param sport:    only aggregate activities for this sport (e.g. ride)
+        :param calendar: how to bucket the activities into periods (UTC, and
+                         weeks starting on sunday, if not given)
 
-            if (time_key not in grouped_by_time):
-                grouped_by_time[time_key] = []
+        :return ActivityAggregation
+        """
+        columns = self.getColumns()
 
-            grouped_by_time[time_key].append(activity)
+        if (calendar is None):
+            calendar = Calendar()
 
-        ret = {}
+        key = (sport, calendar.key)
 
-        for time in grouped_by_time:
-            for activity in grouped_by_time[time]:
-                value = getattr(activity, metric, 0)
+        if (key in self._aggregations):
+            return self._aggregations[key]
 
-                if (value == 0):
-                    continue
+        if (sport is None):
+            aggregation = ActivityAggregation(columns, calendar=calendar)
+        else:
+            aggregation = ActivityAggregation(
+                columns, columns.getSportMask(sport), calendar)
 
-                if (time in ret):
-                    ret[time] += value
-                else:
-                    ret[time] = value
+        # only keep sports that are in the list, as sport comes from the user
+        if (sport is None or sport in columns.sports):
+            self._aggregations[key] = aggregation
 
-        return OrderedDict(sorted(ret.items(), key=lambda item: item[0]))
+        return aggregation
 
-    def _getTimeKey(
-            self, activity: Activity,
-            period: AggregationPeriod) -> str:
-        """Determine the time key (i.e. the period start date) for an activity
-        and aggregation period
+    def sortByDate(self, reverse: bool = False) -> SortedActivityList:
+        return SortedActivityList(self, reverse)
 
-        :param period:   the aggregation period
-        :param activity: the activity to deterime the time key for
+    def getMinDate(self):
+        return min(self, key=Activity.getDateTimestamp).getDateTime()
+
+    def getMaxDate(self):
+        return max(self, key=Activity.getDateTimestamp).getDateTime()
 
-        :return string the time key in Y-m-d format
+    def aggregateAverageMetricByPeriod(
+            self, metric: str, period: AggregationPeriod) -> OrderedDict:
         """
-        if period == AggregationPeriod.WEEK:
-            week = datetime.strftime(activity.getDateTime(), "%Y-%U-1")
-            return datetime.strptime(week, "%Y-%U-%w").strftime("%Y-%m-%d")
+        Average the requested metric for the activities in the list over the
+        given time format
 
-        if period == AggregationPeriod.MONTH:
-            return datetime.strftime(activity.getDateTime(), "%Y-%m-01")
+        :param metric: the metric to average
+        :param period: the time period to aggregate over
+
+        :return Dict of activies with activity keys set based on timef
+        """
+        return self.getAggregation().get('average', metric, period)
+
+    def aggregateTotalMetricByPeriod(
+            self, metric: str, period: AggregationPeriod) -> OrderedDict:
+        """
+        Total the requested metric for the activities in the list over the
+        given time format
 
-        if period == AggregationPeriod.YEAR:
-            return datetime.strftime(activity.getDateTime(), "%Y")
+        :param metric: the metric to average
+        :param period: the time period to aggregate over
 
-        return datetime.strftime(activity.getDateTime(), "%Y-%m-%d")
+        :return Dict of activies with activity keys set based on timef
+        """
+        return self.getAggregation().get('total', metric, period)
 
     def dump(self) -> str:
         """
         Dump out the entire activity list in json
         """
-        out = []
+        return ''.join(self.iterDump())
+
+    def iterDump(self, ndjson: bool = False, chunk_size: int = 100):
+        """
+        Dump out the activity list in json, a chunk at a time, so the whole
+        dump never needs to be held in memory
 
-        for activity in self:
-            out.append(activity.dump())
+        :param ndjson:     output newline delimited json (one activity per
+                           line) instead of a json array
+        :param chunk_size: the number of activities in each chunk
+
+        :return generator of strings, that together form the json
+        """
+        if (not ndjson):
+            yield '['
 
-        return json.dumps(out)
+        for start in range(0, len(self), chunk_size):
+            rows = [
+                json.dumps(activity.dump())
+                for activity in self[start:start + chunk_size]
+            ]
+
+            if (ndjson):
+                yield '\n'.join(rows) + '\n'
+            elif (start == 0):
+                yield ', '.join(rows)
+            else:
+                yield ', ' + ', '.join(rows)
+
+        if (not ndjson):
+            yield ']'
 
     def slice(activities: ActivityList, start: int, end: int) -> ActivityList:
         """
@@ -214,32 +470,37 @@ class ActivityList(list):
         :param start:      the starting index of the slice
         :param end:        the ending index of the slice. If greater than the
                            size of the ActivityList, we will return up to the
-                           end of the list
+                           end of the list. If negative, the slice is
+                           empty
 
-        :return ActivityList
+        :return ActivityList. For a SortedActivityList, this is a view (see
+                SortedActivityList.getView())
         """
-        out = ActivityList()
-        i = start
+        start = max(start, 0)
+        end = max(end, start)
 
-        if (end > len(activities)):
-            end = len(activities)
+        if (isinstance(activities, SortedActivityList)):
+            return activities.getView(start, end)
 
-        while (i < end):
-            out.append(activities[i])
-            i += 1
-
-        return out
+        return ActivityList(activities[start:end])
 
     def trimBeforeDate(activities: ActivityList, date: datetime):
         """
         Remove all activities before the given date
 
         :param date: the starting date. Any activities earlier than this will
-                     be removed
+                     be removed. Dates without tzinfo are taken to be UTC
 
         :return ActivityList trimmed to the given date
         """
+        if (date.tzinfo is None):
+            date = date.replace(tzinfo=timezone.utc)
+
         date_ts = date.timestamp()
+
+        if (isinstance(activities, SortedActivityList)):
+            return activities.getRange(after=date_ts)
+
         out = ActivityList()
 
         for activity in activities:
@@ -262,3 +523,139 @@ class ActivityList(list):
         return ActivityList(
             [activity for activity in activities if predicate(activity)]
         )
+
+
+class SortedActivityList(ActivityList):
+    """
+    An ActivityList in start date order (oldest first, or newest first if
+    reversed), with an index of the start dates. The first and last dates are
+    read without a scan, and date ranges are found by binary search (see
+    getRange())
+
+    Ranges and slices are views (see getView()): they share the index, and
+    the columns if they have been built, of the list they came from. Sorted
+    lists must not be modified
+    """
+    def __init__(self, activities: list = (), reverse: bool = False):
+        """
+        :param activities: the activities, in any order. Sorting activities
+                           that are already in order is O(n)
+        :param reverse:    newest first
+        """
+        if (not isinstance(activities, list)):
+            activities = list(activities)
+
+        try:
+            super().__init__(sorted(
+                activities, key=Activity.getDateTimestamp, reverse=reverse))
+            keys = [activity._timestamp for activity in self]
+        except AttributeError:
+            # some activities have no start date
+            super().__init__(sorted(
+                activities, key=SortedActivityList.getKey, reverse=reverse))
+            keys = [SortedActivityList.getKey(activity) for activity in self]
+
+        self.reverse = reverse
+        self._root = self
+        self._start = 0
+
+        # the start dates, oldest first whichever order the list is in, so
+        # they can be bisected
+        self._keys = keys[::-1] if reverse else keys
+
+    def getKey(activity: Activity) -> float:
+        """
+        :return float the activity's start date in epoch seconds. Activities
+                without a start date sort before all others
+        """
+        if (not activity.start_date):
+            return -math.inf
+
+        return activity.getDateTimestamp()
+
+    def sortByDate(self, reverse: bool = False) -> SortedActivityList:
+        if (reverse == self.reverse):
+            return self
+
+        return SortedActivityList(self, reverse)
+
+    def getMinDate(self):
+        return (self[-1] if self.reverse else self[0]).getDateTime()
+
+    def getMaxDate(self):
+        return (self[0] if self.reverse else self[-1]).getDateTime()
+
+    def getColumns(self) -> ActivityColumns:
+        """
+        Get the columnar representation of this list. A view uses a slice of
+        its root list's columns, if those have been built already
+
+        :return ActivityColumns
+        """
+        root = self._root
+
+        if (self._columns is None and root is not self
+                and root._columns is not None):
+            self._columns = root._columns.slice(
+                self._start, self._start + len(self))
+            self._aggregations = {}
+
+        return super().getColumns()
+
+    def getView(self, start: int, stop: int) -> SortedActivityList:
+        """
+        Get a range of this list by position. Only the references to the
+        activities are copied
+
+        :param start: the first position
+        :param stop:  the position after the last. This may be past the end
+
+        :return SortedActivityList
+        """
+        (start, stop, _) = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+
+        view = list.__new__(SortedActivityList)
+        list.__init__(view, self[start:stop])
+        view.reverse = self.reverse
+        view._root = self._root
+        view._start = self._start + start
+        view._keys = self._keys
+
+        return view
+
+    def getRange(self, after: float = None,
+                 before: float = None) -> SortedActivityList:
+        """
+        Get the activities that started between two times, by binary search
+
+        :param after:  only activities that started after this, in epoch
+                       seconds
+        :param before: only activities that started before this, in epoch
+                       seconds
+
+        :return SortedActivityList, a view of this one
+        """
+        keys = self._keys
+        start = self._start
+        stop = self._start + len(self)
+
+        if (not self.reverse):
+            lo = start
+            hi = stop
+
+            if (after is not None):
+                start = bisect.bisect_right(keys, after, lo, hi)
+            if (before is not None):
+                stop = bisect.bisect_left(keys, before, lo, hi)
+        else:
+            # position p in the root list is keys[len(keys) - 1 - p]
+            lo = len(keys) - stop
+            hi = len(keys) - start
+
+            if (after is not None):
+                stop = len(keys) - bisect.bisect_right(keys, after, lo, hi)
+            if (before is not None):
+                start = len(keys) - bisect.bisect_left(keys, before, lo, hi)
+
+        return self.getView(start - self._start, stop - self._start)
@@ -0,0 +1,265 @@
+import json
+import struct
+import zlib
+
+import numpy
+
+from ActivityQuery import ActivityQuery
+
+
+class ActivityCodec:
+    """
+    Compact binary encoding for a list of activity dicts, as kept by
+    ActivityStore. Activities are stored by column: ids as int64, start
+    dates as fixed width strings, types as indexes into a list of the types
+    used, and each metric as int64 or float64 (whichever keeps the values
+    as they were), with a bitmap of missing values. The whole lot is zlib
+    compressed, which works well on sorted, repetitive columns
+
+    The layout is a 4 byte magic, a 4 byte header length, a JSON header
+    describing the columns, and then the column data in header order
+    """
+    magic = b'SCA1'
+
+    # start dates are always in strava's "2024-01-31T12:34:56Z" format
+    date_width = 20
+
+    def encode(activities: list, fields: tuple, level: int = 3) -> bytes:
+        """
+        Encode activities
+
+        :param activities: activity dicts
+        :param fields:     the fields to keep. Fields other than id,
+                           start_date and type must be numbers
+        :param level:      zlib compression level
+
+        :return bytes
+        """
+        header = {'count': len(activities), 'columns': []}
+        buffers = []
+
+        for field in fields:
+            values = [activity.get(field) for activity in activities]
+            column = {'name': field}
+
+            if (field == 'start_date'):
+                data = numpy.array(
+                    [value or '' for value in values],
+                    dtype='S%d' % ActivityCodec.date_width)
+                column['type'] = 'date'
+            elif (field == 'type'):
+                names = sorted(set(value for value in values if value))
+                codes = {name: i + 1 for (i, name) in enumerate(names)}
+                data = numpy.array(
+                    [codes.get(value, 0) for value in values],
+                    dtype=numpy.uint16)
+                column['type'] = 'category'
+                column['names'] = names
+            else:
+                missing = numpy.array(
+                    [value is None for value in values], dtype=bool)
+                integral = all(
+                    type(value) is int for value in values
+                    if value is not None)
+
+                if (integral):
+                    data = numpy.array(
+                        [value or 0 for value in values], dtype=numpy.int64)
+                    column['type'] = 'int'
+                else:
+                    data = numpy.array(
+                        [numpy.nan if value is None else value
+                         for value in values], dtype=numpy.float64)
+                    column['type'] = 'float'
+
+                if (missing.any()):
+                    column['missing'] = True
+                    buffers.append(numpy.packbits(missing).tobytes())
+
+            buffers.append(data.tobytes())
+            header['columns'].append(column)
+
+        header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+        return ActivityCodec.magic + zlib.compress(
+            struct.pack('<I', len(header)) + header + b''.join(buffers),
+            level)
+
+    def decode(data: bytes) -> list:
+        """
+        Decode activities encoded by encode(). JSON (the format activities
+        used to be stored in) is decoded too
+
+        :param data: the encoded activities
+
+        :return list of activity dicts, without missing fields
+        """
+        if (not ActivityCodec.isEncoded(data)):
+            return json.loads(data)
+
+        (count, columns) = ActivityCodec.decodeColumns(data)
+        columns.pop('_timestamp', None)
+
+        return [
+            {
+                name: values[i] for (name, values) in columns.items()
+                if values[i] is not None
+            }
+            for i in range(count)
+        ]
+
+    def decodeColumns(data: bytes, query: ActivityQuery = None) -> tuple:
+        """
+        Decode activities encoded by encode() (or JSON) into columns, without
+        building a dict per activity. If there are start dates, they are
+        parsed into the extra _timestamp column (epoch seconds)
+
+        :param data:  the encoded activities
+        :param query: only decode the activities this selects (see
+                      ActivityQuery). The others are dropped while the
+                      columns are still arrays. This isn't applied to JSON
+
+        :return tuple (count, dict of field name to list of values). Missing
+                values are None
+        """
+        if (not ActivityCodec.isEncoded(data)):
+            activities = json.loads(data)
+            fields = set()
+            for activity in activities:
+                fields.update(activity)
+
+            return (len(activities), {
+                field: [activity.get(field) for activity in activities]
+                for field in fields
+            })
+
+        data = zlib.decompress(memoryview(data)[len(ActivityCodec.magic):])
+        (length,) = struct.unpack_from('<I', data)
+        header = json.loads(data[4:4 + length])
+        count = header['count']
+        offset = 4 + length
+        arrays = {}
+        timestamps = None
+
+        def read(dtype, size):
+            nonlocal offset
+
+            array = numpy.frombuffer(data, dtype, size, offset)
+            offset += array.nbytes
+
+            return array
+
+        for column in header['columns']:
+            missing = None
+            if (column.get('missing')):
+                missing = numpy.unpackbits(
+                    read(numpy.uint8, (count + 7) // 8), count=count) \
+                    .astype(bool)
+
+            if (column['type'] == 'date'):
+                values = read('S%d' % ActivityCodec.date_width, count)
+                missing = values == b''
+                timestamps = ActivityCodec.parseDates(values)
+            elif (column['type'] == 'category'):
+                values = read(numpy.uint16, count)
+            elif (column['type'] == 'int'):
+                values = read(numpy.int64, count)
+            else:
+                values = read(numpy.float64, count)
+
+            arrays[column['name']] = (column, values, missing)
+
+        rows = None
+        if (query is not None):
+            rows = ActivityCodec.select(query, count, arrays, timestamps)
+            count = len(rows)
+
+        columns = {}
+        for (name, (column, values, missing)) in arrays.items():
+            if (rows is not None):
+                values = values[rows]
+                missing = None if missing is None else missing[rows]
+
+            if (column['type'] == 'date'):
+                values = values.astype('U%d' % ActivityCodec.date_width)
+            elif (column['type'] == 'category'):
+                names = numpy.array([None] + column['names'], dtype=object)
+                values = names[values]
+
+            if (missing is not None and missing.any()):
+                values = values.astype(object)
+                values[missing] = None
+
+            columns[name] = values.tolist()
+
+        if (timestamps is not None):
+            if (rows is not None):
+                timestamps = timestamps[rows]
+
+            missing = numpy.isnan(timestamps)
+            if (missing.any()):
+                timestamps = timestamps.astype(object)
+                timestamps[missing] = None
+
+            columns['_timestamp'] = timestamps.tolist()
+        elif ('start_date' in columns):
+            columns['_timestamp'] = [None] * count
+
+        return (count, columns)
+
+    def select(query: ActivityQuery, count: int, arrays: dict,
+               timestamps: numpy.ndarray) -> numpy.ndarray:
+        """
+        Select the rows a query matches, from the decoded column arrays
+
+        :return ndarray of row indexes
+        """
+        if ('type' in arrays):
+            (column, codes, _) = arrays['type']
+            names = [None] + column['names']
+        else:
+            codes = numpy.zeros(count, dtype=numpy.uint16)
+            names = [None]
+
+        metrics = {}
+        if (query.metric in arrays):
+            (column, values, missing) = arrays[query.metric]
+
+            if (column['type'] in ('int', 'float')):
+                values = values.astype(numpy.float64)
+                if (missing is not None):
+                    values = numpy.where(missing, numpy.nan, values)
+
+                metrics[query.metric] = values
+
+        return query.select(timestamps, codes, names, metrics)
+
+    def isEncoded(data) -> bool:
+        """
+        :return bool whether data was encoded by encode(), rather than being
+                JSON (which may be a string)
+        """
+        return (isinstance(data, (bytes, bytearray, memoryview))
+                and bytes(data[:4]) == ActivityCodec.magic)
+
+    def parseDates(dates: numpy.ndarray) -> numpy.ndarray:
+        """
+        Parse start dates, all at once
+
+        :param dates: fixed width start date strings
+
+        :return ndarray of epoch seconds (as floats, like
+                Activity.getDateTimestamp()), NaN where there's no date. If
+                any date can't be parsed, None, and the dates are left to
+                Activity to parse
+        """
+        try:
+            # without the Z, which numpy won't parse
+            epoch = dates.astype('S19').astype('datetime64[s]')
+        except ValueError:
+            return None
+
+        seconds = epoch.astype(numpy.int64).astype(numpy.float64)
+        seconds[numpy.isnat(epoch)] = numpy.nan
+
+        return seconds
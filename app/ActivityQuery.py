@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import numpy
+
+
+class ActivityQuery:
+    """
+    The activities a request is going to use, so that activities it would
+    discard can be dropped while the activity store is decoded (see
+    ActivityCodec.decodeColumns()), before any Activity objects are built
+
+    Activities are selected in the order the chart routes apply their
+    arguments: the newest limit activities, then those in the date range,
+    then those for the sports that have the metric. The routes still apply
+    their arguments afterwards, so a query may select more activities than
+    it needs to (e.g. if start dates can't be read), but never fewer
+    """
+    def __init__(self, sports: set = None, after: float = None,
+                 before: float = None, limit: int = None, metric: str = None):
+        """
+        :param sports: only activities for these sports (in lower case, e.g.
+                       ride)
+        :param after:  only activities that started after this, in epoch
+                       seconds
+        :param before: only activities that started before this, in epoch
+                       seconds
+        :param limit:  only the newest limit activities
+        :param metric: only activities with a value (above zero, as counted
+                       by ActivityAggregation) for this metric
+        """
+        self.sports = set(sports) if sports else None
+        self.after = after
+        self.before = before
+        self.limit = limit
+        self.metric = metric
+
+    def select(self, timestamps: numpy.ndarray, codes: numpy.ndarray,
+               names: list, metrics: dict) -> numpy.ndarray:
+        """
+        Select the activities the query matches
+
+        :param timestamps: the start dates of the activities, newest first,
+                           in epoch seconds (NaN where missing, which sort
+                           last). None if the dates aren't known
+        :param codes:      the index into names of each activity's sport
+        :param names:      sport names (as strava has them, e.g. Ride), None
+                           for no sport
+        :param metrics:    dict of metric name to values (NaN where missing)
+
+        :return ndarray of the matching rows, in order
+        """
+        count = len(codes)
+        start = 0
+        stop = count if self.limit is None else min(count, self.limit)
+
+        if (timestamps is not None
+                and (self.after is not None or self.before is not None)):
+            # the rows are newest first, so the date range is a run of rows,
+            # found by binary search. Negated, the dates are in order
+            dates = -timestamps[:stop]
+
+            if (self.after is not None):
+                stop = int(numpy.searchsorted(dates, -self.after, 'left'))
+            if (self.before is not None):
+                start = int(numpy.searchsorted(dates, -self.before, 'right'))
+
+        rows = numpy.arange(start, max(start, stop))
+        include = None
+
+        if (self.sports is not None):
+            wanted = [
+                code for (code, name) in enumerate(names)
+                if name and name.lower() in self.sports
+            ]
+            include = numpy.isin(codes[rows], wanted)
+
+        if (self.metric in metrics):
+            present = metrics[self.metric][rows] > 0
+            include = present if include is None else include & present
+
+        return rows if include is None else rows[include]
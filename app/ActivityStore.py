@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+
+from requests_cache.backends.base import BaseCache
+
+from Activity import Activity
+from ActivityCodec import ActivityCodec
+from ActivityQuery import ActivityQuery
+from CacheStorage import CacheStorage
+from Metrics import Metrics
+from SessionPool import SessionPool
+
+
+class ActivityStore:
+    """
+    Persisted store of an athlete's activities, kept alongside the requests
+    cache in the same redis/sqlite backend. Alongside the activities it
+    records the newest start date seen (the cursor), so refreshes only need
+    to ask strava for activities after it, and a version fingerprint that
+    changes whenever the stored activities do
+
+    Activities are stored in a compact binary encoding (see ActivityCodec),
+    a small fraction of the size of the strava responses they came from
+    """
+    # the fields kept for each activity: everything Activity.newFromDict uses,
+    # plus the id to de-duplicate on
+    fields = ('id', 'start_date', 'type', 'utc_offset') + Activity.metrics
+
+    def __init__(self, storage: CacheStorage, athlete_id: int):
+        self.storage = storage
+        self.athlete_id = athlete_id
+        self.key = 'athlete:%s' % athlete_id
+        self.activities = None
+        self.cursor = None
+        self.synced_at = None
+        self.version = None
+
+    def newFromCache(cache: BaseCache, athlete_id: int) -> ActivityStore:
+        """
+        Create a store using the same backend as the given requests cache
+
+        :param cache:      the requests_cache backend to store activities in
+        :param athlete_id: the strava id of the athlete
+
+        :return ActivityStore, loaded with the details of the last sync
+        """
+        store = ActivityStore(
+            SessionPool.getStorage(cache, 'activities'), athlete_id)
+        store.load()
+
+        return store
+
+    def load(self) -> None:
+        """
+        Load the details of the last sync. The activities themselves are only
+        loaded when first needed (see getActivities())
+        """
+        with Metrics.span('store_read'):
+            meta = self.storage.get(self.key + ':meta')
+
+        if (meta is None):
+            return
+
+        meta = json.loads(meta)
+        self.cursor = meta['cursor']
+        self.synced_at = meta['synced_at']
+        self.version = meta['version']
+
+    def getActivities(self) -> list:
+        """
+        Get the stored activities, newest first
+
+        :return list of activity dicts
+        """
+        if (self.activities is None):
+            with Metrics.span('store_read'):
+                data = self.storage.get(self.key, binary=True)
+                self.activities = ActivityCodec.decode(data) if data else []
+
+        return self.activities
+
+    def getActivityObjects(self, query: ActivityQuery = None) -> list:
+        """
+        Get the stored activities as Activity objects, newest first. Unless
+        the activities have already been read as dicts (e.g. to merge new
+        ones), they're built straight from the stored columns
+
+        :param query: only build the activities this selects (see
+                      ActivityQuery). The query isn't applied to activities
+                      already read as dicts
+
+        :return list of Activity
+        """
+        if (self.activities is not None):
+            return [
+                Activity.newFromDict(activity) for activity in self.activities
+            ]
+
+        with Metrics.span('store_read'):
+            data = self.storage.get(self.key, binary=True)
+
+        if (not data):
+            return []
+
+        return Activity.newFromColumns(
+            *ActivityCodec.decodeColumns(data, query))
+
+    def save(self) -> None:
+        with Metrics.span('store_write'):
+            data = ActivityCodec.encode(
+                self.getActivities(), ActivityStore.fields)
+
+            self.synced_at = time.time()
+            self.version = hashlib.sha1(data).hexdigest()
+
+            self.storage.set(self.key, data)
+            self.storage.set(self.key + ':meta', json.dumps({
+                'cursor': self.cursor,
+                'synced_at': self.synced_at,
+                'version': self.version,
+            }))
+
+    def reset(self) -> None:
+        """
+        Forget all stored activities, so the next sync fetches everything
+        """
+        self.activities = []
+        self.cursor = None
+        self.synced_at = None
+        self.version = None
+
+    def isFresh(self, ttl: int) -> bool:
+        """
+        Determine if the store was synced within the last ttl seconds
+
+        :param ttl: the maximum age of the last sync, in seconds
+
+        :return bool
+        """
+        if (self.synced_at is None):
+            return False
+
+        return (time.time() - self.synced_at) < ttl
+
+    def merge(self, activities: list) -> int:
+        """
+        Add activities to the store, replacing any stored activities with the
+        same id, and advance the cursor
+
+        :param activities: activity dicts, as returned by strava
+
+        :return int the number of activities that were not already stored
+        """
+        by_id = {activity['id']: activity for activity in self.getActivities()}
+        before = len(by_id)
+
+        for activity in activities:
+            projected = {
+                field: activity[field]
+                for field in ActivityStore.fields if field in activity
+            }
+            by_id[activity.get('id')] = projected
+
+            if (activity.get('start_date')):
+                timestamp = int(
+                    Activity.newFromDict(activity).getDateTimestamp())
+
+                if (self.cursor is None or timestamp > self.cursor):
+                    self.cursor = timestamp
+
+        self.activities = sorted(
+            by_id.values(),
+            key=lambda activity: activity.get('start_date') or '',
+            reverse=True
+        )
+
+        return len(by_id) - before
@@ -0,0 +1,276 @@
+import time
+
+from requests_cache.backends.base import BaseCache
+from requests_cache.backends.redis import RedisDict
+from requests_cache.backends.sqlite import SQLiteDict
+
+
+class CacheStorage:
+    """
+    Key/value storage for strings (or bytes), kept in the same redis/sqlite
+    backend (and using the same connection) as the requests cache
+    """
+    def __init__(self, cache: BaseCache, name: str):
+        """
+        :param cache: the requests_cache backend to store values in
+        :param name:  name for this set of values. Used as the redis key prefix
+                      or the sqlite table name
+        """
+        responses = cache.responses
+
+        if (isinstance(responses, RedisDict)):
+            self.redis = responses.connection
+            self.prefix = 'strava_charts:%s:' % name
+            self.sqlite = None
+        else:
+            self.redis = None
+            self.sqlite = SQLiteDict(
+                responses.db_path,
+                table_name=name,
+                serializer=None,
+                wal=True,
+                busy_timeout=30000,
+            )
+            self.index_table = name + '_index'
+
+            # the keys in each index (see addToIndex()), a row per key
+            with self.sqlite.connection(commit=True) as con:
+                con.execute(
+                    'CREATE TABLE IF NOT EXISTS %s ('
+                    '    name TEXT, key TEXT, written REAL, expires INTEGER,'
+                    '    PRIMARY KEY (name, key)'
+                    ')' % self.index_table
+                )
+
+    def get(self, key: str, binary: bool = False) -> str:
+        """
+        Read a value
+
+        :param key:    the key to read
+        :param binary: return the value as stored, rather than decoding it
+                       as a string. For values written as bytes
+
+        :return string the value (bytes if binary), or None if not set or
+                expired
+        """
+        if (self.redis):
+            value = self.redis.get(self.prefix + key)
+
+            if (value is None or binary):
+                return value
+
+            return value.decode('utf-8')
+
+        with self.sqlite.connection() as con:
+            row = con.execute(
+                'SELECT value FROM %s WHERE key=? AND '
+                '(expires IS NULL OR expires > ?)' % self.sqlite.table_name,
+                (key, time.time())
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: int = None) -> None:
+        """
+        Write a value
+
+        :param key:   the key to write
+        :param value: the value to write, a string or bytes
+        :param ttl:   number of seconds until the value expires. If None, the
+                      value never expires
+        """
+        if (self.redis):
+            self.redis.set(self.prefix + key, value, ex=ttl)
+            return
+
+        expires = int(time.time() + ttl) if ttl else None
+
+        with self.sqlite.connection(commit=True) as con:
+            con.execute(
+                'INSERT OR REPLACE INTO %s (key, value, expires) '
+                'VALUES (?, ?, ?)' % self.sqlite.table_name,
+                (key, value, expires)
+            )
+
+    def increment(self, key: str, amount: int = 1, ttl: int = None) -> int:
+        """
+        Atomically add to an integer value. Missing (or expired) values
+        start from zero
+
+        :param key:    the key to increment
+        :param amount: the amount to add (may be negative)
+        :param ttl:    number of seconds until the value expires, from when
+                       it was first set. If None, the value never expires
+
+        :return int the new value
+        """
+        if (self.redis):
+            pipe = self.redis.pipeline()
+            pipe.incrby(self.prefix + key, amount)
+            if (ttl):
+                pipe.expire(self.prefix + key, ttl)
+
+            return pipe.execute()[0]
+
+        now = time.time()
+        expires = int(now + ttl) if ttl else None
+
+        with self.sqlite.connection(commit=True) as con:
+            con.execute(
+                'INSERT INTO {table} (key, value, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET '
+                'value = CASE WHEN expires <= ? THEN excluded.value '
+                'ELSE CAST(value AS INTEGER) + excluded.value END, '
+                'expires = CASE WHEN expires <= ? THEN excluded.expires '
+                'ELSE expires END'.format(table=self.sqlite.table_name),
+                (key, amount, expires, now, now)
+            )
+
+            return int(con.execute(
+                'SELECT value FROM %s WHERE key=?' % self.sqlite.table_name,
+                (key,)
+            ).fetchone()[0])
+
+    def add(self, key: str, value: str, ttl: int = None) -> bool:
+        """
+        Write a value, only if the key isn't already set (or has expired)
+
+        :param key:   the key to write
+        :param value: the value to write
+        :param ttl:   number of seconds until the value expires. If None, the
+                      value never expires
+
+        :return bool True if the value was written
+        """
+        if (self.redis):
+            return bool(self.redis.set(self.prefix + key, value, nx=True,
+                                       ex=ttl))
+
+        now = time.time()
+        expires = int(now + ttl) if ttl else None
+
+        with self.sqlite.connection(commit=True) as con:
+            return con.execute(
+                'INSERT INTO {table} (key, value, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET '
+                'value = excluded.value, expires = excluded.expires '
+                'WHERE expires <= ?'.format(table=self.sqlite.table_name),
+                (key, value, expires, now)
+            ).rowcount == 1
+
+    def deleteValue(self, key: str, value: str) -> None:
+        """
+        Delete a key, only if it still has the given value (e.g. to release
+        a lock only if it hasn't expired and been taken by someone else)
+
+        :param key:   the key to delete
+        :param value: the value it must have
+        """
+        if (self.redis):
+            self.redis.eval(
+                "if redis.call('get', KEYS[1]) == ARGV[1] then "
+                "return redis.call('del', KEYS[1]) end return 0",
+                1, self.prefix + key, value
+            )
+            return
+
+        with self.sqlite.connection(commit=True) as con:
+            con.execute(
+                'DELETE FROM %s WHERE key=? AND value=?'
+                % self.sqlite.table_name,
+                (key, value)
+            )
+
+    def addToIndex(self, index: str, key: str, max_entries: int,
+                   ttl: int = None) -> list:
+        """
+        Atomically record a key as the most recently written in an index of
+        keys, and drop the oldest keys from the index, so that it has at most
+        max_entries. Each key is dropped by exactly one caller, even with
+        several processes writing to the index at once
+
+        :param index:       the name of the index
+        :param key:         the key to record
+        :param max_entries: the number of keys to keep
+        :param ttl:         number of seconds until the key expires from the
+                            index. If None, it never expires
+
+        :return list of the keys dropped, oldest first, for the caller to
+                delete the values of
+        """
+        now = time.time()
+
+        if (self.redis):
+            name = self.prefix + index
+
+            # a MULTI/EXEC transaction, so nothing can run in between
+            pipe = self.redis.pipeline(transaction=True)
+            if (ttl):
+                pipe.zremrangebyscore(name, '-inf', now - ttl)
+            pipe.zadd(name, {key: now})
+            pipe.zrange(name, 0, -max_entries - 1)
+            pipe.zremrangebyrank(name, 0, -max_entries - 1)
+            if (ttl):
+                pipe.expire(name, ttl)
+
+            dropped = pipe.execute()[2 if ttl else 1]
+
+            return [value.decode('utf-8') for value in dropped]
+
+        expires = int(now + ttl) if ttl else None
+
+        with self.sqlite.connection(commit=True) as con:
+            try:
+                # take the write lock up front, so other processes' changes
+                # to the index wait for this one
+                con.execute('BEGIN IMMEDIATE')
+                con.execute(
+                    'DELETE FROM %s WHERE name=? AND expires <= ?'
+                    % self.index_table, (index, now))
+                con.execute(
+                    'INSERT OR REPLACE INTO %s (name, key, written, expires) '
+                    'VALUES (?, ?, ?, ?)' % self.index_table,
+                    (index, key, now, expires))
+
+                dropped = [row[0] for row in con.execute(
+                    'SELECT key FROM %s WHERE name=? '
+                    'ORDER BY written DESC, rowid DESC LIMIT -1 OFFSET ?'
+                    % self.index_table, (index, max_entries))]
+
+                con.executemany(
+                    'DELETE FROM %s WHERE name=? AND key=?'
+                    % self.index_table,
+                    [(index, value) for value in dropped])
+            except BaseException:
+                con.rollback()
+                raise
+
+        return dropped[::-1]
+
+    def delete(self, *keys: str) -> None:
+        if (not keys):
+            return
+
+        if (self.redis):
+            self.redis.delete(*[self.prefix + key for key in keys])
+            return
+
+        with self.sqlite.connection(commit=True) as con:
+            con.executemany(
+                'DELETE FROM %s WHERE key=?' % self.sqlite.table_name,
+                [(key,) for key in keys]
+            )
+
+    def deleteExpired(self) -> None:
+        """
+        Remove expired values. Redis expires values itself, so this only
+        applies to sqlite
+        """
+        if (self.redis):
+            return
+
+        with self.sqlite.connection(commit=True) as con:
+            con.execute(
+                'DELETE FROM %s WHERE expires <= ?' % self.sqlite.table_name,
+                (time.time(),)
+            )
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import enum
+
+import numpy
+
+
+class AggregationPeriod(enum.Enum):
+    DAY = 1
+    WEEK = 2
+    MONTH = 3
+    YEAR = 4
+
+    def strToEnum(s: str):
+        try:
+            return getattr(AggregationPeriod, s.upper())
+        except AttributeError:
+            return AggregationPeriod.DAY
+
+
+class Calendar:
+    """
+    Buckets start dates into aggregation periods, for a whole array of dates
+    at once. Each date gets an integer code for its period (see
+    getPeriodCodes()), and only the distinct codes are turned into time keys
+    (see formatPeriodCodes())
+
+    Weeks start on week_start:
+    - SUNDAY: labelled with the monday after the sunday that starts the week,
+      as they always have been (from "%Y-%U-1"), e.g. 2024-01-08
+    - MONDAY: labelled with the monday that starts the week
+    - ISO: ISO 8601 weeks (which start on monday), labelled with the ISO year
+      and week number, e.g. 2024-W02
+
+    Dates are bucketed in UTC, or with local, in the local time where each
+    activity started (start_date_local, i.e. start_date plus utc_offset)
+    """
+    SUNDAY = 'sunday'
+    MONDAY = 'monday'
+    ISO = 'iso'
+
+    def __init__(self, week_start: str = SUNDAY, local: bool = False):
+        """
+        :param week_start: SUNDAY, MONDAY or ISO
+        :param local:      bucket by local time, rather than UTC
+        """
+        if (week_start not in (Calendar.SUNDAY, Calendar.MONDAY,
+                               Calendar.ISO)):
+            raise ValueError("unknown week start: %s" % week_start)
+
+        self.week_start = week_start
+        self.local = local
+
+        # identifies the buckets this calendar makes, e.g. to cache on
+        self.key = '%s:%s' % (week_start, 'local' if local else 'utc')
+
+    def newFromConfig(config) -> Calendar:
+        """
+        Create the calendar set by chart_week_start and chart_local_time
+
+        :param config: the application Config
+
+        :return Calendar
+        """
+        return Calendar(
+            config.get('chart_week_start', Calendar.SUNDAY),
+            bool(config.get('chart_local_time', False))
+        )
+
+    def getPeriodCodes(self, epoch: numpy.ndarray,
+                       period: AggregationPeriod) -> numpy.ndarray:
+        """
+        Determine the time period (i.e. the period start date) for every
+        date, as an integer code
+
+        :param epoch:  the dates, as integer epoch seconds (in local time, if
+                       this is a local calendar)
+        :param period: the aggregation period
+
+        :return ndarray of integer codes, one per date
+        """
+        days = epoch // 86400
+
+        if period == AggregationPeriod.WEEK:
+            # 1970-01-01 was a thursday, so (days + 4) % 7 is days since
+            # sunday, and (days + 3) % 7 days since monday
+            if (self.week_start == Calendar.SUNDAY):
+                return days - (days + 4) % 7 + 1
+
+            return days - (days + 3) % 7
+
+        if period == AggregationPeriod.MONTH:
+            return days.astype('datetime64[D]').astype('datetime64[M]') \
+                .astype(numpy.int64)
+
+        if period == AggregationPeriod.YEAR:
+            return days.astype('datetime64[D]').astype('datetime64[Y]') \
+                .astype(numpy.int64)
+
+        return days
+
+    def formatPeriodCodes(self, codes: numpy.ndarray,
+                          period: AggregationPeriod) -> list:
+        """
+        Convert period codes from getPeriodCodes() to time keys
+
+        :param codes:  the period codes to convert
+        :param period: the aggregation period the codes were built with
+
+        :return list of string time keys in Y-m-d (or Y for years, or Y-Ww
+                for ISO weeks) format
+        """
+        if (period == AggregationPeriod.WEEK
+                and self.week_start == Calendar.ISO):
+            # the ISO year is the year of the week's thursday
+            thursdays = (codes + 3).astype('datetime64[D]')
+            years = thursdays.astype('datetime64[Y]')
+            weeks = (thursdays - years).astype(numpy.int64) // 7 + 1
+
+            return [
+                '%s-W%02d' % (year, week) for (year, week) in zip(
+                    numpy.datetime_as_string(years).tolist(), weeks.tolist())
+            ]
+
+        if period == AggregationPeriod.MONTH:
+            months = codes.astype('datetime64[M]')
+            return [key + '-01' for key in numpy.datetime_as_string(months)]
+
+        if period == AggregationPeriod.YEAR:
+            return numpy.datetime_as_string(codes.astype('datetime64[Y]')) \
+                .tolist()
+
+        return numpy.datetime_as_string(codes.astype('datetime64[D]')) \
+            .tolist()
+
+    def parsePeriodLabels(self, labels: list,
+                          period: AggregationPeriod) -> numpy.ndarray:
+        """
+        Convert time keys from formatPeriodCodes() back to period codes
+
+        :param labels: the time keys to convert
+        :param period: the aggregation period the keys were built with
+
+        :return ndarray of integer codes, one per time key
+        """
+        if (len(labels) == 0):
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        if (period == AggregationPeriod.WEEK
+                and self.week_start == Calendar.ISO):
+            # week 1 is the week with january 4th in it
+            years = numpy.array([label[:4] for label in labels],
+                                dtype='datetime64[Y]')
+            weeks = numpy.array([int(label[6:]) for label in labels])
+            january = years.astype('datetime64[D]').astype(numpy.int64) + 3
+
+            return january - (january + 3) % 7 + (weeks - 1) * 7
+
+        if period == AggregationPeriod.YEAR:
+            return numpy.array(labels, dtype='datetime64[Y]') \
+                .astype(numpy.int64)
+
+        days = numpy.array(labels, dtype='datetime64[D]')
+
+        if period == AggregationPeriod.MONTH:
+            return days.astype('datetime64[M]').astype(numpy.int64)
+
+        return days.astype(numpy.int64)
+
+    def getPeriodStep(self, period: AggregationPeriod) -> int:
+        """
+        :return int the difference between the codes of consecutive periods
+        """
+        return 7 if period == AggregationPeriod.WEEK else 1
+
+    def getPeriodDays(self, period: AggregationPeriod) -> float:
+        """
+        :return float the average length of a period, in days
+        """
+        if period == AggregationPeriod.YEAR:
+            return 365.2425
+
+        if period == AggregationPeriod.MONTH:
+            return 365.2425 / 12
+
+        return 7 if period == AggregationPeriod.WEEK else 1
@@ -1,42 +1,149 @@
-from pychartjs import BaseChart, ChartType, Color, Options
+import json
+import math
 
+import numpy
 
-class Chart(BaseChart):
+from pychartjs import ChartType, Color
+
+from Series import Series
+
+
+class Chart:
+    """
+    Builds the chart.js config for a line chart of an aggregation. All state
+    is kept per instance, so charts can be built concurrently (e.g. by
+    gunicorn's threaded workers)
+    """
     type = ChartType.Line
+    overlay_colors = ('#1F77B4', '#2CA02C', '#9467BD', '#D62728', '#8C564B')
+
+    def __init__(self, title: str = ""):
+        """
+        :param title: the chart's title
+        """
+        self.title = title
+        self.labels = []
+        self.datasets = []
+
+    def setData(self, data: dict, label: str = 'Metric') -> None:
+        """
+        Chart an aggregation, replacing any data already charted
+
+        :param data:  the aggregation, period label to value
+        :param label: the dataset's label
+        """
+        self.labels = list(data)
+        self.datasets = []
+        self.addDataset(label, ["%0.2f" % value for value in data.values()])
+
+    def setSeries(self, series: Series, label: str = 'Metric') -> None:
+        """
+        Chart a series, replacing any data already charted. Unlike setData(),
+        every period is labelled, with gaps left empty, so datasets derived
+        from the series can be added alongside it (see addValues())
+
+        :param series: the series
+        :param label:  the dataset's label
+        """
+        self.labels = series.getLabels()
+        self.datasets = []
+        self.addValues(label, series.values)
+
+    def addValues(self, label: str, values: numpy.ndarray,
+                  **style) -> dict:
+        """
+        Add a dataset of numbers, as for addDataset(). NaN values are left
+        empty
+
+        :return dict the dataset
+        """
+        return self.addDataset(label, [
+            None if math.isnan(value) else "%0.2f" % value
+            for value in values.tolist()
+        ], **style)
+
+    def addDataset(self, label: str, values: list, **style) -> dict:
+        """
+        Add a dataset, with a value for each label
+
+        :param label:  the dataset's label
+        :param values: the values
+        :param style:  chart.js dataset options, to override the defaults
+
+        :return dict the dataset
+        """
+        dataset = {'data': values}
+        dataset.update(Chart.getDatasetStyle())
+        dataset.update(style)
+        dataset['label'] = label
+
+        self.datasets.append(dataset)
+
+        return dataset
+
+    def addOverlay(self, label: str, values: numpy.ndarray,
+                   **style) -> dict:
+        """
+        Add a dataset derived from the charted one (e.g. a trend line), as a
+        thin line in the next overlay color
+
+        :return dict the dataset
+        """
+        color = Chart.overlay_colors[
+            (len(self.datasets) - 1) % len(Chart.overlay_colors)]
+        overlay = {
+            'borderColor': color,
+            'borderWidth': 2,
+            'pointBorderWidth': 0,
+            'pointRadius': 0,
+        }
+        overlay.update(style)
+
+        return self.addValues(label, values, **overlay)
+
+    def getDatasetStyle() -> dict:
+        """
+        :return dict the default chart.js options for a dataset
+        """
+        color = Color.JSLinearGradient('ctx', 0, 0, 1000, 0)
+        color.addColorStop(0, '#E87722')
+
+        return {
+            'backgroundColor': '#FFFFFF',
+            'borderColor': color.returnGradient(),
+            'fill': False,
+            'pointBorderWidth': 7,
+            'pointRadius': 1,
+            'spanGaps': True,
+            'lineTension': 0.2,
+        }
+
+    def getOptions(self) -> dict:
+        """
+        :return dict the chart.js options
+        """
+        return {
+            'title': {'text': self.title, 'display': True, 'fontSize': 18},
+            'legend': {
+                'position': 'Bottom',
+                'labels': {'fontColor': Color.Gray, 'fullWidth': True},
+            },
+            'scales': {
+                'yAxes': [{'ticks': {'beginAtZero': True, 'padding': 15}}],
+                'responsive': True,
+            },
+            'plugins': {},
+        }
+
+    def get(self) -> str:
+        """
+        :return string the chart.js config, as JSON. Javascript (e.g. the
+                gradient) is included as code, rather than as strings
+        """
+        js = json.dumps({
+            'type': self.type,
+            'data': {'labels': self.labels, 'datasets': self.datasets},
+            'options': self.getOptions(),
+        })
 
-    class labels:
-        labels = []
-
-    class data:
-        class Metric:
-            data = []
-            _color = Color.JSLinearGradient('ctx', 0, 0, 1000, 0)
-            _color.addColorStop(0, '#E87722')
-            backgroundColor = '#FFFFFF'
-
-            borderColor = _color.returnGradient()
-            fill = False
-            pointBorderWidth = 7
-            pointRadius = 1
-            spanGaps = True
-            lineTension = 0.2
-
-    class options:
-        title = Options.Title(text="", fontSize=18)
-
-        _labels = Options.Legend_Labels(fontColor=Color.Gray, fullWidth=True)
-        legend = Options.Legend(position='Bottom', labels=_labels)
-
-        _yAxes = [
-            Options.General(
-                ticks=Options.General(
-                    beginAtZero=True,
-                    padding=15,
-                ),
-            )
-        ]
-
-        scales = Options.General(
-            yAxes=_yAxes,
-            responsive=True
-        )
+        return js.replace('"<<', '').replace('>>"', '')
@@ -1,29 +1,76 @@
 import os
+import threading
 import yaml
 
 
 class Config:
-    config = {}
+    """
+    Application config, read from config.yaml. The file is parsed once per
+    process and shared by every Config instance. Constructing a Config only
+    checks the file's mtime, and re-reads it if it has changed
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'config.yaml')
 
-    def __init__(self):
-        cwd = os.path.dirname(os.path.abspath(__file__))
+    _lock = threading.Lock()
+    _config = {}
+    _resolved = {}
+    _mtime = None
 
-        with open(cwd + "/config.yaml", 'r') as config_file:
-            try:
-                self.config = yaml.safe_load(config_file)
-            except yaml.YAMLError as e:
-                print("Failed to load config: %s" % e)
+    def __init__(self):
+        Config.reloadIfChanged()
 
     def get(self, key, default=None):
-        ret = self.config.get(key, default)
+        try:
+            return Config._resolved[key]
+        except KeyError:
+            pass
+
+        if (key not in Config._config):
+            return default
+
+        ret = Config._config[key]
 
         if isinstance(ret, str) and ret.startswith('[ENV]'):
-            ret = self._getFromEnviron(ret.strip('[ENV]'))
+            ret = self._getFromEnviron(ret[len('[ENV]'):])
+
+        Config._resolved[key] = ret
 
         return ret
 
     def dump(self):
-        return self.config
+        return Config._config
+
+    def reloadIfChanged() -> bool:
+        """
+        Re-read the config file if it has been modified since it was last read
+
+        :return bool True if the config was (re-)loaded
+        """
+        mtime = os.stat(Config.path).st_mtime
+
+        if (mtime == Config._mtime):
+            return False
+
+        Config.reload(mtime)
+
+        return True
+
+    def reload(mtime: float = None) -> None:
+        """
+        Re-read the config file, and discard any resolved [ENV] values
+
+        :param mtime: the modification time of the file being read, if known
+        """
+        with Config._lock:
+            with open(Config.path, 'r') as config_file:
+                try:
+                    Config._config = yaml.safe_load(config_file) or {}
+                except yaml.YAMLError as e:
+                    print("Failed to load config: %s" % e)
+
+            Config._resolved = {}
+            Config._mtime = mtime or os.stat(Config.path).st_mtime
 
     def _getFromEnviron(self, name: str) -> str:
         """
@@ -35,7 +82,4 @@ class Config:
         :return String the value of the value from environment variable, empty
                 string if not found or not set
         """
-        if (os.environ[name.upper()]):
-            return os.environ[name.upper()]
-
-        return ''
+        return os.environ.get(name.upper(), '')
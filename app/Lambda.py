@@ -1,22 +1,45 @@
 import base64
 import io
+import time
 from urllib.parse import urlencode
 
+from Metrics import Metrics
+
 
 class Lambda:
     request = {}
 
-    response = {
-        "statusCode": 500,
-        "headers": {
-            "Content-Type": "application/json"
-        },
-        "body": ""
-    }
+    # True until the first request in this instance has been handled
+    cold = True
 
     def __init__(self, event: dict):
+        # per instance, so headers can't carry over between invocations
+        self.response = {
+            "statusCode": 500,
+            "headers": {
+                "Content-Type": "application/json"
+            },
+            "body": ""
+        }
+
         self.request = self.getRequest(event)
 
+    def isWarmUpEvent(event: dict) -> bool:
+        """
+        Determine if a lambda event is a warm-up: either a scheduled
+        (EventBridge) event, or an event with "warmup" set. These are not HTTP
+        requests, and are used to keep an instance ready to serve requests
+
+        :param event: the lambda event
+
+        :return bool
+        """
+        if (event.get("warmup")):
+            return True
+
+        return (event.get("source") == "aws.events"
+                and event.get("detail-type") == "Scheduled Event")
+
     def getRequest(self, event: dict) -> dict:
         """
         Convert a lambda event (in API Gateway format) to the WSGI format for
@@ -73,11 +96,42 @@ class Lambda:
         return request
 
     def handleRequest(self, application) -> bool:
+        start = time.perf_counter()
         body = application(self.request, self._buildResponse)
-        self.response["body"] = bytes.join(b'', body).decode("utf-8")
+
+        # the body may be streamed, so collect all of it before responding
+        try:
+            self.response["body"] = bytes.join(b'', body).decode("utf-8")
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        # the application's Server-Timing doesn't include the time spent
+        # streaming the body, or whether this instance was cold
+        timing = [Metrics.formatTiming(
+            'lambda', time.perf_counter() - start)]
+
+        if (Lambda.cold):
+            timing.append('cold')
+            Lambda.cold = False
+
+        self.addServerTiming(', '.join(timing))
 
         return True
 
+    def addServerTiming(self, timing: str) -> None:
+        """
+        Add metrics to the response's Server-Timing header
+
+        :param timing: Server-Timing metrics, e.g. "lambda;dur=12.3"
+        """
+        headers = self.response["headers"]
+
+        if (headers.get("Server-Timing")):
+            timing = "%s, %s" % (headers["Server-Timing"], timing)
+
+        headers["Server-Timing"] = timing
+
     def getResponse(self) -> dict:
         return self.response
 
@@ -0,0 +1,238 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Request timings and counters. Each request records the time spent in each
+    phase of handling it (strava I/O, cache reads, parsing, aggregation,
+    rendering) as spans, which are returned to the client in the
+    Server-Timing header. Every span is also added to process wide
+    histograms, which are exposed in prometheus text format (see render())
+    """
+    prefix = 'strava_charts_'
+
+    # histogram bucket upper bounds, in seconds
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0)
+
+    # metric name: (type, help)
+    descriptions = {
+        'request_duration_seconds': (
+            'histogram', 'Time to handle a request, by route'),
+        'phase_duration_seconds': (
+            'histogram', 'Time spent in each phase of handling requests'),
+        'strava_requests_total': (
+            'counter', 'Requests for strava data, by requests cache result'),
+        'result_cache_total': (
+            'counter', 'Result cache lookups, by result'),
+    }
+
+    _lock = threading.Lock()
+    _histograms = {}
+    _counters = {}
+    _local = threading.local()
+
+    def startRequest() -> None:
+        """
+        Start recording spans for a new request on this thread
+        """
+        Metrics._local.spans = []
+        Metrics._local.start = time.perf_counter()
+
+    def endRequest(route: str) -> float:
+        """
+        Stop recording spans for the request on this thread, and record the
+        duration of the request
+
+        :param route: the route that handled the request
+
+        :return float the duration of the request, in seconds
+        """
+        duration = time.perf_counter() - Metrics._local.start
+
+        Metrics.observe('request_duration_seconds', duration, route=route)
+
+        return duration
+
+    @contextmanager
+    def span(name: str):
+        """
+        Time a phase of handling the current request
+
+        :param name: the name of the phase
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            Metrics.record(name, time.perf_counter() - start)
+
+    def record(name: str, duration: float) -> None:
+        """
+        Record a span that has already been timed. Spans recorded outside a
+        request (e.g. on worker threads) are only added to the histograms
+
+        :param name:     the name of the phase
+        :param duration: the time spent, in seconds
+        """
+        spans = getattr(Metrics._local, 'spans', None)
+
+        if (spans is not None):
+            spans.append((name, duration))
+
+        Metrics.observe('phase_duration_seconds', duration, phase=name)
+
+    def increment(name: str, amount: int = 1, **labels) -> None:
+        """
+        Increment a counter
+
+        :param name:   the name of the counter (see descriptions)
+        :param amount: the amount to increment by
+        :param labels: labels for this count
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + amount
+
+    def observe(name: str, value: float, **labels) -> None:
+        """
+        Add a value to a histogram
+
+        :param name:   the name of the histogram (see descriptions)
+        :param value:  the value to add
+        :param labels: labels for this value
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        with Metrics._lock:
+            if (key not in Metrics._histograms):
+                Metrics._histograms[key] = {
+                    'buckets': [0] * len(Metrics.buckets),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+
+            histogram = Metrics._histograms[key]
+
+            for i, bound in enumerate(Metrics.buckets):
+                if (value <= bound):
+                    histogram['buckets'][i] += 1
+
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def getServerTiming(total: float = None) -> str:
+        """
+        Build a Server-Timing header value from the spans recorded for the
+        current request. Repeated spans are summed, with the number of
+        occurrences as the description
+
+        :param total: the total duration of the request, in seconds
+
+        :return string
+        """
+        totals = {}
+        counts = {}
+
+        for (name, duration) in getattr(Metrics._local, 'spans', None) or []:
+            totals[name] = totals.get(name, 0.0) + duration
+            counts[name] = counts.get(name, 0) + 1
+
+        if (total is not None):
+            totals['total'] = total
+            counts['total'] = 1
+
+        return ', '.join(
+            Metrics.formatTiming(name, totals[name], counts[name])
+            for name in totals
+        )
+
+    def formatTiming(name: str, duration: float, count: int = 1) -> str:
+        """
+        Format a single Server-Timing metric
+
+        :param name:     the name of the metric
+        :param duration: the duration, in seconds
+        :param count:    the number of occurrences summed in duration
+
+        :return string
+        """
+        out = '%s;dur=%0.1f' % (name, duration * 1000)
+
+        if (count > 1):
+            out += ';desc="%dx"' % count
+
+        return out
+
+    def render() -> str:
+        """
+        Render every metric in prometheus text exposition format
+
+        :return string
+        """
+        lines = []
+
+        with Metrics._lock:
+            histograms = {
+                key: dict(value, buckets=list(value['buckets']))
+                for key, value in Metrics._histograms.items()
+            }
+            counters = dict(Metrics._counters)
+
+        for name, (type, help) in Metrics.descriptions.items():
+            lines.append('# HELP %s%s %s' % (Metrics.prefix, name, help))
+            lines.append('# TYPE %s%s %s' % (Metrics.prefix, name, type))
+
+            for (key, labels), value in sorted(counters.items()):
+                if (key == name):
+                    lines.append('%s%s%s %d' % (
+                        Metrics.prefix, name, Metrics._formatLabels(labels),
+                        value))
+
+            for (key, labels), value in sorted(histograms.items()):
+                if (key != name):
+                    continue
+
+                for bound, count in zip(Metrics.buckets, value['buckets']):
+                    lines.append('%s%s_bucket%s %d' % (
+                        Metrics.prefix, name,
+                        Metrics._formatLabels(labels + (('le', bound),)),
+                        count))
+
+                lines.append('%s%s_bucket%s %d' % (
+                    Metrics.prefix, name,
+                    Metrics._formatLabels(labels + (('le', '+Inf'),)),
+                    value['count']))
+                lines.append('%s%s_sum%s %f' % (
+                    Metrics.prefix, name, Metrics._formatLabels(labels),
+                    value['sum']))
+                lines.append('%s%s_count%s %d' % (
+                    Metrics.prefix, name, Metrics._formatLabels(labels),
+                    value['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def reset() -> None:
+        """
+        Discard every recorded metric
+        """
+        with Metrics._lock:
+            Metrics._histograms = {}
+            Metrics._counters = {}
+
+    def _formatLabels(labels: tuple) -> str:
+        if (not labels):
+            return ''
+
+        return '{%s}' % ','.join(
+            '%s="%s"' % (
+                name,
+                str(value).replace('\\', '\\\\').replace('"', '\\"')
+            )
+            for (name, value) in labels
+        )
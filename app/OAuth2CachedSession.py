@@ -1,15 +1,207 @@
+import hashlib
+import json
+
+from urllib.parse import urlparse, parse_qs
+
+from requests.adapters import HTTPAdapter
+from requests_cache.backends.redis import RedisDict
 from requests_cache.session import CacheMixin
 from requests_oauthlib import OAuth2Session
 
+from CacheStorage import CacheStorage
+from SingleFlight import SingleFlight
+
 
 class OAuth2CachedSession(
     CacheMixin,
     OAuth2Session
 ):
-    def __init__(self, *, oauth_kwargs: dict, cache_kwargs: dict):
+    """
+    An oauth session with a requests cache. Pages of activities are cached
+    for different times depending on how likely they are to change (see
+    getExpireAfter()), and concurrent token refreshes are coalesced (see
+    refresh_token())
+    """
+    # seconds a refreshed token is kept for, for other requests that still
+    # have the token it replaced
+    token_ttl = 300
+
+    def __init__(self, *, oauth_kwargs: dict, cache_kwargs: dict,
+                 adapter: HTTPAdapter = None, head_ttl: int = None,
+                 history_ttl: int = None, single_flight: SingleFlight = None,
+                 token_storage: CacheStorage = None):
+        """
+        :param oauth_kwargs:  arguments for OAuth2Session
+        :param cache_kwargs:  arguments for requests_cache
+        :param adapter:       HTTP adapter to use for all requests, to share
+                              a connection pool between sessions
+        :param head_ttl:      seconds to cache pages of recent activities for
+        :param history_ttl:   seconds to cache pages of history for
+        :param single_flight: to coalesce token refreshes with
+        :param token_storage: where refreshed tokens are kept, for
+                              coalesced refreshes in other workers
+        """
         CacheMixin.__init__(self, **cache_kwargs)
         OAuth2Session.__init__(self, **oauth_kwargs)
 
+        self.head_ttl = head_ttl
+        self.history_ttl = history_ttl
+
+        # whose responses this session's are, e.g. athlete:<id>, for the
+        # cache key (see SessionPool.createCacheKey()). Only set this once
+        # strava has confirmed who the token is for
+        self.cache_scope = None
+        self.single_flight = single_flight
+        self.token_storage = token_storage
+
+        if (adapter):
+            self.mount('https://', adapter)
+            self.mount('http://', adapter)
+
+    def request(self, method: str, url: str, *args, expire_after=None,
+                **kwargs):
+        """
+        Make a request, cached for the time given by getExpireAfter() unless
+        expire_after is given
+        """
+        if (expire_after is None):
+            expire_after = self.getExpireAfter(url)
+
+        return super().request(
+            method, url, *args, expire_after=expire_after, **kwargs)
+
+    def send(self, request, **kwargs):
+        """
+        Send a prepared request, with caching, keyed on the session's
+        cache_scope
+        """
+        request.cache_scope = self.cache_scope
+
+        return super().send(request, **kwargs)
+
+    def refresh_token(self, token_url: str, refresh_token: str = None,
+                      **kwargs) -> dict:
+        """
+        Refresh the access token. Requests that have the same refresh token
+        (e.g. several charts opened at once) share a single refresh, and the
+        new token is kept for token_ttl seconds so that requests from other
+        workers, or that arrive just after, use it rather than refreshing
+        again
+
+        :param token_url     The URL to refresh the token at
+        :param refresh_token The refresh token, if not the session's
+
+        :return dict the new token
+        """
+        refresh_token = refresh_token or self.token.get('refresh_token')
+
+        if (self.single_flight is None or not refresh_token):
+            return super().refresh_token(
+                token_url, refresh_token=refresh_token, **kwargs)
+
+        key = 'token:%s' % hashlib.sha256(
+            refresh_token.encode('utf-8')).hexdigest()[:32]
+
+        def refresh() -> dict:
+            token = self.token_storage.get(key)
+
+            if (token is not None):
+                return json.loads(token)
+
+            token = OAuth2Session.refresh_token(
+                self, token_url, refresh_token=refresh_token, **kwargs)
+            self.token_storage.set(
+                key, json.dumps(token), OAuth2CachedSession.token_ttl)
+
+            return token
+
+        self.token = dict(self.single_flight.do(key, refresh))
+
+        return self.token
+
+    def getExpireAfter(self, url: str):
+        """
+        Get how long to cache the response for a URL. Pages of activities
+        before a fixed time (history) stay the same unless an old activity is
+        edited, so are kept for history_ttl. Other pages are of recent
+        activities (the head), which change whenever one is uploaded, so are
+        kept for head_ttl and then revalidated with a conditional request
+        (If-None-Match), which strava answers with a 304 if nothing changed
+
+        :param url The URL requested
+
+        :return the number of seconds to cache for, or None for the session's
+                default
+        """
+        query = parse_qs(urlparse(url).query)
+
+        if ('page' not in query):
+            return None
+
+        if ('before' in query):
+            return self.history_ttl
+
+        return self.head_ttl
+
+    def revalidate(self, url: str, **kwargs):
+        """
+        Get a response from the server, using a conditional request if a
+        cached response has an ETag (or Last-Modified) to validate against,
+        so that it's not sent again if unchanged
+
+        :param url The URL to get
+
+        :return the response. This is the cached response (with revalidated
+                set) if it was unchanged
+        """
+        res = self.get(url, refresh=True, **kwargs)
+
+        # a cached response without a validator is used without asking the
+        # server, so it has to be fetched again
+        if (getattr(res, 'from_cache', False) and not res.revalidated):
+            res = self.get(url, force_refresh=True, **kwargs)
+
+        return res
+
+    def getCachedResponses(self, keys: list) -> dict:
+        """
+        Read several cached responses in a single round trip to the cache
+        backend (an MGET for redis, one query for sqlite)
+
+        :param keys The cache keys to read
+
+        :return dict of cache key to response, for those responses that are
+                cached and haven't expired
+        """
+        responses = self.cache.responses
+
+        if (not keys):
+            return {}
+
+        if (isinstance(responses, RedisDict)):
+            values = responses.connection.mget(responses._bkeys(keys))
+        else:
+            with responses.connection() as con:
+                rows = dict(con.execute(
+                    'SELECT key, value FROM %s WHERE key IN (%s)'
+                    % (responses.table_name, ','.join('?' * len(keys))),
+                    keys
+                ).fetchall())
+
+            values = [rows.get(key) for key in keys]
+
+        out = {}
+        for (key, value) in zip(keys, values):
+            if (value is None):
+                continue
+
+            res = responses.deserialize(key, value)
+
+            if (res is not None and not res.is_expired):
+                out[key] = res
+
+        return out
+
     def getCacheKey(self, request) -> str:
         """
         Get the cache key that requests_cache uses for the given request
@@ -18,15 +210,18 @@ class OAuth2CachedSession(
 
         :return string the cache key
         """
+        request.cache_scope = self.cache_scope
+
         return self.cache.create_key(request)
 
-    def clear(self, request) -> None:
+    def clear(self, response) -> None:
         """
         clear the cache for a result
 
-        :param request the request to clear from the cache
+        :param response the cached response to clear from the cache. Its
+                        request can't be used to find the key, as the
+                        credentials are redacted from cached requests
 
         :return None
         """
-        key = self.getCacheKey(request)
-        self.cache.delete(key)
+        self.cache.delete(response.cache_key)
@@ -0,0 +1,238 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from CacheStorage import CacheStorage
+
+
+class RateLimiter:
+    """
+    Keeps requests to strava within the application's rate limits: a number
+    of requests per 15 minutes (reset on the quarter hour) and per day (reset
+    at midnight UTC). Usage is counted in the cache backend, so the budget is
+    shared by every worker, and is corrected from the X-RateLimit-Usage
+    headers strava returns.
+
+    Requests wait for budget in priority order, so interactive requests go
+    before background ones (e.g. backfilling an athlete's history), and
+    background requests may only use background_share of the budget. If
+    there is no budget within max_wait seconds, or strava keeps responding
+    with 429, a RateLimitException is raised
+    """
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    # the length of each rate limit window, in seconds
+    windows = (900, 86400)
+
+    def __init__(self, storage: CacheStorage, limits: tuple = (200, 2000),
+                 background_share: float = 0.8, max_wait: float = 10,
+                 max_retries: int = 3):
+        """
+        :param storage:          where usage is counted
+        :param limits:           the 15 minute and daily limits, until strava
+                                 tells us otherwise
+        :param background_share: the share of each limit that background
+                                 requests may use
+        :param max_wait:         the longest to wait for budget, in seconds
+        :param max_retries:      the number of times to retry a request that
+                                 gets a 429
+        """
+        self.storage = storage
+        self.limits = tuple(limits)
+        self.background_share = background_share
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.log = logging.getLogger('strava')
+
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def request(self, send: callable, priority: int = INTERACTIVE):
+        """
+        Make a request to strava, once there is budget for it, retrying (with
+        backoff) if strava responds with a 429
+
+        :param send:     callable that makes the request, and returns the
+                         response
+        :param priority: INTERACTIVE or BACKGROUND
+
+        :return the response
+        """
+        deadline = time.time() + self.max_wait
+
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority, deadline)
+
+            res = send()
+            self.update(res.headers)
+
+            if (res.status_code != 429):
+                return res
+
+            # other requests will be told to wait by the usage in the 429's
+            # headers. This one backs off, in case that's not enough
+            backoff = min(2 ** attempt, self.getRetryAfter())
+            self.log.debug("rate limited by strava, retrying in %ds"
+                           % backoff)
+
+            if (time.time() + backoff > deadline):
+                break
+
+            time.sleep(backoff)
+
+        raise RateLimitException(self.getRetryAfter())
+
+    def acquire(self, priority: int, deadline: float) -> None:
+        """
+        Wait (in priority order) until there is budget for a request, and
+        count it
+
+        :param priority: INTERACTIVE or BACKGROUND
+        :param deadline: the time to give up waiting at
+        """
+        entry = (priority, next(self._sequence))
+
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+
+            try:
+                while (True):
+                    wait = deadline - time.time()
+
+                    # only the request at the head of the queue may take
+                    # budget. The others wait for it to
+                    if (self._queue[0] == entry):
+                        retry_after = self._reserveUnlocked(entry)
+
+                        if (retry_after is None):
+                            return
+
+                        wait = min(wait, retry_after)
+
+                        if (time.time() + retry_after > deadline):
+                            raise RateLimitException(retry_after)
+                    elif (wait <= 0):
+                        raise RateLimitException(self.getRetryAfter())
+
+                    self._condition.wait(wait)
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+
+    def _reserveUnlocked(self, entry: tuple):
+        """
+        Reserve budget for the request at the head of the queue. It leaves the
+        queue while the usage is counted, which is a round trip (or a few) to
+        the cache backend, so the lock is released for it and the next
+        request can go at the same time. Called with the lock held
+
+        :param entry: the request's (priority, sequence) queue entry
+
+        :return see reserve()
+        """
+        heapq.heappop(self._queue)
+        self._condition.notify_all()
+        self._condition.release()
+
+        try:
+            return self.reserve(entry[0])
+        finally:
+            self._condition.acquire()
+            heapq.heappush(self._queue, entry)
+
+    def reserve(self, priority: int):
+        """
+        Count a request against the budget, if there is room
+
+        :param priority: INTERACTIVE or BACKGROUND
+
+        :return None if the request was counted, otherwise the number of
+                seconds until there will be room
+        """
+        share = (self.background_share
+                 if priority == RateLimiter.BACKGROUND else 1)
+        now = time.time()
+        keys = self.getKeys(now)
+
+        for (i, key) in enumerate(keys):
+            usage = self.storage.increment(key, 1, self.windows[i])
+
+            if (usage > self.limits[i] * share):
+                # give back what was counted, including this one
+                for j in range(i + 1):
+                    self.storage.increment(keys[j], -1, self.windows[j])
+
+                return self.windows[i] - (now % self.windows[i])
+
+        return None
+
+    def update(self, headers) -> None:
+        """
+        Update the limits and usage from strava's response headers. Usage is
+        only ever raised, as requests may still be in flight
+
+        :param headers: the response headers
+        """
+        limits = RateLimiter.parseHeader(headers.get('X-RateLimit-Limit'))
+        usage = RateLimiter.parseHeader(headers.get('X-RateLimit-Usage'))
+
+        if (limits):
+            self.limits = limits
+
+        if (not usage):
+            return
+
+        for (i, key) in enumerate(self.getKeys(time.time())):
+            counted = int(self.storage.get(key) or 0)
+
+            if (usage[i] > counted):
+                self.storage.increment(key, usage[i] - counted,
+                                       self.windows[i])
+
+    def getRetryAfter(self) -> int:
+        """
+        :return int the number of seconds until there is room for an
+                interactive request
+        """
+        now = time.time()
+        retry_after = 1
+
+        for (i, key) in enumerate(self.getKeys(now)):
+            if (int(self.storage.get(key) or 0) >= self.limits[i]):
+                retry_after = max(
+                    retry_after, self.windows[i] - (now % self.windows[i]))
+
+        return int(retry_after)
+
+    def getKeys(self, now: float) -> tuple:
+        """
+        :return tuple the storage keys for each window at the given time
+        """
+        return tuple(
+            'usage:%d:%d' % (window, now // window)
+            for window in self.windows
+        )
+
+    def parseHeader(value: str) -> tuple:
+        """
+        Parse a rate limit header, e.g. "200,2000"
+
+        :return tuple of ints (15 minute, daily), or None if not valid
+        """
+        try:
+            values = tuple(int(part) for part in value.split(','))
+        except (AttributeError, ValueError):
+            return None
+
+        return values if len(values) == 2 else None
+
+
+class RateLimitException(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("strava rate limit reached")
+        self.retry_after = int(retry_after)
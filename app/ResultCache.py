@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import hashlib
+import json
+
+from requests_cache.backends.base import BaseCache
+
+from ActivityStore import ActivityStore
+from CacheStorage import CacheStorage
+from Metrics import Metrics
+from SessionPool import SessionPool
+
+
+class ResultCache:
+    """
+    Cache of results computed from an athlete's activities (aggregations and
+    rendered charts). Keys include the version of the athlete's activity
+    store, so entries never need invalidating: once the activities change,
+    lookups simply miss. Entries expire after a TTL, and only the most
+    recently written max_entries are kept for each athlete
+    """
+    # bump this when a change alters the results for the same activities
+    schema = 1
+
+    def __init__(self, storage: CacheStorage, athlete_id: int, version: str,
+                 ttl: int, max_entries: int):
+        self.storage = storage
+        self.athlete_id = athlete_id
+        self.version = version
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index_key = 'athlete:%s:recent' % athlete_id
+
+    def newFromCache(cache: BaseCache, store: ActivityStore, ttl: int,
+                     max_entries: int = 100) -> ResultCache:
+        """
+        Create a result cache using the same backend as the given requests
+        cache, for the athlete and version of the given activity store
+
+        :param cache:       the requests_cache backend to store results in
+        :param store:       the (synced) activity store the results are
+                            computed from
+        :param ttl:         number of seconds until entries expire
+        :param max_entries: the number of entries to keep for the athlete
+
+        :return ResultCache
+        """
+        return ResultCache(
+            SessionPool.getStorage(cache, 'results'),
+            store.athlete_id,
+            store.version,
+            ttl,
+            max_entries
+        )
+
+    def getKey(self, name: str, params: dict) -> str:
+        """
+        Build the key for a result
+
+        :param name:   the kind of result (e.g. aggregate, chart)
+        :param params: everything, besides the activities, that the result
+                       depends on
+
+        :return string
+        """
+        fingerprint = hashlib.sha1(
+            json.dumps(params, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+        return 'athlete:%s:%s:%d:%s:%s' % (
+            self.athlete_id, self.version, ResultCache.schema, name,
+            fingerprint)
+
+    def get(self, name: str, params: dict):
+        """
+        Read a result
+
+        :param name:   the kind of result
+        :param params: the parameters the result was computed with
+
+        :return the result, or None on a cache miss
+        """
+        if (self.version is None):
+            return None
+
+        with Metrics.span('result_cache'):
+            value = self.storage.get(self.getKey(name, params))
+
+        Metrics.increment(
+            'result_cache_total', result='miss' if value is None else 'hit')
+
+        if (value is None):
+            return None
+
+        return json.loads(value)
+
+    def set(self, name: str, params: dict, value) -> None:
+        """
+        Write a result, evicting the oldest entries for the athlete if there
+        are now more than max_entries
+
+        :param name:   the kind of result
+        :param params: the parameters the result was computed with
+        :param value:  the result. Must be JSON serializable
+        """
+        if (self.version is None):
+            return
+
+        with Metrics.span('result_cache'):
+            key = self.getKey(name, params)
+            self.storage.set(key, json.dumps(value), self.ttl)
+
+            evicted = self.storage.addToIndex(
+                self.index_key, key, self.max_entries, self.ttl)
+
+            if (evicted):
+                self.storage.delete(*evicted)
+                self.storage.deleteExpired()
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import math
+
+import numpy
+
+from Calendar import AggregationPeriod, Calendar
+
+
+class Series:
+    """
+    An aggregated series with a value for every period between its first and
+    last, e.g. every day rather than only the days with activities. Periods
+    without a value (gaps) are NaN, so the series is a plain array, and
+    everything derived from it (rolling windows, EWMA curves and trend lines)
+    is computed with cumulative sums in time linear in the number of periods,
+    whatever the window
+    """
+    # time constants, in days, of the fitness and fatigue curves
+    fitness_days = 42
+    fatigue_days = 7
+
+    def __init__(self, start: int, values: numpy.ndarray,
+                 period: AggregationPeriod, calendar: Calendar = None):
+        """
+        :param start:    the period code of the first value (see
+                         Calendar.getPeriodCodes())
+        :param values:   a value for each period from start on, NaN for gaps
+        :param period:   the aggregation period
+        :param calendar: the calendar the periods come from
+        """
+        self.start = start
+        self.values = values
+        self.period = period
+        self.calendar = calendar or Calendar()
+
+    def newFromAggregation(data: dict, period: AggregationPeriod,
+                           calendar: Calendar = None) -> Series:
+        """
+        Create a series from an aggregation, filling in the gaps between the
+        periods it has values for
+
+        :param data:     the aggregation, time key to value, in time order
+                         (see ActivityAggregation.get())
+        :param period:   the aggregation period
+        :param calendar: the calendar the aggregation was bucketed with
+
+        :return Series
+        """
+        calendar = calendar or Calendar()
+        values = numpy.fromiter(data.values(), dtype=float, count=len(data))
+
+        if (len(values) == 0):
+            return Series(0, values, period, calendar)
+
+        codes = calendar.parsePeriodLabels(list(data), period)
+        positions = (codes - codes[0]) // calendar.getPeriodStep(period)
+
+        filled = numpy.full(positions[-1] + 1, numpy.nan)
+        filled[positions] = values
+
+        return Series(int(codes[0]), filled, period, calendar)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def getLabels(self) -> list:
+        """
+        :return list of the time keys of every period in the series
+        """
+        step = self.calendar.getPeriodStep(self.period)
+        codes = self.start + numpy.arange(len(self.values)) * step
+
+        return self.calendar.formatPeriodCodes(codes, self.period)
+
+    def rollingSum(self, window: int) -> numpy.ndarray:
+        """
+        Sum the values over a rolling window, counting gaps as zero
+
+        :param window: the number of periods in the window, which ends at
+                       (and includes) each period
+
+        :return ndarray with the sum for each period
+        """
+        return Series._windowSums(self._getFilled(), window)
+
+    def rollingMean(self, window: int) -> numpy.ndarray:
+        """
+        Average the values over a rolling window, skipping gaps
+
+        :param window: the number of periods in the window, which ends at
+                       (and includes) each period
+
+        :return ndarray with the mean for each period, NaN where the window
+                has no values
+        """
+        counts = Series._windowSums(self._getPresent(), window)
+        sums = Series._windowSums(self._getFilled(), window)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(counts > 0, sums / counts, numpy.nan)
+
+    def ewma(self, periods: float) -> numpy.ndarray:
+        """
+        Exponentially weighted moving average of the values, counting gaps
+        as zero, e.g. the fitness and fatigue curves of training load
+
+        :param periods: the time constant, in periods. A value's weight
+                        decays by a factor of e over this many periods
+
+        :return ndarray with the average for each period
+        """
+        values = self._getFilled()
+        decay = math.exp(-1 / periods)
+        alpha = 1 - decay
+        out = numpy.empty(len(values))
+
+        # y[t] = decay ** t * (y[-1] * decay + alpha * sum(x[j] / decay ** j))
+        # for j <= t, which is a cumulative sum. The powers of decay would
+        # overflow over a long series, so it's summed in blocks short enough
+        # not to
+        block = max(1, int(300 * periods))
+        last = 0.0
+
+        for start in range(0, len(values), block):
+            x = values[start:start + block]
+            powers = decay ** numpy.arange(len(x))
+
+            out[start:start + len(x)] = powers * (
+                last * decay + alpha * numpy.cumsum(x / powers))
+            last = out[start + len(x) - 1]
+
+        return out
+
+    def getFitness(self) -> tuple:
+        """
+        The fitness and fatigue curves of training load, with time constants
+        of fitness_days and fatigue_days however long the periods are (e.g.
+        6 weeks and 1 week on a weekly series)
+
+        :return tuple of ndarray (fitness, fatigue)
+        """
+        days = self.calendar.getPeriodDays(self.period)
+
+        return (self.ewma(Series.fitness_days / days),
+                self.ewma(Series.fatigue_days / days))
+
+    def trend(self, window: int = None) -> numpy.ndarray:
+        """
+        Fit a least squares line to the values, skipping gaps
+
+        :param window: fit over the last window periods at each period,
+                       rather than once over the whole series
+
+        :return ndarray with the fitted value for each period, NaN where
+                there are too few values to fit a line
+        """
+        present = self._getPresent()
+        x = numpy.arange(len(self.values), dtype=float)
+        y = self._getFilled()
+
+        # sums of the values, x, x^2, y and xy that the fit is made from
+        terms = (present, x * present, x * x * present, y, x * y)
+
+        if (window is None):
+            sums = [numpy.sum(term) for term in terms]
+        else:
+            sums = [Series._windowSums(term, window) for term in terms]
+
+        (n, sx, sxx, sy, sxy) = sums
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            denominator = n * sxx - sx * sx
+            slope = (n * sxy - sx * sy) / denominator
+            intercept = (sy - slope * sx) / n
+
+            return numpy.where(
+                (n >= 2) & (denominator > 0), intercept + slope * x, numpy.nan)
+
+    def _getFilled(self) -> numpy.ndarray:
+        """
+        :return ndarray of the values, with zero for gaps
+        """
+        return numpy.nan_to_num(self.values, nan=0.0)
+
+    def _getPresent(self) -> numpy.ndarray:
+        """
+        :return ndarray of 1 for periods with a value, 0 for gaps
+        """
+        return (~numpy.isnan(self.values)).astype(float)
+
+    def _windowSums(values: numpy.ndarray, window: int) -> numpy.ndarray:
+        """
+        Sum values over a rolling window, from the differences of their
+        cumulative sum
+
+        :param values: the values to sum
+        :param window: the number of values in the window, which ends at
+                       (and includes) each value
+
+        :return ndarray with the sum for each value
+        """
+        window = max(1, window)
+        sums = numpy.concatenate(([0.0], numpy.cumsum(values)))
+        ends = numpy.arange(1, len(sums))
+
+        return sums[ends] - sums[numpy.maximum(ends - window, 0)]
@@ -0,0 +1,197 @@
+import hashlib
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests_cache import RedisCache, SQLiteCache
+from requests_cache.backends.base import BaseCache
+from requests_cache.cache_keys import create_key
+
+from CacheStorage import CacheStorage
+from Config import Config
+from RateLimiter import RateLimiter
+from SingleFlight import SingleFlight
+
+
+class SessionPool:
+    """
+    Process wide cache backends, HTTP connection pools and cache storage.
+    These are shared by every request (and every thread), so only the first
+    request in a process pays for connecting to redis and to strava. Only the
+    athlete's token is bound per request, in their OAuth2CachedSession
+    """
+    _lock = threading.Lock()
+    _backends = {}
+    _adapters = {}
+    _storage = {}
+    _rate_limiters = {}
+    _single_flights = {}
+
+    def getCacheBackend(config: Config) -> BaseCache:
+        """
+        Get the requests cache backend for the given config
+
+        :param config: the application config
+
+        :return BaseCache
+        """
+        if (config.get('cache_backend') == 'redis'):
+            key = (
+                'redis',
+                config.get('redis_host'),
+                config.get('redis_port', 6379),
+                config.get('redis_username', 'default'),
+            )
+        else:
+            key = (
+                'sqlite',
+                config.get('cache_data_dir', '/app')
+                + '/strava_charts.sqlite',
+            )
+
+        with SessionPool._lock:
+            if (key not in SessionPool._backends):
+                if (key[0] == 'redis'):
+                    backend = RedisCache(
+                        host=config.get('redis_host'),
+                        port=config.get('redis_port', 6379),
+                        username=config.get('redis_username', 'default'),
+                        password=config.get('redis_password'),
+                        ssl=config.get('redis_ssl', True),
+                    )
+                else:
+                    # several gunicorn workers share the file, so readers
+                    # mustn't block writers (or each other)
+                    backend = SQLiteCache(key[1], wal=True, busy_timeout=30000)
+
+                SessionPool._backends[key] = backend
+
+            return SessionPool._backends[key]
+
+    def createCacheKey(request, **kwargs) -> str:
+        """
+        Create the requests cache key for a request (a requests_cache key_fn).
+        This is the default key, made specific to the athlete: strava returns
+        each athlete's own data for the same URL, and the backends are
+        shared, so cached responses must never be shared between athletes
+
+        The athlete is the request's cache_scope, set by the session (see
+        OAuth2CachedSession.cache_scope). Access tokens are refreshed every
+        few hours, so keying on the athlete rather than the token keeps
+        responses that are cached for longer (e.g. history) reachable. Until
+        the athlete is known, the key is specific to the access token
+
+        :param request: the request
+        :param kwargs:  passed to requests_cache's create_key
+
+        :return string
+        """
+        key = create_key(request, **kwargs)
+        scope = getattr(request, 'cache_scope', None) \
+            or request.headers.get('Authorization')
+
+        if (not scope):
+            return key
+
+        return hashlib.sha256((key + scope).encode('utf-8')).hexdigest()[:32]
+
+    def getAdapter(pool_size: int = 10) -> HTTPAdapter:
+        """
+        Get an HTTP adapter (and so connection pool) to mount on sessions
+
+        :param pool_size: the maximum number of connections to keep per host
+
+        :return HTTPAdapter
+        """
+        with SessionPool._lock:
+            if (pool_size not in SessionPool._adapters):
+                SessionPool._adapters[pool_size] = HTTPAdapter(
+                    pool_connections=pool_size,
+                    pool_maxsize=pool_size,
+                )
+
+            return SessionPool._adapters[pool_size]
+
+    def getStorage(cache: BaseCache, name: str) -> CacheStorage:
+        """
+        Get key/value storage in the given cache backend
+
+        :param cache: the requests_cache backend to store values in
+        :param name:  name for this set of values (see CacheStorage)
+
+        :return CacheStorage
+        """
+        with SessionPool._lock:
+            if ((cache, name) not in SessionPool._storage):
+                SessionPool._storage[(cache, name)] = CacheStorage(cache, name)
+
+            return SessionPool._storage[(cache, name)]
+
+    def getRateLimiter(config: Config) -> RateLimiter:
+        """
+        Get the strava rate limiter. There is one per cache backend, which
+        counts usage in that backend, so all workers using it share a budget
+
+        :param config: the application config
+
+        :return RateLimiter
+        """
+        cache = SessionPool.getCacheBackend(config)
+        storage = SessionPool.getStorage(cache, 'ratelimit')
+
+        with SessionPool._lock:
+            if (cache not in SessionPool._rate_limiters):
+                SessionPool._rate_limiters[cache] = RateLimiter(
+                    storage,
+                    limits=config.get('strava_rate_limits', (200, 2000)),
+                    background_share=config.get(
+                        'rate_limit_background_share', 0.8),
+                    max_wait=config.get('rate_limit_max_wait', 10),
+                    max_retries=config.get('rate_limit_retries', 3),
+                )
+
+            return SessionPool._rate_limiters[cache]
+
+    def getSingleFlight(config: Config) -> SingleFlight:
+        """
+        Get the single flight for coalescing work (see SingleFlight). There
+        is one per cache backend, which keeps its locks in that backend, so
+        work is coalesced across every worker using it
+
+        :param config: the application config
+
+        :return SingleFlight
+        """
+        cache = SessionPool.getCacheBackend(config)
+        storage = SessionPool.getStorage(cache, 'locks')
+
+        with SessionPool._lock:
+            if (cache not in SessionPool._single_flights):
+                SessionPool._single_flights[cache] = SingleFlight(
+                    storage, timeout=config.get('single_flight_timeout', 30))
+
+            return SessionPool._single_flights[cache]
+
+    def connect(config: Config) -> None:
+        """
+        Open the connection to the cache backend now, rather than on first use
+
+        :param config: the application config
+        """
+        backend = SessionPool.getCacheBackend(config)
+
+        if (isinstance(backend, RedisCache)):
+            backend.responses.connection.ping()
+        else:
+            with backend.responses.connection():
+                pass
+
+    def reset() -> None:
+        """
+        Drop everything in the pool, e.g. after forking
+        """
+        with SessionPool._lock:
+            SessionPool._backends = {}
+            SessionPool._adapters = {}
+            SessionPool._storage = {}
+            SessionPool._rate_limiters = {}
+            SessionPool._single_flights = {}
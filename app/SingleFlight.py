@@ -0,0 +1,108 @@
+import threading
+import time
+import uuid
+
+from CacheStorage import CacheStorage
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that would do the same work, e.g. fetch the
+    same page from strava, so that only one of them does it
+
+    Within a process, calls with the same key while one is in flight wait
+    for it, and get its result (or its exception). Across processes, the
+    call holds a lock in the cache backend while it works, and other
+    processes wait for the lock before making their own call. Their call is
+    expected to find the work done (e.g. the page in the requests cache), so
+    work that's coalesced across processes must check for that first
+
+    If the lock isn't released within timeout seconds (e.g. the process
+    holding it died), the call is made anyway
+    """
+    # the longest to wait between checks of another process's lock
+    max_poll_interval = 0.5
+
+    def __init__(self, storage: CacheStorage, timeout: float = 30):
+        """
+        :param storage: where the locks are kept
+        :param timeout: the longest to wait for another call, in seconds.
+                        This is also how long a lock is held for at most
+        """
+        self.storage = storage
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key: str, fn: callable):
+        """
+        Call fn, unless a call with the same key is already in flight, in
+        which case wait for that instead
+
+        :param key: identifies the work fn does
+        :param fn:  callable that does the work
+
+        :return what fn returned, for whichever call did the work
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if (leader):
+                flight = self._flights[key] = Flight()
+
+        if (not leader):
+            if (not flight.done.wait(self.timeout)):
+                return fn()
+
+            if (flight.error is not None):
+                raise flight.error
+
+            return flight.result
+
+        try:
+            flight.result = self.doLocked(key, fn)
+
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+    def doLocked(self, key: str, fn: callable):
+        """
+        Call fn while holding the lock for key, waiting for any other process
+        holding it to release it first
+
+        :return what fn returned
+        """
+        owner = uuid.uuid4().hex
+        deadline = time.time() + self.timeout
+        interval = 0.01
+        locked = self.storage.add(key, owner, int(self.timeout) + 1)
+
+        while (not locked and time.time() < deadline):
+            time.sleep(interval)
+            interval = min(interval * 2, SingleFlight.max_poll_interval)
+            locked = self.storage.add(key, owner, int(self.timeout) + 1)
+
+        try:
+            return fn()
+        finally:
+            if (locked):
+                self.storage.deleteValue(key, owner)
+
+
+class Flight:
+    """
+    A call in progress, and eventually its outcome
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -1,17 +1,28 @@
 import base64
+import hashlib
 import json
 import logging
-import math
+import os
 import sys
+import threading
 import time
 
-from requests_cache import RedisCache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from requests_cache import DO_NOT_CACHE
 from requests_oauthlib import OAuth2Session, TokenUpdated
 from oauthlib.oauth2.rfc6749.errors import MissingTokenError
 
 from Config import Config
-from Activity import Activity, ActivityList
+from Activity import Activity, ActivityList, SortedActivityList
+from Calendar import Calendar
+from ActivityQuery import ActivityQuery
+from ActivityStore import ActivityStore
+from CacheStorage import CacheStorage
+from Metrics import Metrics
 from OAuth2CachedSession import OAuth2CachedSession
+from RateLimiter import RateLimiter, RateLimitException
+from SessionPool import SessionPool
 
 
 class Authentication:
@@ -31,7 +42,7 @@ class Authentication:
         )
 
         authorization_url, state = oauth.authorization_url(
-            'https://www.strava.com/oauth/authorize',
+            Authentication._getBaseUrl() + '/oauth/authorize',
             access_type="offline"
         )
 
@@ -61,7 +72,7 @@ class Authentication:
 
         try:
             token = oauth.fetch_token(
-                'https://www.strava.com/oauth/token',
+                Authentication._getBaseUrl() + '/oauth/token',
                 authorization_response=url,
                 include_client_id=True,
                 client_secret=secret,
@@ -74,6 +85,12 @@ class Authentication:
 
         return token
 
+    def _getBaseUrl() -> str:
+        """
+        :return: string the strava URL to authenticate against
+        """
+        return Authentication._config.get('strava_base_url', Strava.base_url)
+
     def _storeState(session, state):
         """Write oauth state data to this user's session
 
@@ -160,7 +177,9 @@ class CookieTokenStorage(TokenStorage):
 
 
 class Strava:
+    base_url = 'https://www.strava.com'
     max_page_size = 100
+    max_concurrent_pages = 4
 
     def debug(self, on=False):
         log = logging.getLogger('requests_oauthlib')
@@ -181,6 +200,11 @@ class Strava:
     def __init__(
             self, token_storage, debug: bool = False, force: bool = False):
         self.force = force
+        self.activity_store = None
+        self.verified_athlete_id = None
+
+        # called with the page number as each page of activities is fetched
+        self.on_page = None
         self.log = logging.getLogger('strava')
 
         if (debug):
@@ -188,130 +212,440 @@ class Strava:
             self.log.debug("Debug enabled")
 
         self.config = Config()
+        self.base_url = self.config.get('strava_base_url', Strava.base_url)
         self.max_page_size = self.config.get('max_page_size', 100)
+        self.max_concurrent_pages = self.config.get('max_concurrent_pages', 4)
+        self.cache_ttl = self.config.get('cache_ttl')
+        self.history_ttl = self.config.get('cache_history_ttl', 2592000)
+        self.rate_limiter = SessionPool.getRateLimiter(self.config)
+        self.single_flight = SessionPool.getSingleFlight(self.config)
         self.log.debug("Config loaded: %s" % self.config.dump())
 
         self.token_storage = token_storage
 
         token = token_storage.get()
 
-        if (self.config.get('cache_backend') == 'redis'):
-            backend = RedisCache(
-                host=self.config.get('redis_host'),
-                port=self.config.get('redis_port', 6379),
-                username=self.config.get('redis_username', 'default'),
-                password=self.config.get('redis_password'),
-                ssl=self.config.get('redis_ssl', True),
-            )
+        backend = SessionPool.getCacheBackend(self.config)
 
-            cache_kwargs = {
-                'backend': backend,
-                'expire_after': self.config.get('cache_ttl')
-            }
-        else:
-            cache_kwargs = {
-                'backend': self.config.get('cache_backend'),
-                'cache_name': self.config.get('cache_data_dir', '/app')
-                + '/strava_charts.sqlite',
-                'expire_after': self.config.get('cache_ttl')
-            }
+        cache_kwargs = {
+            'backend': backend,
+            'expire_after': self.config.get('cache_ttl'),
+            'key_fn': SessionPool.createCacheKey,
+        }
 
         self.oauth = OAuth2CachedSession(
             oauth_kwargs={
                 'token': token,
-                'auto_refresh_url': 'https://www.strava.com/oauth/token',
+                'auto_refresh_url': self.base_url + '/oauth/token',
                 'auto_refresh_kwargs': {
                     'client_id': self.config.get('strava_client_id'),
                     'client_secret': self.config.get('strava_client_secret')
                 },
             },
-            cache_kwargs=cache_kwargs
+            cache_kwargs=cache_kwargs,
+            adapter=SessionPool.getAdapter(
+                max(10, self.max_concurrent_pages)),
+            head_ttl=self.config.get('cache_head_ttl', 900),
+            history_ttl=self.history_ttl,
+            single_flight=self.single_flight,
+            token_storage=SessionPool.getStorage(backend, 'tokens'),
         )
 
-    def getActivities(self, num: int, offset: int = 0) -> ActivityList:
-        orig_num = num
+    def getActivities(self, num: int, offset: int = 0,
+                      query: ActivityQuery = None) -> ActivityList:
+        """
+        Get the user's most recent activities, newest first. Like
+        getAllActivities() these are read from the athlete's activity store
 
-        if (num > self.max_page_size):
-            remaining = num - self.max_page_size
-            num = self.max_page_size
-        else:
-            remaining = 0
+        :param: num    the number of activities to get
+        :param: offset the number of most recent activities to skip
+        :param: query  see getAllActivities()
 
-        out = ActivityList()
-        while (remaining >= 0):
-            self.log.debug(
-                "pagination parameters are: num=%s offset=%s remaining=%s"
-                % (num, offset, remaining)
-            )
+        return: ActivityList
+        """
+        out = self.getAllActivities(query).sortByDate(True)
 
-            page = math.floor(offset / num) + 1
+        return ActivityList.slice(out, offset, offset + num)
 
-            activities = self.getActivitiesPage(page, num)
+    def getAllActivities(self, query: ActivityQuery = None) -> ActivityList:
+        """
+        Get all activities for the user, for all time. These are read from the
+        athlete's activity store (see getActivityStore())
 
-            for activity in activities:
+        :param: query only build the activities this selects, the rest are
+                dropped as the store is decoded (see ActivityQuery)
+
+        return: SortedActivityList, newest first
+        """
+        store = self.getActivityStore()
+
+        with Metrics.span('parse'):
+            try:
+                return SortedActivityList(
+                    store.getActivityObjects(query), True)
+            except ValueError:
+                pass
+
+            # an activity couldn't be parsed, so go one by one to skip it
+            out = ActivityList()
+            for activity in store.getActivities():
                 try:
                     out.append(Activity.newFromDict(activity))
                 except ValueError as e:
-                    self.log.warning("Activity missing required field: %s" % e)
+                    self.log.warning(
+                        "Activity missing required field: %s" % e)
+
+            return out.sortByDate(True)
+
+    def getActivityStore(self, sync: bool = True) -> ActivityStore:
+        """
+        Get the athlete's activity store. The store is loaded once per
+        instance, and is first synced with strava if it has not been synced
+        within cache_ttl (or if we are forcing a refresh). Concurrent requests
+        for the same athlete share a single sync (see SingleFlight). If
+        strava's rate limit stops the sync, the activities from the last sync
+        are used
+
+        :param: sync set to False to skip syncing the store
 
-            offset += num
-            remaining = orig_num - offset
-            num = self.max_page_size
+        return: ActivityStore
+        """
+        if (self.activity_store is None):
+            store = ActivityStore.newFromCache(
+                self.oauth.cache, self.getVerifiedAthleteId())
 
-        out = out.sortByDate(True)
+            if (sync and (self.force or not store.isFresh(self.cache_ttl))):
+                started = time.time()
+                store = self.single_flight.do(
+                    'sync:%s:%d' % (store.athlete_id, self.force),
+                    lambda: self.syncActivityStore(store, started))
 
-        if (len(out) > orig_num):
-            return ActivityList.slice(out, 0, orig_num)
+            self.activity_store = store
 
-        return out
+        return self.activity_store
 
-    def getAllActivities(self) -> ActivityList:
+    def syncActivityStore(self, store: ActivityStore,
+                          started: float) -> ActivityStore:
         """
-        Get all activities for the user, for all time. Keep walking back
-        page-by-page until it looks like we have everything
+        Sync the activity store, unless another request (perhaps in another
+        worker) has synced it since this request started
 
-        return: ActivityList
+        :param: store   the activity store to sync
+        :param: started the time this request decided the store needed a sync
+
+        return: ActivityStore
         """
-        page = 1
-        done = False
-        out = ActivityList()
+        store.load()
 
-        while (not done):
-            activities = self.getActivitiesPage(page, self.max_page_size)
+        if (store.synced_at is not None and store.synced_at >= started):
+            return store
 
-            for activity in activities:
-                try:
-                    out.append(Activity.newFromDict(activity))
-                except ValueError as e:
-                    self.log.warning("Activity missing required field: %s" % e)
+        if (not self.force and store.isFresh(self.cache_ttl)):
+            return store
 
-            page = page + 1
+        try:
+            self.syncActivities(store, full=self.force)
+        except RateLimitException:
+            if (store.version is None):
+                raise
 
-            if (len(activities) < self.max_page_size):
-                self.log.debug(
-                    "Asked for %d got %d. Assuming all activities are fetched"
-                    % (self.max_page_size, len(activities))
-                )
+            self.log.warning(
+                "rate limited, using activities synced at %s"
+                % store.synced_at)
+
+        return store
+
+    def syncActivities(self, store: ActivityStore, full: bool = False) -> int:
+        """
+        Sync the activity store with strava. The first sync fetches the
+        entire history, after that only activities newer than the store's
+        cursor are fetched. The store is only changed once every page has
+        been fetched
+
+        :param: store the activity store to sync
+        :param: full  discard the stored activities and fetch everything
+
+        return: int the number of new activities
+        """
+        with Metrics.span('sync'):
+            if (full or store.cursor is None):
+                pages = self.getAllActivitiesPages(self.max_page_size)
+                store.reset()
+            else:
+                pages = self.getActivitiesPagesAfter(
+                    store.cursor, self.max_page_size)
+
+        count = 0
+        for activities in pages:
+            count += store.merge(activities)
+
+        store.save()
+
+        self.log.debug("synced %d new activities" % count)
+
+        return count
+
+    def getAllActivitiesPages(self, perPage: int) -> list:
+        """
+        Fetch every page of strava activities: the head (activities since the
+        history boundary, see getHistoryBoundary()) and then the history.
+        Pages of history are paged back from a fixed time, so their contents
+        don't move when new activities are uploaded, and they can be cached
+        for a long time (see OAuth2CachedSession.getExpireAfter())
+
+        :param: perPage the number of activities per page to fetch
+
+        return: list of pages, the head pages (oldest first) followed by the
+                history pages (newest first)
+        """
+        boundary = self.getHistoryBoundary()
+
+        # the head is fetched on this thread, so that if the token needs
+        # refreshing that happens here, where the new token can be stored (in
+        # the response)
+        pages = self.getActivitiesPagesAfter(boundary, perPage, cache=True)
+
+        return pages + self.getHistoryPages(boundary, perPage)
+
+    def getHistoryBoundary(self) -> int:
+        """
+        Get the time before which activities are fetched as history. This
+        moves forward every cache_history_ttl seconds, so in between the
+        history pages keep the same URLs (and cache keys)
+
+        return: int epoch seconds
+        """
+        return int(time.time() // self.history_ttl * self.history_ttl)
+
+    def getHistoryPages(self, before: int, perPage: int) -> list:
+        """
+        Fetch every page of activities that started before the given time.
+        Pages in the requests cache are read all at once (see
+        getCachedHistoryPages()), and only the others are requested. After
+        the first page, up to max_concurrent_pages pages are requested at
+        once, and each full page that comes back prefetches the next one.
+        The first page shorter than perPage marks the end, and any
+        outstanding requests for later pages are cancelled
+
+        :param: before  the history boundary, in epoch seconds
+        :param: perPage the number of activities per page to fetch
+
+        return: list of pages, in page order
+        """
+        cached = self.getCachedHistoryPages(before, perPage)
+
+        # every page is cached, up to the last one
+        if (cached and len(cached) == max(cached)):
+            pages = [
+                json.loads(cached[page].content)
+                for page in range(1, len(cached) + 1)
+            ]
+
+            if (len(pages[-1]) < perPage):
+                return pages
+
+        keys = {}
+
+        def fetch(page: int) -> list:
+            if (page in cached):
+                res = cached[page]
+            else:
+                res = self.getActivitiesPageResponse(
+                    page, perPage, before=before)
+
+            keys[page] = res.cache_key
+
+            return json.loads(res.content)
+
+        # the first page is fetched on this thread, which saves speculative
+        # requests for athletes with a single page of activities
+        pages = {1: fetch(1)}
+
+        if (len(pages[1]) < perPage):
+            return [pages[1]]
+
+        pending = {}
+        next_page = 2
+        last_page = None
+
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrent_pages)
+
+        try:
+            while (len(pending) < self.max_concurrent_pages):
+                future = executor.submit(fetch, next_page)
+                pending[future] = next_page
+                next_page += 1
+
+            while (pending):
+                done = wait(pending, return_when=FIRST_COMPLETED).done
+
+                for future in done:
+                    page = pending.pop(future)
+                    pages[page] = future.result()
+
+                    if (len(pages[page]) < perPage
+                            and (last_page is None or page < last_page)):
+                        self.log.debug(
+                            "Asked for %d got %d on page %d. Assuming all "
+                            "activities are fetched"
+                            % (perPage, len(pages[page]), page)
+                        )
+                        last_page = page
+
+                if (last_page is not None):
+                    for future, page in list(pending.items()):
+                        if (page > last_page):
+                            future.cancel()
+                            del pending[future]
+
+                    continue
+
+                while (len(pending) < self.max_concurrent_pages):
+                    future = executor.submit(fetch, next_page)
+                    pending[future] = next_page
+                    next_page += 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        self.saveHistoryPageIndex(
+            before, perPage,
+            [keys.get(page) for page in range(1, last_page + 1)])
+
+        return [pages[page] for page in range(1, last_page + 1)]
+
+    def getCachedHistoryPages(self, before: int, perPage: int) -> dict:
+        """
+        Read the athlete's cached pages of history in a single round trip to
+        the cache. The pages' cache keys are in an index, saved by the last
+        fetch of the history (see saveHistoryPageIndex())
+
+        :param: before  the history boundary, in epoch seconds
+        :param: perPage the number of activities per page
+
+        return: dict of page number to cached response, for those pages that
+                are still cached
+        """
+        index = self.getPageIndex().get(
+            self.getHistoryPageIndexKey(before, perPage))
+
+        if (index is None):
+            return {}
+
+        keys = json.loads(index)
+
+        with Metrics.span('strava'):
+            responses = self.oauth.getCachedResponses(keys)
 
-                done = True
+        Metrics.increment(
+            'strava_requests_total', len(responses), cache='batch')
 
-        return out
+        return {
+            page: responses[key]
+            for (page, key) in enumerate(keys, 1) if key in responses
+        }
 
-    def getActivitiesPage(self, page: int, perPage: int) -> dict:
+    def saveHistoryPageIndex(self, before: int, perPage: int,
+                             keys: list) -> None:
+        """
+        Save the cache keys of the athlete's pages of history, so they can
+        be read all at once next time (see getCachedHistoryPages())
+
+        :param: before  the history boundary, in epoch seconds
+        :param: perPage the number of activities per page
+        :param: keys    the cache key of each page, in page order. If a page
+                        wasn't cached, nothing is saved
+        """
+        if (None in keys):
+            return
+
+        self.getPageIndex().set(
+            self.getHistoryPageIndexKey(before, perPage),
+            json.dumps(keys),
+            self.history_ttl
+        )
+
+    def getPageIndex(self) -> CacheStorage:
+        return SessionPool.getStorage(self.oauth.cache, 'pages')
+
+    def getHistoryPageIndexKey(self, before: int, perPage: int) -> str:
+        return 'athlete:%s:history:%d:%d' % (
+            self.getVerifiedAthleteId(), before, perPage)
+
+    def getActivitiesPagesAfter(self, after: int, perPage: int,
+                                cache: bool = False) -> list:
+        """
+        Fetch every page of strava activities that started after the given
+        time. This is expected to be a handful of recent activities, so pages
+        are fetched one at a time
+
+        :param: after   the time to fetch activities after, in epoch seconds
+        :param: perPage the number of activities per page to fetch
+        :param: cache   cache the pages. Pages after the sync cursor aren't
+                        cached, as the cursor moves with every new activity
+
+        return: list of pages, in page order
+        """
+        pages = []
+        page = 1
+
+        while (True):
+            pages.append(self.getActivitiesPage(
+                page, perPage, after=after,
+                expire_after=None if cache else DO_NOT_CACHE))
+
+            if (len(pages[-1]) < perPage):
+                return pages
+
+            page += 1
+
+    def getActivitiesPage(
+            self, page: int, perPage: int, after: int = None,
+            before: int = None, expire_after=None) -> dict:
+        """
+        Fetch a specific page of strava activities. See
+        getActivitiesPageResponse() for the arguments
+
+        return: dict
+        """
+        return json.loads(self.getActivitiesPageResponse(
+            page, perPage, after, before, expire_after).content)
+
+    def getActivitiesPageResponse(
+            self, page: int, perPage: int, after: int = None,
+            before: int = None, expire_after=None):
         """
         Fetch a specific page of strava activities
 
         :param: page the page number to fetch
         :param: perPage the number of activities per page to fetch
+        :param: after only fetch activities that started after this time, in
+                epoch seconds. These are recent activities, so are
+                prioritised over fetching history (see RateLimiter), and are
+                revalidated when forcing a refresh
+        :param: before only fetch activities that started before this time,
+                in epoch seconds. These pages are history, which is never
+                re-fetched when forcing a refresh
+        :param: expire_after override the cache expiry for this request
 
-        return: dict
+        return: Requests response
         """
         start_time = time.perf_counter()
 
-        base_url = 'https://www.strava.com/api/v3/athlete/activities'
-        url = '%s?page=%d&per_page=%d' % (base_url, page, perPage)
+        # so the page is cached for the athlete, rather than the token
+        self.getVerifiedAthleteId()
+
+        url = '%s/api/v3/athlete/activities?page=%d&per_page=%d' % (
+            self.base_url, page, perPage)
 
-        res = self.get(url)
+        if (after is not None):
+            url = '%s&after=%d' % (url, after)
+
+        if (before is not None):
+            url = '%s&before=%d' % (url, before)
+            res = self.get(url, expire_after=expire_after,
+                           priority=RateLimiter.BACKGROUND)
+        else:
+            res = self.get(url, expire_after=expire_after, refresh=self.force)
 
         if (res.status_code != 200):
             raise AuthenticationException("invalid auth token")
@@ -323,12 +657,44 @@ class Strava:
         except AttributeError:
             self.log.debug("read %s from network" % url)
 
-        return json.loads(res.content)
+        if (self.on_page is not None):
+            self.on_page(page)
 
-    def get(self, url: str):
+        return res
+
+    def getVerifiedAthleteId(self) -> int:
+        """
+        Ask strava which athlete the token is for, once per instance. The
+        athlete in the token comes from the browser, so only this one is
+        trusted to key the athlete's activity store, results and sync on,
+        and to scope the requests cache to (see
+        OAuth2CachedSession.cache_scope). The answer is cached for the token
+
+        return: int
+        """
+        if (self.verified_athlete_id is None):
+            res = self.get(self.base_url + '/api/v3/athlete')
+
+            if (res.status_code != 200):
+                raise AuthenticationException("invalid auth token")
+
+            self.verified_athlete_id = json.loads(res.content)['id']
+            self.oauth.cache_scope = 'athlete:%s' % self.verified_athlete_id
+
+        return self.verified_athlete_id
+
+    def get(self, url: str, expire_after=None,
+            priority: int = RateLimiter.INTERACTIVE, refresh: bool = False):
         """
         Fetch strava data from the given url, with oauth credentials. This
-        handles expired tokens and cache clearing as required
+        handles expired tokens as required. Requests that aren't answered
+        from the cache wait for rate limit budget (see RateLimiter)
+
+        :param: url the url to fetch
+        :param: expire_after override the cache expiry for this request
+        :param: priority RateLimiter.INTERACTIVE or RateLimiter.BACKGROUND
+        :param: refresh check with strava that a cached response is still
+                current (with a conditional request)
 
         return: Requests response
         """
@@ -337,22 +703,95 @@ class Strava:
         self.log.debug("fetching %s" % url)
 
         try:
-            res = self.oauth.get(url=url)
+            with Metrics.span('strava'):
+                res = self._send(url, expire_after, priority, refresh)
         except TokenUpdated as e:
             self.log.debug("need to update token...")
             self.token_storage.set(e.token)
-            return self.get(url=url)
+            return self.get(url=url, expire_after=expire_after,
+                            priority=priority, refresh=refresh)
 
-        if (res.from_cache and self.force):
-            self.log.debug("clearing cache to prompt re-fetch for %s"
-                           % res.request)
-            self.oauth.clear(res.request)
-            return self.get(url=url)
+        if (getattr(res, 'revalidated', False)):
+            cache = 'revalidated'
+        elif (getattr(res, 'from_cache', False)):
+            cache = 'hit'
+        else:
+            cache = 'miss'
+
+        Metrics.increment('strava_requests_total', cache=cache)
 
         return res
 
+    def _send(self, url: str, expire_after, priority: int, refresh: bool):
+        """
+        Make a request, from the requests cache if possible. Only requests
+        that go to strava (including conditional requests) count against the
+        rate limit, and identical requests that are made at the same time are
+        only sent once (see SingleFlight)
+        """
+        if (expire_after is DO_NOT_CACHE):
+            return self.rate_limiter.request(
+                lambda: self.oauth.get(url=url, expire_after=expire_after),
+                priority
+            )
+
+        if (refresh):
+            return self.single_flight.do(
+                self.getFlightKey(url, refresh),
+                lambda: self.rate_limiter.request(
+                    lambda: self.oauth.revalidate(
+                        url=url, expire_after=expire_after),
+                    priority
+                )
+            )
+
+        res = self.oauth.get(
+            url=url, expire_after=expire_after, only_if_cached=True)
+
+        # requests_cache's response when there's no fresh cached copy
+        if (res.status_code != 504):
+            return res
+
+        def fetch():
+            # another worker may have fetched it while this one waited
+            res = self.oauth.get(
+                url=url, expire_after=expire_after, only_if_cached=True)
+
+            if (res.status_code != 504):
+                return res
+
+            # an expired response is revalidated, if it has an ETag
+            return self.rate_limiter.request(
+                lambda: self.oauth.get(url=url, expire_after=expire_after),
+                priority
+            )
+
+        return self.single_flight.do(self.getFlightKey(url, refresh), fetch)
+
+    def getFlightKey(self, url: str, refresh: bool) -> str:
+        """
+        Get the single flight key for a request. Like the requests cache key,
+        this includes the access token, so athletes never share responses
+
+        return: string
+        """
+        digest = hashlib.sha256(
+            ('%s %s' % (self.oauth.access_token, url)).encode('utf-8'))
+
+        return 'fetch:%d:%s' % (refresh, digest.hexdigest()[:32])
+
 
 class StravaDemo(Strava):
+    """
+    Strava, but with a fixed set of demo activities. The demo data is parsed
+    once per process (see loadDataset())
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'data', 'demo.json')
+
+    _lock = threading.Lock()
+    _activities = None
+
     def __init__(self, debug: bool = False):
         self.log = logging.getLogger('strava')
 
@@ -364,56 +803,52 @@ class StravaDemo(Strava):
         self.max_page_size = self.config.get('max_page_size', 100)
         self.log.debug("Config loaded: %s" % self.config.dump())
 
-    def getActivities(self, num: int, offset: int = 0) -> ActivityList:
-        out = ActivityList()
-
-        activities = self.getActivitiesPage(0, 0)
-
-        for activity in activities:
-            try:
-                out.append(Activity.newFromDict(activity))
-            except ValueError as e:
-                self.log.warning("Activity missing required field: %s" % e)
+    def loadDataset() -> ActivityList:
+        """
+        Load the demo activities, sorted newest first. These are parsed on the
+        first call only, at which point the aggregations for all activities
+        and for each sport are computed too, so they can be shared by every
+        request
 
-        out = out.sortByDate(True)
+        return: ActivityList. This is shared, and must not be modified
+        """
+        with StravaDemo._lock:
+            if (StravaDemo._activities is None):
+                out = ActivityList()
 
-        if (len(out) > num):
-            return ActivityList.slice(out, 0, num)
+                with Metrics.span('parse'), open(StravaDemo.path) as demofile:
+                    for activity in json.load(demofile):
+                        out.append(Activity.newFromDict(activity))
 
-        return out
+                out = out.sortByDate(True)
 
-    def getAllActivities(self) -> ActivityList:
-        """
-        Get all activities for the user, for all time. Keep walking back
-        page-by-page until it looks like we have everything
+                calendar = Calendar.newFromConfig(Config())
 
-        return: ActivityList
-        """
-        out = ActivityList()
+                out.getAggregation(calendar=calendar)
+                for sport in out.getColumns().sports:
+                    if (sport):
+                        out.getAggregation(sport, calendar)
 
-        activities = self.getActivitiesPage(0, self.max_page_size)
+                StravaDemo._activities = out
 
-        for activity in activities:
-            try:
-                out.append(Activity.newFromDict(activity))
-            except ValueError as e:
-                self.log.warning("Activity missing required field: %s" % e)
+            return StravaDemo._activities
 
-        return out
+    def getActivities(self, num: int, offset: int = 0,
+                      query: ActivityQuery = None) -> ActivityList:
+        return ActivityList.slice(
+            StravaDemo.loadDataset(), offset, offset + num)
 
-    def getActivitiesPage(self, page: int, perPage: int) -> dict:
+    def getAllActivities(self, query: ActivityQuery = None) -> ActivityList:
         """
-        Fetch a specific page of strava activities
+        Get all demo activities. The query isn't applied, as the demo
+        activities and their aggregations are shared
 
-        :param: page the page number to fetch
-        :param: perPage the number of activities per page to fetch
-
-        return: dict
+        return: ActivityList. This is shared, and must not be modified
         """
-        with open('data/demo.json') as demofile:
-            return json.load(demofile)
+        return StravaDemo.loadDataset()
 
-    def get(self, url: str):
+    def get(self, url: str, expire_after=None,
+            priority: int = RateLimiter.INTERACTIVE, refresh: bool = False):
         pass
 
 
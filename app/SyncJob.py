@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+
+from RateLimiter import RateLimitException
+from SessionPool import SessionPool
+from Strava import AuthenticationException
+
+
+class SyncJob:
+    """
+    Syncs an athlete's activity store on a background thread, so that after
+    logging in the browser only has to poll for progress (see /sync/status)
+    rather than drive the fetching of every page itself
+
+    The job's status is kept in the cache backend, so any worker can report
+    it. A running job records its progress after every page, and a job that
+    stops making progress for stale_after seconds (e.g. its worker died, or
+    its lambda instance isn't being invoked) can be started again by another
+    worker. Pages that were fetched are in the requests cache, so a restarted
+    job picks up where the last one stopped
+    """
+    RUNNING = 'running'
+    DONE = 'done'
+    RATE_LIMITED = 'rate_limited'
+    UNAUTHORIZED = 'unauthorized'
+    FAILED = 'failed'
+
+    stale_after = 30
+
+    # seconds a job's status is kept for, once it has finished
+    status_ttl = 3600
+
+    _lock = threading.Lock()
+    _running = set()
+
+    def __init__(self, strava):
+        """
+        :param strava: Strava instance for the athlete. This is used on the
+                       job's thread, so its token storage must not depend on
+                       the request (see TokenStorage)
+        """
+        self.strava = strava
+        self.storage = SessionPool.getStorage(strava.oauth.cache, 'jobs')
+        self.key = 'sync:%s' % strava.getVerifiedAthleteId()
+        self.log = logging.getLogger('strava')
+
+        self._progress_lock = threading.Lock()
+        self.pages = 0
+
+    def start(strava) -> SyncJob:
+        """
+        Start syncing the athlete's activities, unless a sync is already
+        running for them
+
+        :param strava: Strava instance for the athlete
+
+        :return SyncJob
+        """
+        job = SyncJob(strava)
+
+        with SyncJob._lock:
+            if (job.key in SyncJob._running):
+                return job
+
+            SyncJob._running.add(job.key)
+
+        job.setStatus(SyncJob.RUNNING)
+
+        thread = threading.Thread(
+            target=job.run, name='sync-%s' % job.key, daemon=True)
+        thread.start()
+
+        return job
+
+    def run(self) -> None:
+        """
+        Sync the activity store, recording the outcome in the job's status
+        """
+        self.strava.on_page = self.addPage
+
+        try:
+            store = self.strava.getActivityStore()
+
+            self.setStatus(SyncJob.DONE, synced_at=store.synced_at)
+        except RateLimitException as e:
+            self.setStatus(SyncJob.RATE_LIMITED, retry_after=e.retry_after)
+        except AuthenticationException:
+            # strava refused the token, or failed. Either way, syncing again
+            # with the same token won't help
+            self.log.warning("sync unauthorized for %s" % self.key)
+            self.setStatus(SyncJob.UNAUTHORIZED)
+        except Exception as e:
+            self.log.exception("sync failed for %s" % self.key)
+            self.setStatus(SyncJob.FAILED, error=type(e).__name__)
+        finally:
+            with SyncJob._lock:
+                SyncJob._running.discard(self.key)
+
+    def addPage(self, page: int) -> None:
+        """
+        Record a fetched page. Called from the threads fetching pages
+
+        :param page: the page number
+        """
+        with self._progress_lock:
+            self.pages += 1
+
+            self.setStatus(SyncJob.RUNNING)
+
+    def setStatus(self, state: str, **details) -> None:
+        """
+        Save the job's status
+
+        :param state:   RUNNING, DONE, RATE_LIMITED, UNAUTHORIZED or FAILED
+        :param details: anything else to report
+        """
+        status = {
+            'state': state,
+            'pages': self.pages,
+            'updated_at': time.time(),
+        }
+        status.update(details)
+
+        self.storage.set(self.key, json.dumps(status), SyncJob.status_ttl)
+
+    def getStatus(strava) -> dict:
+        """
+        Get the status of the athlete's sync
+
+        :param strava: Strava instance for the athlete
+
+        :return dict with state (one of the states above), pages (the number
+                fetched so far) and updated_at, or None if there is no sync
+                for the athlete
+        """
+        status = SessionPool.getStorage(strava.oauth.cache, 'jobs').get(
+            'sync:%s' % strava.getVerifiedAthleteId())
+
+        return json.loads(status) if status else None
+
+    def isStale(status: dict) -> bool:
+        """
+        Determine if a sync needs to be (re)started: there is none, it is
+        running but hasn't made progress for stale_after seconds, or it was
+        rate limited and the rate limit has since reset
+
+        :param status: the sync's status (see getStatus())
+
+        :return bool
+        """
+        if (status is None):
+            return True
+
+        age = time.time() - status['updated_at']
+
+        if (status['state'] == SyncJob.RATE_LIMITED):
+            return age >= status['retry_after']
+
+        return status['state'] == SyncJob.RUNNING and age > SyncJob.stale_after
@@ -1,19 +1,27 @@
-from datetime import datetime
+from __future__ import annotations
+
+from collections import OrderedDict
+from datetime import datetime, timezone
 import logging
 import os
 import sys
+from typing import TYPE_CHECKING
 
 import bottle
 from bottle import route, run, template, request, response, redirect, \
-                   static_file
-from bottle.ext import beaker
-
-from Activity import ActivityList, AggregationPeriod
-from Chart import Chart
-from Config import Config
-from Strava import Strava, StravaDemo, Authentication, \
-         AuthenticationException, CookieTokenStorage
+                   static_file, hook
+
 from Lambda import Lambda
+from Metrics import Metrics
+
+# Everything else is imported by the routes that need it, so that a lambda
+# cold start only pays for the modules the request uses (see warmUp())
+if TYPE_CHECKING:
+    from Activity import ActivityList
+    from ActivityQuery import ActivityQuery
+    from Chart import Chart
+    from ResultCache import ResultCache
+    from Series import Series
 
 session_opts = {
     'session.type': 'memory',
@@ -24,7 +32,54 @@ session_opts = {
 if (os.environ.get('DEBUG')):
     bottle.debug(True)
 
-application = beaker.middleware.SessionMiddleware(bottle.app(), session_opts)
+
+class Application:
+    """
+    The WSGI application. Routes that use a web session are served through
+    beaker's session middleware, which is slow to import, so it is only
+    created for the first request that needs it
+    """
+    session_paths = ('/verify', '/chart')
+
+    def __init__(self, app):
+        self.app = app
+        self.session_app = None
+
+    def __call__(self, environ, start_response):
+        if (environ.get('PATH_INFO', '').startswith(self.session_paths)):
+            return self.getSessionApp()(environ, start_response)
+
+        return self.app(environ, start_response)
+
+    def getSessionApp(self):
+        if (self.session_app is None):
+            from bottle.ext import beaker
+
+            self.session_app = beaker.middleware.SessionMiddleware(
+                self.app, session_opts)
+
+        return self.session_app
+
+
+application = Application(bottle.app())
+
+
+@hook('before_request')
+def startTiming():
+    Metrics.startRequest()
+
+
+@hook('after_request')
+def endTiming():
+    """
+    Record the request duration, and report the time spent in each phase of
+    the request in the Server-Timing header. Streamed responses are timed
+    until the stream starts
+    """
+    route = request.environ.get('bottle.route')
+    duration = Metrics.endRequest(route.rule if route else 'unmatched')
+
+    response.set_header('Server-Timing', Metrics.getServerTiming(duration))
 
 
 @route('/favico/<file:re:.*\\.(ico|png|webmanifest)$>')
@@ -43,8 +98,32 @@ def marco():
     return 'polo'
 
 
+@route('/metrics')
+def metrics():
+    """
+    Request timings and cache hit rates for this process, in prometheus text
+    format
+    """
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    return Metrics.render()
+
+
 @route('/dump')
 def main():
+    """
+    Dump the logged in user's activities as json
+
+    Accepted arguments:
+        count:  Maximum number of activities to dump (default 100)
+        format: ndjson to output one activity per line, rather than a json
+                array
+
+    The output is streamed, a chunk of activities at a time
+    """
+    from RateLimiter import RateLimitException
+    from Strava import Strava, AuthenticationException, CookieTokenStorage
+
     try:
         token_store = CookieTokenStorage(bottle.request, response)
         strava = Strava(token_storage=token_store, debug=True)
@@ -58,10 +137,17 @@ def main():
     else:
         count = 100
 
-    activities = strava.getActivities(count)
+    try:
+        activities = strava.getActivities(count)
+    except RateLimitException as e:
+        return _rateLimited(e)
+
+    if (request.query.format == 'ndjson'):
+        response.set_header('Content-Type', 'application/x-ndjson')
+        return activities.iterDump(ndjson=True)
 
     response.set_header('Content-Type', 'application/json')
-    return activities.dump()
+    return activities.iterDump()
 
 
 @route('/debug')
@@ -69,6 +155,9 @@ def debug():
     if (not os.environ.get('DEBUG')):
         bottle.abort(404, "Not Found")
 
+    from Config import Config
+    from Strava import AuthenticationException, CookieTokenStorage
+
     config = Config()
     try:
         token_store = CookieTokenStorage(request, response)
@@ -93,6 +182,15 @@ def debug():
 
 @route('/verify')
 def verify():
+    """
+    Complete the oauth dance, and start syncing the athlete's activities in
+    the background (see SyncJob). The loading page polls /sync/status, and
+    moves on to the chart once the sync is done
+    """
+    from Strava import Authentication, AuthenticationException, \
+        CookieTokenStorage, Strava, TokenStorage
+    from SyncJob import SyncJob
+
     session = bottle.request.environ.get('beaker.session')
 
     token_store = CookieTokenStorage(request, response)
@@ -103,54 +201,50 @@ def verify():
         token_store=token_store
     )
 
-    if (token):
-        return template('preload', page=0)
-    else:
+    if (not token):
         response.status = 400
         return "Authentication failure"
 
-
-@route('/preload')
-def preload():
-    """
-    Load a single page of strava activity data for the loggedin user, to
-    store in the requests cache. This works in conjunction with the preload
-    template to increment the page number and request preload for the next page
-
-    Once all activities have been loaded, we redirect to /chart
-    """
-    force = bool(request.query.force)
-    token_store = CookieTokenStorage(request, response)
+    # the job outlives this request, so it can't use the cookie
+    job_token_store = TokenStorage()
+    job_token_store.set(token)
 
     try:
-        strava = Strava(
-            token_storage=token_store,
-            debug=True,
-            force=force
-        )
+        SyncJob.start(Strava(token_storage=job_token_store, debug=True))
     except AuthenticationException:
         response.status = 401
+        return "Authentication failure"
 
-        return "Not Authorized"
+    return template('preload')
 
-    page = int(request.query.get('page', 0))
 
-    # for page zero, don't do any work, flush the loading page immediately
-    if (page == 0):
-        return template('preload', page=1)
+@route('/sync/status')
+def syncStatus():
+    """
+    Report the progress of the logged in athlete's background sync, as json
+    (see SyncJob.getStatus()). If there is no sync, or it has stopped making
+    progress, one is started
+    """
+    from Strava import Strava, AuthenticationException, CookieTokenStorage, \
+        TokenStorage
+    from SyncJob import SyncJob
 
-    activities = strava.getActivitiesPage(page, strava.max_page_size)
+    try:
+        strava = Strava(token_storage=CookieTokenStorage(request, response))
+        status = SyncJob.getStatus(strava)
+    except AuthenticationException:
+        response.status = 401
 
-    # if we got fewer activies than we asked for, assume we're done
-    if (len(activities) < strava.max_page_size):
-        strava.log.debug(
-            "Asked for %d got %d. Assuming all activities are fetched"
-            % (strava.max_page_size, len(activities))
-        )
+        return {'state': SyncJob.UNAUTHORIZED}
 
-        redirect('/chart')
+    if (SyncJob.isStale(status)):
+        job_token_store = TokenStorage()
+        job_token_store.set(strava.token_storage.get())
 
-    return template('preload', page=page)
+        SyncJob.start(Strava(token_storage=job_token_store, debug=True))
+        status = SyncJob.getStatus(strava)
+
+    return status
 
 
 @route('/chart')
@@ -165,6 +259,11 @@ def chart(type: str = 'average', metric: str = 'average_watts',
         after: Only chart events with a start date after this (expected to be
                a date in format YYYY-mm-dd)
     """
+    from RateLimiter import RateLimitException
+    from ResultCache import ResultCache
+    from Strava import Strava, Authentication, AuthenticationException, \
+        CookieTokenStorage
+
     if (request.query.force):
         force = True
     else:
@@ -172,12 +271,21 @@ def chart(type: str = 'average', metric: str = 'average_watts',
 
     token_store = CookieTokenStorage(request, response)
 
+    # strava may also refuse the token when it is first used, e.g. if the
+    # athlete has revoked access
     try:
         strava = Strava(
             token_storage=token_store,
             debug=True,
             force=force
         )
+
+        results = ResultCache.newFromCache(
+            strava.oauth.cache,
+            strava.getActivityStore(),
+            ttl=strava.config.get('result_cache_ttl', strava.cache_ttl),
+            max_entries=strava.config.get('result_cache_max_entries', 100)
+        )
     except AuthenticationException:
         session = bottle.request.environ.get('beaker.session')
 
@@ -186,18 +294,31 @@ def chart(type: str = 'average', metric: str = 'average_watts',
         )
 
         redirect(url)
+    except RateLimitException as e:
+        return _rateLimited(e)
+
+    chartJSON = results.get('chart', _getChartParams(type, metric, period))
+
+    if (chartJSON is not None):
+        with Metrics.span('render'):
+            return template('chart', chartJSON=chartJSON)
+
+    # the same chart with other overlays (see _addChartOverlays()) has the
+    # same aggregation
+    data = results.get('aggregate', _getAggregateParams(type, metric, period))
+
+    if (data is not None):
+        return _renderAggregate(
+            type, metric, period, OrderedDict(data), results)
+
+    query = _getActivityQuery(metric)
 
     if (request.query.limit):
-        activities = strava.getActivities(int(request.query.limit))
+        activities = strava.getActivities(int(request.query.limit), 0, query)
     else:
-        activities = strava.getAllActivities()
-
-    if (request.query.sport):
-        activities = ActivityList.filter(
-            activities, lambda a: a.sport == request.query.sport
-        )
+        activities = strava.getAllActivities(query)
 
-    return _renderChart(type, metric, period, activities)
+    return _renderChart(type, metric, period, activities, results)
 
 
 @route('/demo')
@@ -211,7 +332,12 @@ def demo(type: str = 'average', metric: str = 'average_watts',
         limit: Maximum number of activities to chart
         after: Only chart events with a start date after this (expected to be
                a date in format YYYY-mm-dd)
+
+    Without limit or after, the chart is a lookup of aggregations precomputed
+    at startup
     """
+    from Strava import StravaDemo
+
     strava = StravaDemo()
 
     if (request.query.limit):
@@ -219,51 +345,221 @@ def demo(type: str = 'average', metric: str = 'average_watts',
     else:
         activities = strava.getAllActivities()
 
-    if (request.query.sport):
-        activities = ActivityList.filter(
-            activities, lambda a: a.sport == request.query.sport
-        )
-
     return _renderChart(type, metric, period, activities)
 
 
-def _renderChart(type: str, metric: str, period: str,
-                 activities: ActivityList):
-    log = logging.getLogger('strava')
-    chart = Chart()
+def _getAggregateParams(type: str, metric: str, period: str) -> dict:
+    """
+    Get everything, other than the activities themselves, that determines the
+    aggregation charted for the current request
+    """
+    from Calendar import Calendar
+    from Config import Config
+
+    return {
+        'type': type,
+        'metric': metric,
+        'period': period,
+        'calendar': Calendar.newFromConfig(Config()).key,
+        'sport': request.query.sport,
+        'after': request.query.after,
+        'limit': request.query.limit,
+    }
+
+
+def _getChartParams(type: str, metric: str, period: str) -> dict:
+    """
+    Get everything, other than the activities themselves, that determines the
+    chart for the current request
+    """
+    params = _getAggregateParams(type, metric, period)
+    params.update({
+        'rolling': request.query.rolling,
+        'trend': request.query.trend,
+        'fitness': request.query.fitness,
+    })
 
-    chart_title = "%s by %s" % (metric.replace("_", " ").title(), period)
-    chart.options.title.text = chart_title
+    return params
 
-    chart.labels.labels = []
-    chart.data.Metric.data = []
 
+def _getActivityQuery(metric: str) -> ActivityQuery:
+    """
+    Get the activities that the current chart request uses, as selected by
+    _renderChart(), so that the others don't have to be built
+    """
+    from ActivityQuery import ActivityQuery
+
+    after = None
     if (request.query.after):
         try:
-            after_date = datetime.fromisoformat(request.query.after)
-            activities = ActivityList.trimBeforeDate(activities, after_date)
+            after = datetime.fromisoformat(request.query.after)
         except ValueError:
             pass
 
-    if (type == 'total'):
-        data = activities.aggregateTotalMetricByPeriod(
-                    metric=metric,
-                    period=AggregationPeriod.strToEnum(period))
-    else:
-        data = activities.aggregateAverageMetricByPeriod(
+    if (after is not None and after.tzinfo is None):
+        after = after.replace(tzinfo=timezone.utc)
+
+    return ActivityQuery(
+        sports={request.query.sport} if request.query.sport else None,
+        after=after.timestamp() if after else None,
+        limit=int(request.query.limit) if request.query.limit else None,
+        metric=metric,
+    )
+
+
+def _rateLimited(e):
+    """
+    Respond to a request that couldn't be served because strava's rate limit
+    has been reached
+    """
+    response.status = 503
+    response.set_header('Retry-After', str(e.retry_after))
+
+    return ("Strava's rate limit has been reached, please try again in %d "
+            "minutes" % max(1, round(e.retry_after / 60)))
+
+
+def _renderChart(type: str, metric: str, period: str,
+                 activities: ActivityList, results: ResultCache = None):
+    from Activity import ActivityList, AggregationPeriod
+    from Calendar import Calendar
+    from Config import Config
+
+    log = logging.getLogger('strava')
+    calendar = Calendar.newFromConfig(Config())
+
+    with Metrics.span('aggregate'):
+        if (request.query.after):
+            try:
+                after_date = datetime.fromisoformat(request.query.after)
+                activities = ActivityList.trimBeforeDate(
+                    activities, after_date)
+            except ValueError:
+                pass
+
+        data = activities.getAggregation(
+                    request.query.sport or None, calendar).get(
+                    type=type,
                     metric=metric,
                     period=AggregationPeriod.strToEnum(period))
 
     log.debug("chart data: %s" % data)
 
-    for label in data:
-        chart.labels.labels.append(label)
-        chart.data.Metric.data.append("%0.2f" % data[label])
+    if (results):
+        results.set('aggregate', _getAggregateParams(type, metric, period),
+                    list(data.items()))
+
+    return _renderAggregate(type, metric, period, data, results)
+
+
+def _renderAggregate(type: str, metric: str, period: str, data: OrderedDict,
+                     results: ResultCache = None):
+    """
+    Render the chart of an aggregation, computed by _renderChart() or read
+    from the result cache
+    """
+    from Activity import AggregationPeriod
+    from Calendar import Calendar
+    from Chart import Chart
+    from Config import Config
+    from Series import Series
+
+    chart = Chart(
+        "%s by %s" % (metric.replace("_", " ").title(), period))
+    calendar = Calendar.newFromConfig(Config())
+    aggregation_period = AggregationPeriod.strToEnum(period)
 
-    chartJSON = chart.get()
+    with Metrics.span('chart'):
+        if (request.query.rolling or request.query.trend
+                or request.query.fitness):
+            series = Series.newFromAggregation(
+                data, aggregation_period, calendar)
+            chart.setSeries(series)
+            _addChartOverlays(chart, series, type)
+        else:
+            chart.setData(data)
 
-    return template('chart', chartJSON=chartJSON)
+        chartJSON = chart.get()
 
+    if (results):
+        results.set('chart', _getChartParams(type, metric, period), chartJSON)
+
+    with Metrics.span('render'):
+        return template('chart', chartJSON=chartJSON)
+
+
+def _addChartOverlays(chart: Chart, series: Series, type: str) -> None:
+    """
+    Add the datasets derived from the charted series that the current
+    request asks for:
+        rolling: comma separated windows, in periods (e.g. 7,28), for rolling
+                 sums on total and count charts, or rolling averages on the
+                 others
+        trend:   a least squares trend line. trend=1 fits one line to the
+                 whole chart, trend=n (n > 1) fits the last n periods at each
+                 period
+        fitness: fitness and fatigue curves, i.e. exponentially weighted
+                 averages over 42 and 7 days, in periods of the chart (gaps
+                 count as zero, so this is meant for totals)
+    """
+    windows = [
+        int(window) for window in request.query.rolling.split(',')
+        if window.strip().isdigit() and int(window) > 0
+    ]
+
+    # each window is another dataset, so don't let one request ask for many
+    for window in windows[:4]:
+        if (type in ('total', 'count')):
+            chart.addOverlay('%d period sum' % window,
+                             series.rollingSum(window))
+        else:
+            chart.addOverlay('%d period average' % window,
+                             series.rollingMean(window))
+
+    if (request.query.trend):
+        window = request.query.trend
+        if (window.isdigit() and int(window) > 1):
+            chart.addOverlay('%s period trend' % window,
+                             series.trend(int(window)))
+        else:
+            chart.addOverlay('Trend', series.trend(), borderDash=[6, 4])
+
+    if (request.query.fitness):
+        (fitness, fatigue) = series.getFitness()
+
+        chart.addOverlay('Fitness', fitness)
+        chart.addOverlay('Fatigue', fatigue)
+
+
+def warmUp(connect: bool = True) -> None:
+    """
+    Do the work that would otherwise fall on the first requests: import the
+    modules the routes use, parse the demo data and precompute its
+    aggregations
+
+    :param connect: also open the connection to the cache backend
+    """
+    from bottle.ext import beaker  # noqa: F401
+    import Chart  # noqa: F401
+    import ResultCache  # noqa: F401
+    from Config import Config
+    from SessionPool import SessionPool
+    from Strava import StravaDemo
+
+    application.getSessionApp()
+    StravaDemo.loadDataset()
+
+    if (connect):
+        SessionPool.connect(Config())
+
+
+# when serving (the dev server, or gunicorn in each worker, or once in the
+# master with --preload), warm up as the application is loaded, so that the
+# demo data is already parsed and aggregated for the first /demo request.
+# Not on lambda, where cold starts must stay cheap, and the scheduled warm
+# up event does this instead
+if ('dev' in sys.argv or 'gunicorn' in sys.modules):
+    warmUp(connect=False)
 
 if ('dev' in sys.argv):
     run(
@@ -275,6 +571,7 @@ if ('dev' in sys.argv):
         certfile='cert.crt',
         keyfile='private.key',
         server='gunicorn',
+        threads=4,
         timeout=120
     )
 
@@ -285,7 +582,15 @@ def lambda_handler(event, context):
 
     This (application.lambda_handler) is expected to be defined as the
     entrypoint for the container when running on lambda
+
+    Warm-up events (see Lambda.isWarmUpEvent()) don't run a route, they just
+    prepare this instance for the requests to come
     """
+    if (Lambda.isWarmUpEvent(event)):
+        warmUp()
+
+        return {"statusCode": 200, "body": "warm"}
+
     lambdaRequest = Lambda(event)
     lambdaRequest.handleRequest(application)
 
@@ -114,7 +114,7 @@
       />
       <div class="text-content">
         <h1 id="loadingText">Loading...</h1>
-        <h2>Downloading your workouts from strava</h2>
+        <h2 id="detailText">Downloading your workouts from strava</h2>
       </div>
     </main>
     <footer>
@@ -128,12 +128,36 @@
     </footer>
 
     <script>
-        const urlParams = new URLSearchParams(window.location.search);
-        let page = urlParams.get('page') ? parseInt(urlParams.get('page')) : 0;
-    
-        document.getElementById('loadingText').textContent += ".".repeat(page);
-    
-        window.location.replace("/preload?page=" + (page + 1));
+        const loadingText = document.getElementById('loadingText');
+        const detailText = document.getElementById('detailText');
+
+        // the sync runs on the server, this only waits for it to finish
+        function poll() {
+            fetch('/sync/status', {credentials: 'same-origin'})
+                .then((res) => res.json())
+                .then((status) => {
+                    if (status.state == 'running') {
+                        loadingText.textContent = 'Loading' +
+                            '.'.repeat(status.pages + 1);
+                        setTimeout(poll, 500);
+                    } else if (status.state == 'rate_limited') {
+                        loadingText.textContent = 'Strava is busy, ' +
+                            'retrying in ' + status.retry_after + 's';
+                        setTimeout(poll, status.retry_after * 1000);
+                    } else if (status.state == 'unauthorized') {
+                        // polling again won't help, so leave it to the
+                        // athlete to log in again
+                        loadingText.textContent = 'Strava refused your login';
+                        detailText.innerHTML =
+                            '<a href="/chart">Log in again</a>';
+                    } else {
+                        window.location.replace('/chart');
+                    }
+                })
+                .catch(() => setTimeout(poll, 2000));
+        }
+
+        poll();
     </script>
   </body>
 </html>
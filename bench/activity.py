@@ -0,0 +1,69 @@
+"""
+Benchmark the per-request activity handling for /chart on the demo data:
+building Activity objects, sorting, date trimming and aggregating, plus the
+memory used per Activity
+
+Usage: python3 bench/activity.py [iterations]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from Activity import Activity, ActivityList, AggregationPeriod  # noqa: E402
+
+
+def loadDemo() -> list:
+    with open(os.path.join(APP_DIR, 'data', 'demo.json')) as demofile:
+        return json.load(demofile)
+
+
+def buildList(pages: list) -> ActivityList:
+    return ActivityList(Activity.newFromDict(d) for d in pages)
+
+
+def chartRequest(pages: list) -> None:
+    """
+    The activity work done by a single /chart?after=... request
+    """
+    activities = buildList(pages).sortByDate(True)
+    activities.getMinDate()
+    activities.getMaxDate()
+    activities = ActivityList.trimBeforeDate(activities, datetime(2021, 1, 1))
+    activities.aggregateAverageMetricByPeriod(
+        'average_watts', AggregationPeriod.WEEK)
+
+
+def timeCpu(fn, iterations: int) -> float:
+    start = time.process_time()
+    for i in range(iterations):
+        fn()
+
+    return (time.process_time() - start) / iterations
+
+
+def bytesPerActivity(pages: list) -> float:
+    tracemalloc.start()
+    activities = buildList(pages)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return current / len(activities)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    pages = loadDemo()
+
+    print("activities:             %d" % len(pages))
+    print("newFromDict (ms):       %0.3f"
+          % (timeCpu(lambda: buildList(pages), iterations) * 1000))
+    print("chart request CPU (ms): %0.3f"
+          % (timeCpu(lambda: chartRequest(pages), iterations) * 1000))
+    print("bytes per activity:     %0.1f" % bytesPerActivity(pages))
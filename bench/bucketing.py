@@ -0,0 +1,105 @@
+"""
+Benchmark bucketing start dates into aggregation periods: Calendar, which
+works on a whole array of epoch seconds at once, against formatting each
+date with strftime/strptime, as aggregation used to. The labels of both are
+compared, so this doubles as a check that weeks starting on sunday keep
+their labels
+
+Usage: python3 bench/bucketing.py [count ...]
+"""
+import os
+import sys
+import time
+
+from datetime import datetime, timezone
+
+import numpy
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from Calendar import AggregationPeriod, Calendar  # noqa: E402
+
+# dates are spread over this many years before END
+YEARS = 30
+END = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def getTimeKey(date: datetime, period: AggregationPeriod) -> str:
+    """
+    The time key for a date, the way it was determined per activity
+    """
+    if period == AggregationPeriod.WEEK:
+        week = datetime.strftime(date, "%Y-%U-1")
+        return datetime.strptime(week, "%Y-%U-%w").strftime("%Y-%m-%d")
+
+    if period == AggregationPeriod.MONTH:
+        return datetime.strftime(date, "%Y-%m-01")
+
+    if period == AggregationPeriod.YEAR:
+        return datetime.strftime(date, "%Y")
+
+    return datetime.strftime(date, "%Y-%m-%d")
+
+
+def bucketStrings(epoch: numpy.ndarray, period: AggregationPeriod) -> list:
+    return [
+        getTimeKey(datetime.fromtimestamp(seconds, timezone.utc), period)
+        for seconds in epoch.tolist()
+    ]
+
+
+def bucketCalendar(calendar: Calendar, epoch: numpy.ndarray,
+                   period: AggregationPeriod) -> list:
+    (keys, inverse) = numpy.unique(
+        calendar.getPeriodCodes(epoch, period), return_inverse=True)
+    labels = numpy.array(calendar.formatPeriodCodes(keys, period))
+
+    return labels[inverse].tolist()
+
+
+def isoWeeks(epoch: numpy.ndarray) -> list:
+    out = []
+    for seconds in epoch.tolist():
+        (year, week, day) = datetime.fromtimestamp(
+            seconds, timezone.utc).isocalendar()
+        out.append('%d-W%02d' % (year, week))
+
+    return out
+
+
+def timed(fn) -> tuple:
+    start = time.perf_counter()
+    result = fn()
+
+    return (result, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    rng = numpy.random.default_rng(0)
+
+    print("%-8s %9s %12s %12s %8s" % (
+        'period', 'dates', 'strings (s)', 'calendar (s)', 'speedup'))
+
+    for count in counts:
+        epoch = numpy.sort(
+            END - rng.integers(0, YEARS * 365 * 86400, count))[::-1]
+
+        for period in AggregationPeriod:
+            (expected, strings) = timed(lambda: bucketStrings(epoch, period))
+            (labels, vectorized) = timed(
+                lambda: bucketCalendar(Calendar(), epoch, period))
+
+            if (labels != expected):
+                sys.exit("%s labels differ for %d dates" % (
+                    period.name, count))
+
+            print("%-8s %9d %12.3f %12.3f %7.1fx" % (
+                period.name.lower(), count, strings, vectorized,
+                strings / vectorized))
+
+        iso = bucketCalendar(
+            Calendar(Calendar.ISO), epoch, AggregationPeriod.WEEK)
+        if (iso != isoWeeks(epoch)):
+            sys.exit("ISO weeks differ for %d dates" % count)
@@ -0,0 +1,377 @@
+"""
+A local stand-in for the strava API, serving synthetic activities (see
+generate.py), so the application can be driven under load without touching
+strava.com. Point the application at it with strava_base_url (see
+load.py, which does this for you). As it is plain http, the application
+also needs OAUTHLIB_INSECURE_TRANSPORT=1 in its environment
+
+Implements:
+  GET  /api/v3/athlete                  the athlete
+  GET  /api/v3/athlete/activities       with page, per_page, before and after
+  GET  /oauth/authorize                 redirects straight back with a code
+  POST /oauth/token                     authorization_code and refresh_token
+  GET  /fake/stats                      counts of requests served, by path
+                                        and status (or with by=query, by
+                                        path, query string and status)
+
+API responses carry an ETag, and a request with a matching If-None-Match
+gets a 304 (which still counts against the rate limit)
+
+Every response carries strava's X-RateLimit-Limit and X-RateLimit-Usage
+headers (15 minute and daily limits), and requests over either limit get a
+429, as strava does
+
+Usage: python3 bench/fakestrava.py [--port 8900] [--activities 3000]
+                                   [--latency 50] [--rate-limit 200,2000]
+"""
+import argparse
+import hashlib
+import json
+import random
+import secrets
+import threading
+import time
+
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlencode, urlparse, parse_qs
+
+from generate import generateActivities
+
+# strava's default and maximum page sizes
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 200
+
+
+class RateLimiter:
+    """
+    Strava's rate limits: a number of requests per 15 minutes (reset on the
+    quarter hour) and per day (reset at midnight UTC)
+    """
+    def __init__(self, short_limit: int, long_limit: int):
+        self.limits = (short_limit, long_limit)
+        self.usage = [0, 0]
+        self.windows = (None, None)
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """
+        Count a request against the limits
+
+        :return bool False if the request is over either limit (in which case
+                it is not counted)
+        """
+        now = datetime.now(timezone.utc)
+        windows = (
+            (now.date(), now.hour, now.minute // 15),
+            now.date(),
+        )
+
+        with self.lock:
+            for i in (0, 1):
+                if (windows[i] != self.windows[i]):
+                    self.usage[i] = 0
+            self.windows = windows
+
+            if (self.usage[0] >= self.limits[0]
+                    or self.usage[1] >= self.limits[1]):
+                return False
+
+            self.usage[0] += 1
+            self.usage[1] += 1
+
+            return True
+
+    def getHeaders(self) -> dict:
+        with self.lock:
+            return {
+                'X-RateLimit-Limit': '%d,%d' % self.limits,
+                'X-RateLimit-Usage': '%d,%d' % tuple(self.usage),
+            }
+
+
+class FakeStrava(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, activities: list, latency: float = 0,
+                 jitter: float = 0, rate_limiter: RateLimiter = None,
+                 athlete_id: int = 1):
+        """
+        :param address:      (host, port) to listen on
+        :param activities:   the activities to serve, newest first
+        :param latency:      seconds to wait before each response
+        :param jitter:       up to this many seconds are randomly added to
+                             the latency
+        :param rate_limiter: the rate limits to apply, if any
+        :param athlete_id:   the id of the athlete tokens are issued for
+        """
+        super().__init__(address, FakeStravaHandler)
+        self.activities = activities
+        self.oldest_first = list(reversed(activities))
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limiter = rate_limiter
+        self.athlete_id = athlete_id
+        # access tokens that get a 401, as if the athlete had revoked access
+        self.revoked = set()
+        self.stats = {}
+        self.query_stats = {}
+        self.stats_lock = threading.Lock()
+
+    def count(self, path: str, query: str, status: int) -> None:
+        key = '%s %d' % (path, status)
+        query_key = '%s?%s %d' % (path, query, status)
+
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+            self.query_stats[query_key] = (
+                self.query_stats.get(query_key, 0) + 1)
+
+    def getActivities(self, page: int, per_page: int, before: int = None,
+                      after: int = None) -> list:
+        """
+        Get a page of activities. Like strava, activities are newest first,
+        unless after is given, in which case they are oldest first
+        """
+        if (after is not None):
+            activities = [
+                activity for activity in self.oldest_first
+                if FakeStrava.getTimestamp(activity) > after
+            ]
+        else:
+            activities = self.activities
+
+        if (before is not None):
+            activities = [
+                activity for activity in activities
+                if FakeStrava.getTimestamp(activity) < before
+            ]
+
+        return activities[(page - 1) * per_page:page * per_page]
+
+    def getTimestamp(activity: dict) -> int:
+        if ('_timestamp' not in activity):
+            activity['_timestamp'] = int(datetime.strptime(
+                activity['start_date'], '%Y-%m-%dT%H:%M:%SZ'
+            ).replace(tzinfo=timezone.utc).timestamp())
+
+        return activity['_timestamp']
+
+    def newToken(self) -> dict:
+        return {
+            'token_type': 'Bearer',
+            'access_token': secrets.token_hex(20),
+            'refresh_token': secrets.token_hex(20),
+            'expires_at': int(time.time()) + 21600,
+            'expires_in': 21600,
+        }
+
+
+class FakeStravaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method: str):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if (method == 'POST'):
+            length = int(self.headers.get('Content-Length', 0))
+            body = parse_qs(self.rfile.read(length).decode('utf-8'))
+            query.update({key: values[0] for key, values in body.items()})
+
+        if (url.path == '/fake/stats'):
+            # respond() counts the request, so the lock is released first
+            with self.server.stats_lock:
+                if (query.get('by') == 'query'):
+                    stats = dict(self.server.query_stats)
+                else:
+                    stats = dict(self.server.stats)
+
+            return self.respond(200, stats, url.path)
+
+        latency = self.server.latency
+        if (self.server.jitter):
+            latency += random.uniform(0, self.server.jitter)
+        if (latency):
+            time.sleep(latency)
+
+        limiter = self.server.rate_limiter
+        if (limiter and not limiter.acquire()):
+            return self.respond(429, {
+                'message': 'Rate Limit Exceeded',
+                'errors': [{
+                    'resource': 'Application',
+                    'field': 'rate limit',
+                    'code': 'exceeded',
+                }],
+            }, url.path)
+
+        routes = {
+            ('GET', '/api/v3/athlete'): self.athlete,
+            ('GET', '/api/v3/athlete/activities'): self.activities,
+            ('GET', '/oauth/authorize'): self.authorize,
+            ('POST', '/oauth/token'): self.token,
+        }
+
+        if ((method, url.path) not in routes):
+            return self.respond(404, {'message': 'Record Not Found'}, url.path)
+
+        routes[(method, url.path)](url.path, query)
+
+    def athlete(self, path: str, query: dict):
+        if (self.isAuthorized(path)):
+            self.respond(200, {'id': self.server.athlete_id}, path)
+
+    def activities(self, path: str, query: dict):
+        if (not self.isAuthorized(path)):
+            return
+
+        try:
+            page = int(query.get('page', 1))
+            per_page = min(
+                int(query.get('per_page', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            before = int(query['before']) if 'before' in query else None
+            after = int(query['after']) if 'after' in query else None
+        except ValueError:
+            return self.respond(400, {'message': 'Bad Request'}, path)
+
+        activities = self.server.getActivities(page, per_page, before, after)
+
+        self.respond(200, [
+            {key: value for key, value in activity.items() if key[0] != '_'}
+            for activity in activities
+        ], path)
+
+    def authorize(self, path: str, query: dict):
+        location = '%s?%s' % (query.get('redirect_uri', '/'), urlencode({
+            'state': query.get('state', ''),
+            'code': secrets.token_hex(20),
+            'scope': query.get('scope', 'read'),
+        }))
+
+        self.respond(302, {}, path, {'Location': location})
+
+    def token(self, path: str, query: dict):
+        grant_type = query.get('grant_type')
+
+        if (grant_type == 'refresh_token' and query.get('refresh_token')):
+            self.respond(200, self.server.newToken(), path)
+        elif (grant_type == 'authorization_code' and query.get('code')):
+            token = self.server.newToken()
+            token['athlete'] = {'id': self.server.athlete_id}
+            self.respond(200, token, path)
+        else:
+            self.respond(400, {'message': 'Bad Request'}, path)
+
+    def isAuthorized(self, path: str) -> bool:
+        authorization = self.headers.get('Authorization', '')
+
+        if (authorization.startswith('Bearer ')
+                and authorization[len('Bearer '):] not in self.server.revoked):
+            return True
+
+        self.respond(401, {'message': 'Authorization Error'}, path)
+
+        return False
+
+    def respond(self, status: int, body, path: str, headers: dict = None):
+        data = json.dumps(body).encode('utf-8')
+        headers = dict(headers or {})
+
+        if (status == 200 and path.startswith('/api/')):
+            headers['ETag'] = 'W/"%s"' % hashlib.sha1(data).hexdigest()
+
+            if (self.headers.get('If-None-Match') == headers['ETag']):
+                status = 304
+                data = b''
+
+        # counted before the response is sent, so that a client that has its
+        # response can rely on it being counted
+        self.server.count(path, urlparse(self.path).query, status)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+
+        if (self.server.rate_limiter):
+            for name, value in self.server.rate_limiter.getHeaders().items():
+                self.send_header(name, value)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(port: int = 0, activities: int = 3000, latency: float = 0,
+          jitter: float = 0, rate_limit: tuple = None,
+          seed: int = 0) -> FakeStrava:
+    """
+    Start a fake strava server on a background thread
+
+    :param port:       the port to listen on, or 0 for any free port
+    :param activities: the number of synthetic activities to serve
+    :param latency:    seconds to wait before each response
+    :param jitter:     up to this many seconds are randomly added to latency
+    :param rate_limit: (15 minute limit, daily limit), or None for no limits
+    :param seed:       seed for the activity generator
+
+    :return FakeStrava the running server. Its base URL is
+            http://127.0.0.1:<server.server_port>
+    """
+    server = FakeStrava(
+        ('127.0.0.1', port),
+        generateActivities(activities, seed),
+        latency=latency,
+        jitter=jitter,
+        rate_limiter=RateLimiter(*rate_limit) if rate_limit else None,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--activities', type=int, default=3000,
+                        help='number of activities to serve')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the activity generator')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='ms to wait before each response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='up to this many ms are added to the latency')
+    parser.add_argument('--rate-limit',
+                        help='15 minute and daily request limits, e.g. '
+                             '200,2000 (the default is no limit)')
+    args = parser.parse_args()
+
+    server = serve(
+        port=args.port,
+        activities=args.activities,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        rate_limit=tuple(map(int, args.rate_limit.split(',')))
+        if args.rate_limit else None,
+        seed=args.seed,
+    )
+
+    print("fake strava with %d activities on http://127.0.0.1:%d"
+          % (args.activities, server.server_port))
+
+    try:
+        while (True):
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,130 @@
+"""
+Generate realistic synthetic strava activities, in the format returned by
+the strava /athlete/activities API. The sports are mixed, and like real data
+some fields are missing or null: runs and walks have no power, not every ride
+has a power meter, and strength sessions have no distance or speed. The
+output only depends on the count and seed, so runs are repeatable
+
+Usage: python3 bench/generate.py count [seed] > activities.json
+"""
+import json
+import random
+import sys
+import time
+
+from datetime import datetime, timezone
+
+# (type, weight, (min, max) speed in m/s, (min, max) moving time in s,
+#  probability of a power meter)
+SPORTS = (
+    ('Ride', 50, (5.0, 11.0), (1200, 14400), 0.7),
+    ('Run', 25, (2.2, 4.5), (900, 7200), 0.1),
+    ('Walk', 15, (1.0, 1.8), (600, 5400), 0.0),
+    ('Swim', 5, (0.5, 1.2), (900, 3600), 0.0),
+    ('WeightTraining', 5, None, (1200, 4800), 0.0),
+)
+
+# the end of the generated history. Activities go back from here
+END = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+# at most this many years of history is generated, so large counts have
+# several activities a day
+MAX_YEARS = 20
+
+# the athlete's timezone, as seconds from UTC. Fixed, so that the random
+# sequence (and so the other fields) is the same as before it was added
+UTC_OFFSET = 3600.0
+
+
+def generateActivities(count: int, seed: int = 0) -> list:
+    """
+    Generate activities, newest first
+
+    :param count: the number of activities to generate
+    :param seed:  seed for the random generator
+
+    :return list of activity dicts
+    """
+    rng = random.Random(seed)
+    weights = [sport[1] for sport in SPORTS]
+
+    # roughly one activity a day, but no more than MAX_YEARS of history
+    span = min(count, MAX_YEARS * 365) * 86400
+    end = int(END.timestamp())
+    starts = sorted((end - rng.randrange(span) for i in range(count)),
+                    reverse=True)
+
+    out = []
+    for (i, start) in enumerate(starts):
+        (type, weight, speed, moving, power) = rng.choices(SPORTS, weights)[0]
+
+        moving_time = rng.randint(*moving)
+        activity = {
+            'id': 1000000000 + count - i,
+            'name': '%s %d' % (type, count - i),
+            'type': type,
+            'sport_type': type,
+            'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                        time.gmtime(start)),
+            'start_date_local': time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(start + UTC_OFFSET)),
+            'utc_offset': UTC_OFFSET,
+            'moving_time': moving_time,
+            'elapsed_time': moving_time + rng.randint(0, 900),
+            'kudos_count': rng.randint(0, 20),
+        }
+
+        if (speed):
+            average_speed = round(rng.uniform(*speed), 3)
+            activity['average_speed'] = average_speed
+            activity['max_speed'] = round(average_speed * 1.8, 3)
+            activity['distance'] = round(average_speed * moving_time, 1)
+            activity['total_elevation_gain'] = round(
+                activity['distance'] * rng.uniform(0, 0.02), 1)
+        else:
+            activity['distance'] = 0.0
+            activity['average_speed'] = 0.0
+            activity['total_elevation_gain'] = 0
+
+        if (rng.random() < power):
+            average_watts = round(rng.uniform(100, 300), 1)
+            activity['average_watts'] = average_watts
+            activity['device_watts'] = rng.random() < 0.8
+
+            if (activity['device_watts']):
+                activity['weighted_average_watts'] = round(
+                    average_watts * rng.uniform(1.0, 1.15))
+
+        # the odd activity has been edited, or uploaded from a device that
+        # doesn't record everything
+        if (rng.random() < 0.01):
+            activity['total_elevation_gain'] = None
+        if (rng.random() < 0.005):
+            del activity['average_speed']
+
+        out.append(activity)
+
+    return out
+
+
+def generatePages(activities: list, per_page: int = 100) -> list:
+    """
+    Split activities into pages, as strava returns them
+
+    :param activities: activities, newest first
+    :param per_page:   the number of activities per page
+
+    :return list of pages. The last page is shorter than per_page (and may be
+            empty), which is how strava marks the end
+    """
+    return [
+        activities[offset:offset + per_page]
+        for offset in range(0, len(activities) + 1, per_page)
+    ]
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    json.dump(generateActivities(count, seed), sys.stdout)
@@ -0,0 +1,355 @@
+"""
+Load test the application against a fake strava (see fakestrava.py), either
+running under gunicorn or called through lambda_handler, and report
+requests/sec and latency percentiles
+
+The application is run from a temporary copy, with a config pointing it at
+the fake strava and a sqlite cache in a temporary directory. Config can be
+overridden with --set, e.g. --set max_concurrent_pages=8
+
+Usage: python3 bench/load.py [--mode gunicorn|lambda] [--path /chart]
+                             [--concurrency 4] [--requests 200]
+                             [--activities 3000] [--latency 50]
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+import fakestrava
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+
+def installApp(path: str, strava_url: str, settings: dict) -> str:
+    """
+    Copy the application to path, with the dev config pointed at the fake
+    strava and a sqlite cache in path
+
+    :param path:       the directory to install to
+    :param strava_url: the base URL of the fake strava
+    :param settings:   config values to override
+
+    :return string the application directory
+    """
+    app_dir = os.path.join(path, 'app')
+    shutil.copytree(
+        APP_DIR, app_dir,
+        ignore=shutil.ignore_patterns('__pycache__', 'config.yaml'))
+
+    with open(os.path.join(app_dir, 'config', 'dev.yaml')) as dev:
+        config = yaml.safe_load(dev)
+
+    config.update({
+        'strava_base_url': strava_url,
+        'cache_data_dir': path,
+    })
+    config.update(settings)
+
+    with open(os.path.join(app_dir, 'config.yaml'), 'w') as out:
+        yaml.safe_dump(config, out)
+
+    return app_dir
+
+
+def getCookie(athlete_id: int, expired: bool = False) -> str:
+    """
+    Build the token cookie for an athlete
+
+    :param athlete_id: the athlete's id
+    :param expired:    make the access token expired, so that every request
+                       refreshes it
+
+    :return string the cookie header value
+    """
+    token = {
+        'token_type': 'Bearer',
+        'access_token': 'load-%d' % athlete_id,
+        'refresh_token': 'load-refresh-%d' % athlete_id,
+        'expires_at': time.time() + (-60 if expired else 21600),
+        'athlete': {'id': athlete_id},
+    }
+
+    return 'token=' + base64.urlsafe_b64encode(
+        json.dumps(token).encode('utf-8')).decode('ascii')
+
+
+def getFreePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class GunicornTarget:
+    """
+    The application running under gunicorn, requested over http
+    """
+    def __init__(self, app_dir: str, workers: int, threads: int,
+                 log: str = None):
+        self.port = getFreePort()
+        self.log = open(log, 'w') if log else subprocess.DEVNULL
+        self.process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn',
+                '--bind', '127.0.0.1:%d' % self.port,
+                '--workers', str(workers),
+                '--threads', str(threads),
+                '--timeout', '120',
+                'application:application',
+            ],
+            cwd=app_dir,
+            env=dict(os.environ, OAUTHLIB_INSECURE_TRANSPORT='1'),
+            stdout=self.log,
+            stderr=self.log,
+        )
+
+        # wait for every worker to start
+        deadline = time.time() + 30
+        while (True):
+            try:
+                if (self.request('/ping', '')[0] == 200):
+                    break
+            except OSError:
+                if (time.time() > deadline):
+                    raise
+
+            time.sleep(0.1)
+
+    def request(self, path: str, cookie: str) -> tuple:
+        """
+        :return (status, body length)
+        """
+        connection = http.client.HTTPConnection(
+            '127.0.0.1', self.port, timeout=120)
+
+        try:
+            connection.request('GET', path, headers={'Cookie': cookie})
+            res = connection.getresponse()
+
+            return (res.status, len(res.read()))
+        finally:
+            connection.close()
+
+    def close(self) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+        if (self.log is not subprocess.DEVNULL):
+            self.log.close()
+
+
+class LambdaTarget:
+    """
+    The application called through lambda_handler, in this process. This is
+    a single lambda instance, which handles one invocation at a time
+    """
+    def __init__(self, app_dir: str):
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        os.chdir(app_dir)
+        sys.path.insert(0, app_dir)
+
+        import application
+
+        self.application = application
+
+    def request(self, path: str, cookie: str) -> tuple:
+        """
+        :return (status, body length)
+        """
+        (path, _, query) = path.partition('?')
+        event = {
+            'version': '2.0',
+            'rawPath': path,
+            'rawQueryString': query,
+            'headers': {'host': 'load'},
+            'cookies': [cookie],
+            'requestContext': {'http': {'method': 'GET', 'path': path}},
+        }
+
+        res = self.application.lambda_handler(event, None)
+
+        return (res['statusCode'], len(res['body']))
+
+    def close(self) -> None:
+        pass
+
+
+def run(target, paths: list, cookies: list, requests: int,
+        concurrency: int) -> dict:
+    """
+    Make requests to the target from concurrency threads, cycling through
+    the paths and cookies
+
+    :return dict of results
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        while (True):
+            with lock:
+                i = next(counter, None)
+
+            if (i is None):
+                return
+
+            path = paths[i % len(paths)]
+            cookie = cookies[i % len(cookies)]
+
+            start = time.perf_counter()
+            # errors are counted by name, as a status. In lambda mode these
+            # include exceptions escaping the application
+            try:
+                status = target.request(path, cookie)[0]
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                status = type(e).__name__
+            latency = time.perf_counter() - start
+
+            with lock:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    return {
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+        'mean': statistics.mean(latencies),
+        'statuses': {str(status): n for status, n in statuses.items()},
+    }
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    :param values:  sorted values
+    :param percent: the percentile to get
+
+    :return float the nearest-rank percentile
+    """
+    rank = max(int(round(percent / 100 * len(values))), 1)
+
+    return values[rank - 1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--mode', choices=('gunicorn', 'lambda'),
+                        default='gunicorn')
+    parser.add_argument('--path', action='append',
+                        help='path to request, may be given more than once '
+                             '(default /chart)')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='concurrent requests (always 1 for lambda)')
+    parser.add_argument('--athletes', type=int, default=1,
+                        help='number of athletes to spread requests over')
+    parser.add_argument('--expired-token', action='store_true',
+                        help='send expired tokens, so every request '
+                             'refreshes its token')
+    parser.add_argument('--no-warm-up', action='store_true',
+                        help="don't make a request per athlete before "
+                             "measuring (so the first requests sync the "
+                             "athletes' activities)")
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='gunicorn threads per worker')
+    parser.add_argument('--activities', type=int, default=3000,
+                        help='number of activities the fake strava serves')
+    parser.add_argument('--latency', type=float, default=50,
+                        help='ms the fake strava waits before responding')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='up to this many ms are added to the latency')
+    parser.add_argument('--rate-limit',
+                        help="fake strava's 15 minute and daily limits, e.g. "
+                             "200,2000 (default no limit)")
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE', help='override app config')
+    parser.add_argument('--app-log',
+                        help="file to write gunicorn's output to")
+    parser.add_argument('--output', help='file to write results to, as JSON')
+    args = parser.parse_args()
+
+    settings = {}
+    for setting in args.set:
+        (key, _, value) = setting.partition('=')
+        settings[key] = yaml.safe_load(value)
+
+    strava = fakestrava.serve(
+        activities=args.activities,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        rate_limit=tuple(map(int, args.rate_limit.split(',')))
+        if args.rate_limit else None,
+    )
+    strava_url = 'http://127.0.0.1:%d' % strava.server_port
+
+    tmp = tempfile.TemporaryDirectory()
+    app_dir = installApp(tmp.name, strava_url, settings)
+
+    if (args.mode == 'gunicorn'):
+        target = GunicornTarget(
+            app_dir, args.workers, args.threads, args.app_log)
+    else:
+        target = LambdaTarget(app_dir)
+        args.concurrency = 1
+
+    paths = args.path or ['/chart']
+    cookies = [
+        getCookie(athlete_id, args.expired_token)
+        for athlete_id in range(1, args.athletes + 1)
+    ]
+
+    try:
+        if (not args.no_warm_up):
+            for cookie in cookies:
+                target.request(paths[0], cookie)
+
+        results = run(target, paths, cookies, args.requests, args.concurrency)
+    finally:
+        target.close()
+        strava.shutdown()
+        tmp.cleanup()
+
+    results['strava'] = dict(strava.stats)
+
+    print("%d requests in %0.2fs: %0.1f requests/sec"
+          % (results['requests'], results['seconds'], results['rps']))
+    print("latency (ms): p50 %0.1f  p90 %0.1f  p99 %0.1f  max %0.1f"
+          % tuple(results[key] * 1000 for key in ('p50', 'p90', 'p99', 'max')))
+    print("statuses: %s" % results['statuses'])
+    print("strava requests: %s" % results['strava'])
+
+    if (args.output):
+        results['args'] = vars(args)
+
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
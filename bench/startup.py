@@ -0,0 +1,136 @@
+"""
+Benchmark application startup, as paid on a lambda cold start: the import
+time of each heavy module when importing application, and the time to serve
+the first request to a few routes. Every measurement runs in a fresh python
+process, with the environment lambda sets
+
+Usage: python3 bench/startup.py [runs]
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+# modules reported on, in the order they are reported
+MODULES = (
+    'bottle',
+    'beaker.middleware',
+    'requests',
+    'requests_cache',
+    'requests_oauthlib',
+    'redis',
+    'yaml',
+    'pychartjs',
+    'numpy',
+    'Config',
+    'Activity',
+    'Chart',
+    'Strava',
+    'application',
+)
+
+SETUP = """
+import sys, time
+sys.path.insert(0, '.')
+"""
+
+FIRST_REQUEST = SETUP + """
+import io
+start = time.perf_counter()
+import application
+environ = {
+    'REQUEST_METHOD': 'GET', 'PATH_INFO': %r, 'QUERY_STRING': '',
+    'SERVER_NAME': 'bench', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http',
+    'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+}
+b''.join(application.application(environ, lambda *args: None))
+print(time.perf_counter() - start)
+"""
+
+
+# set on lambda, where importing application must not do any more work than
+# serving /ping needs
+ENVIRONMENT = {'AWS_LAMBDA_FUNCTION_NAME': 'bench'}
+
+
+def run(code: str, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args, '-c', code], cwd=run.app_dir,
+        env=dict(os.environ, **ENVIRONMENT),
+        capture_output=True, text=True, check=True
+    )
+
+
+def installApp(path: str) -> str:
+    """
+    Copy the application to path, with the dev config installed (as the
+    docker build does)
+
+    :return string the application directory
+    """
+    app_dir = os.path.join(path, 'app')
+    shutil.copytree(APP_DIR, app_dir,
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    shutil.copy(os.path.join(app_dir, 'config', 'dev.yaml'),
+                os.path.join(app_dir, 'config.yaml'))
+
+    return app_dir
+
+
+def importTimes() -> dict:
+    """
+    Import application with -X importtime
+
+    :return dict of module name to cumulative import time in ms. Modules that
+            were not imported are missing
+    """
+    out = {}
+    stderr = run(SETUP + 'import application', '-X', 'importtime').stderr
+
+    for line in stderr.splitlines():
+        if (not line.startswith('import time:')):
+            continue
+
+        (self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+        name = name.strip()
+
+        if (name in MODULES and name not in out):
+            out[name] = int(cumulative_us) / 1000
+
+    return out
+
+
+def firstRequest(path: str) -> float:
+    """
+    :return float ms to import application and serve a request to path
+    """
+    return float(run(FIRST_REQUEST % path).stdout) * 1000
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    tmp = tempfile.TemporaryDirectory()
+    run.app_dir = installApp(tmp.name)
+
+    samples = [importTimes() for i in range(runs)]
+
+    print("cumulative import time when importing application (ms, median)")
+    for module in MODULES:
+        times = [sample[module] for sample in samples if module in sample]
+
+        if (times):
+            print("  %-20s %8.1f" % (module, statistics.median(times)))
+        else:
+            print("  %-20s %8s" % (module, 'not imported'))
+
+    print("import application and serve the first request (ms, median)")
+    for path in ('/ping', '/demo'):
+        times = [firstRequest(path) for i in range(runs)]
+        print("  %-20s %8.1f" % (path, statistics.median(times)))
+
+    tmp.cleanup()
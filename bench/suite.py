@@ -0,0 +1,364 @@
+"""
+Benchmark the activity handling at a range of history sizes, using
+synthetic activities (see generate.py): building Activity objects, sorting,
+date trimming and ranges, filtering, aggregating every metric type over
+every period, the series analytics charts can overlay on a daily
+aggregation (filling gaps, rolling windows, EWMA curves and trend lines),
+dumping, encoding and decoding the activity store (as JSON and
+in the compact encoding, with the size of each, and with a query pushed
+down), and a full /chart request through the WSGI application (both when
+the chart has to be computed, and when it is already in the result cache)
+
+Results are written as JSON, by default to bench/results/<commit>.json, so
+they can be compared between commits:
+
+Usage: python3 bench/suite.py [--sizes 1000,10000] [--output file.json]
+       python3 bench/suite.py --compare before.json after.json
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+import numpy  # noqa: E402
+
+from Activity import Activity, ActivityList, AggregationPeriod  # noqa: E402
+from ActivityCodec import ActivityCodec  # noqa: E402
+from ActivityQuery import ActivityQuery  # noqa: E402
+from ActivityStore import ActivityStore  # noqa: E402
+from Config import Config  # noqa: E402
+from Series import Series  # noqa: E402
+from generate import generateActivities  # noqa: E402
+
+SIZES = (1000, 10000, 100000, 1000000)
+
+ATHLETE_ID = 1
+
+# the metric the aggregations and charts are timed on
+METRIC = 'distance'
+
+
+def measure(fn, setup=None, min_time: float = 0.2, min_runs: int = 3,
+            max_runs: int = 20) -> dict:
+    """
+    Time fn, repeating it until it has run for min_time seconds (but at least
+    min_runs and at most max_runs times)
+
+    :param fn:    the function to time
+    :param setup: called (untimed) before each run. What it returns is passed
+                  to fn
+    :param min_time: the minimum total time to run for, in seconds
+    :param min_runs: the minimum number of runs
+    :param max_runs: the maximum number of runs
+
+    :return dict of the min and median time of a run, in seconds, and the
+            number of runs
+    """
+    times = []
+
+    while (len(times) < max_runs
+           and (len(times) < min_runs or sum(times) < min_time)):
+        args = setup() if setup else ()
+
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'runs': len(times),
+    }
+
+
+def installConfig(path: str) -> None:
+    """
+    Point the application at a config using a sqlite cache in path
+    """
+    config_path = os.path.join(path, 'config.yaml')
+
+    with open(os.path.join(APP_DIR, 'config', 'dev.yaml')) as dev:
+        config = dev.read()
+
+    with open(config_path, 'w') as out:
+        out.write(config + "\ncache_data_dir: '%s'\n" % path)
+
+    Config.path = config_path
+    Config.reload()
+
+
+def storeActivities(activities: list) -> None:
+    """
+    Replace the benchmark athlete's activity store with the given activities,
+    marked as just synced, so requests never go to strava
+    """
+    from ActivityStore import ActivityStore
+    from SessionPool import SessionPool
+
+    store = ActivityStore.newFromCache(
+        SessionPool.getCacheBackend(Config()), ATHLETE_ID)
+    store.reset()
+    store.merge(activities)
+    store.save()
+
+
+def request(path: str, query: str = '') -> bytes:
+    """
+    Make a request as the benchmark athlete through the WSGI application
+    """
+    import application
+
+    token = json.dumps({
+        'access_token': 'bench',
+        'token_type': 'Bearer',
+        'athlete': {'id': ATHLETE_ID},
+    })
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query,
+        'SERVER_NAME': 'bench', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+        'HTTP_COOKIE': 'token=' + base64.urlsafe_b64encode(
+            token.encode('utf-8')).decode('ascii'),
+    }
+    status = []
+
+    body = b''.join(application.application(
+        environ, lambda line, headers, exc_info=None: status.append(line)))
+
+    if (not status[0].startswith('200')):
+        raise RuntimeError('%s?%s returned %s' % (path, query, status[0]))
+
+    return body
+
+
+def runSize(size: int) -> dict:
+    """
+    Run every benchmark on size synthetic activities
+
+    :return dict of benchmark name to timings (see measure())
+    """
+    raw = generateActivities(size)
+    activities = ActivityList(Activity.newFromDict(d) for d in raw)
+    newest = activities.sortByDate(True)
+    middle = newest[len(newest) // 2].getDateTime()
+
+    out = {}
+
+    def record(name, fn, setup=None):
+        out[name] = measure(fn, setup)
+        print("  %-45s %10.3f ms" % (name, out[name]['min'] * 1000))
+
+    record('newFromDict',
+           lambda: [Activity.newFromDict(d) for d in raw])
+    record('sortByDate', lambda: activities.sortByDate(True))
+    record('trimBeforeDate',
+           lambda: ActivityList.trimBeforeDate(activities, middle))
+    record('trimBeforeDate.sorted',
+           lambda: ActivityList.trimBeforeDate(newest, middle))
+    record('getMinDate', lambda: newest.getMinDate())
+    record('getMaxDate', lambda: newest.getMaxDate())
+    # what Strava.getActivities() does for ?limit=500
+    record('limit', lambda: ActivityList.slice(
+        newest.sortByDate(True), 0, 500))
+    record('filter', lambda: ActivityList.filter(
+        activities, lambda activity: activity.sport == 'ride'))
+
+    # aggregations are cached on the list, so each run gets a fresh copy
+    for period in AggregationPeriod:
+        for method in ('aggregateAverageMetricByPeriod',
+                       'aggregateTotalMetricByPeriod'):
+            record(
+                '%s.%s' % (method, period.name.lower()),
+                lambda acts: getattr(acts, method)(METRIC, period),
+                lambda: (ActivityList(activities),)
+            )
+
+    # what /chart/total/<metric>/day?rolling=7,28,42&trend=1&fitness=1 adds
+    daily = ActivityList(activities).aggregateTotalMetricByPeriod(
+        METRIC, AggregationPeriod.DAY)
+    series = Series.newFromAggregation(daily, AggregationPeriod.DAY)
+
+    record('series.fill', lambda: Series.newFromAggregation(
+        daily, AggregationPeriod.DAY))
+    record('series.rolling',
+           lambda: [series.rollingSum(window) for window in (7, 28, 42)])
+    record('series.ewma', lambda: series.getFitness())
+    record('series.trend', lambda: series.trend())
+    record('series.trend.window', lambda: series.trend(28))
+
+    record('dump', lambda: activities.dump())
+
+    # the activity store, in the JSON it used to be kept in and the compact
+    # encoding. Decoding includes building the Activity objects
+    fields = ActivityStore.fields
+    projected = [
+        {field: d[field] for field in fields if field in d} for d in raw
+    ]
+    as_json = json.dumps(projected)
+    packed = ActivityCodec.encode(projected, fields)
+
+    record('store.encode.json', lambda: json.dumps(projected))
+    record('store.encode', lambda: ActivityCodec.encode(projected, fields))
+    record('store.decode.json',
+           lambda: [Activity.newFromDict(d) for d in json.loads(as_json)])
+    record('store.decode', lambda: Activity.newFromColumns(
+        *ActivityCodec.decodeColumns(packed)))
+
+    # /chart?sport=ride&after=<the middle of the history>
+    query = ActivityQuery(
+        sports={'ride'}, metric=METRIC,
+        after=middle.replace(tzinfo=timezone.utc).timestamp())
+    record('store.decode.query', lambda: Activity.newFromColumns(
+        *ActivityCodec.decodeColumns(packed, query)))
+
+    out['store.encode.json']['bytes'] = len(as_json)
+    out['store.encode']['bytes'] = len(packed)
+    print("  %-45s %10d bytes (responses %d, JSON %d)"
+          % ('store.size', len(packed), len(json.dumps(raw)), len(as_json)))
+    del projected, as_json, packed
+
+    storeActivities(raw)
+    del raw, activities, newest
+
+    # a different (no-op) after date for each run, so every run misses the
+    # result cache
+    days = iter(range(1000000))
+
+    def after():
+        date = datetime(1900, 1, 1) + timedelta(days=next(days))
+        return ('after=%s' % date.strftime('%Y-%m-%d'),)
+
+    record('chart.miss',
+           lambda query: request('/chart/total/%s/week' % METRIC, query),
+           after)
+
+    def afterLimit():
+        return (after()[0] + '&limit=500',)
+
+    record('chart.miss.limit',
+           lambda query: request('/chart/total/%s/week' % METRIC, query),
+           afterLimit)
+
+    # a recent half of the rides. The limit is a no-op, to miss the cache
+    def sportAfter():
+        return ('sport=ride&after=%s&limit=%d'
+                % (middle.strftime('%Y-%m-%d'), 10 ** 7 + next(days)),)
+
+    record('chart.miss.sport_after',
+           lambda query: request('/chart/total/%s/week' % METRIC, query),
+           sportAfter)
+
+    def overlays():
+        return (after()[0] + '&rolling=7,28,42&trend=1&fitness=1',)
+
+    record('chart.miss.overlays',
+           lambda query: request('/chart/total/%s/day' % METRIC, query),
+           overlays)
+
+    request('/chart/total/%s/week' % METRIC)
+    record('chart.hit', lambda: request('/chart/total/%s/week' % METRIC))
+
+    return out
+
+
+def getCommit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(before_path: str, after_path: str) -> None:
+    """
+    Print the change in min time for every benchmark in both result files
+    """
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before = json.load(before_file)
+        after = json.load(after_file)
+
+    print("%s -> %s" % (before['commit'], after['commit']))
+
+    for size, results in after['results'].items():
+        if (size not in before['results']):
+            continue
+
+        print("%s activities" % size)
+        for name, result in results.items():
+            if (name not in before['results'][size]):
+                continue
+
+            was = before['results'][size][name]['min']
+            now = result['min']
+            print("  %-45s %10.3f -> %10.3f ms  %6.2fx"
+                  % (name, was * 1000, now * 1000, was / now))
+
+            if ('bytes' in result
+                    and 'bytes' in before['results'][size][name]):
+                was = before['results'][size][name]['bytes']
+                now = result['bytes']
+                print("  %-45s %10d -> %10d bytes" % ('', was, now))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated numbers of activities')
+    parser.add_argument('--output', help='file to write results to')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files, instead of running')
+    args = parser.parse_args()
+
+    if (args.compare):
+        compare(*args.compare)
+        sys.exit(0)
+
+    commit = getCommit()
+    output = os.path.abspath(args.output or os.path.join(
+        BENCH_DIR, 'results', '%s.json' % commit))
+
+    # bottle looks up the templates relative to the working directory
+    os.chdir(APP_DIR)
+
+    # the routes log debug output, which would drown out the results
+    for name in ('strava', 'requests_oauthlib'):
+        logging.getLogger(name).addHandler(logging.NullHandler())
+
+    tmp = tempfile.TemporaryDirectory()
+    installConfig(tmp.name)
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        print("%d activities" % size)
+        results[str(size)] = runSize(size)
+
+    tmp.cleanup()
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as out:
+        json.dump({
+            'commit': commit,
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.machine(),
+            'results': results,
+        }, out, indent=2)
+
+    print("results written to %s" % output)
@@ -0,0 +1,86 @@
+"""
+Tests for the rate limiter with many threads taking budget at once, as the
+concurrent page fetches of a sync do, against a cache backend slow enough
+that counting usage while holding the limiter's lock would queue them all
+"""
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+
+from requests_cache import SQLiteCache  # noqa: E402
+
+from CacheStorage import CacheStorage  # noqa: E402
+from RateLimiter import RateLimiter, RateLimitException  # noqa: E402
+
+THREADS = 8
+DELAY = 0.05
+
+
+class SlowStorage(CacheStorage):
+    """
+    A cache storage with a round trip's latency added to every increment
+    """
+    def increment(self, key: str, amount: int = 1, ttl: int = None) -> int:
+        time.sleep(DELAY)
+
+        return super().increment(key, amount, ttl)
+
+
+def getRateLimiter(path: str, limits: tuple) -> RateLimiter:
+    cache = SQLiteCache(path, wal=True, busy_timeout=30000)
+
+    return RateLimiter(SlowStorage(cache, 'limits'), limits, max_wait=5)
+
+
+def acquireAll(limiter: RateLimiter) -> list:
+    """
+    Acquire budget for a request on each of THREADS threads at once
+
+    :return list of the threads' exceptions, None for those that got budget
+    """
+    errors = [None] * THREADS
+
+    def acquire(i: int) -> None:
+        try:
+            limiter.acquire(
+                RateLimiter.INTERACTIVE, time.time() + limiter.max_wait)
+        except RateLimitException as e:
+            errors[i] = e
+
+    threads = [
+        threading.Thread(target=acquire, args=(i,)) for i in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return errors
+
+
+def test_usage_counted_concurrently(tmp_path):
+    limiter = getRateLimiter(str(tmp_path / 'cache.sqlite'), (200, 2000))
+
+    start = time.time()
+    errors = acquireAll(limiter)
+    elapsed = time.time() - start
+
+    assert errors == [None] * THREADS
+    assert [int(limiter.storage.get(key)) for key in limiter.getKeys(
+        time.time())] == [THREADS, THREADS]
+
+    # one at a time, counting both windows would take THREADS * 2 * DELAY
+    assert elapsed < THREADS * DELAY
+
+
+def test_budget_not_exceeded(tmp_path):
+    limiter = getRateLimiter(str(tmp_path / 'cache.sqlite'), (5, 2000))
+
+    errors = acquireAll(limiter)
+
+    assert errors.count(None) == 5
+    assert int(limiter.storage.get(limiter.getKeys(time.time())[0])) == 5
@@ -0,0 +1,77 @@
+"""
+Tests for the result cache's bound on the number of entries per athlete,
+with several processes writing to the same sqlite cache at once, as
+gunicorn workers do
+"""
+import multiprocessing
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+
+from requests_cache import SQLiteCache  # noqa: E402
+
+from CacheStorage import CacheStorage  # noqa: E402
+from ResultCache import ResultCache  # noqa: E402
+
+WRITERS = 4
+WRITES = 100
+MAX_ENTRIES = 25
+
+
+def getResultCache(path: str) -> ResultCache:
+    cache = SQLiteCache(path, wal=True, busy_timeout=30000)
+
+    return ResultCache(
+        CacheStorage(cache, 'results'), 1, 'version', 3600, MAX_ENTRIES)
+
+
+def write(path: str, writer: int) -> None:
+    results = getResultCache(path)
+
+    for i in range(WRITES):
+        results.set('chart', {'writer': writer, 'i': i}, 'chart')
+
+
+def test_max_entries_with_concurrent_writers(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    results = getResultCache(path)
+
+    context = multiprocessing.get_context('spawn')
+    writers = [
+        context.Process(target=write, args=(path, writer))
+        for writer in range(WRITERS)
+    ]
+    for process in writers:
+        process.start()
+    for process in writers:
+        process.join()
+
+    assert all(process.exitcode == 0 for process in writers)
+
+    with results.storage.sqlite.connection() as con:
+        entries = con.execute(
+            "SELECT COUNT(*) FROM results WHERE key != ?",
+            (results.index_key,)).fetchone()[0]
+        indexed = con.execute(
+            "SELECT COUNT(*) FROM results_index WHERE name = ?",
+            (results.index_key,)).fetchone()[0]
+
+    assert entries == MAX_ENTRIES
+    assert indexed == MAX_ENTRIES
+
+
+def test_rewrite_is_most_recent(tmp_path):
+    results = getResultCache(str(tmp_path / 'cache.sqlite'))
+
+    for i in range(MAX_ENTRIES):
+        results.set('chart', {'i': i}, i)
+
+    # rewriting the oldest entry makes the second oldest the next evicted
+    results.set('chart', {'i': 0}, 0)
+    results.set('chart', {'i': MAX_ENTRIES}, MAX_ENTRIES)
+
+    assert results.get('chart', {'i': 0}) == 0
+    assert results.get('chart', {'i': 1}) is None
+    assert results.get('chart', {'i': MAX_ENTRIES}) == MAX_ENTRIES
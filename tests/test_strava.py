@@ -0,0 +1,237 @@
+"""
+Tests for fetching an athlete's full history from strava, against the fake
+strava server in bench/ with latency added to every response, so that
+pages are fetched concurrently and requests for later pages are in flight
+when the last page comes back. Requests are counted once every page fetch
+that was started has finished, and exact counts leave out the speculative
+requests for pages after the last, so they don't depend on timing
+"""
+import json
+import os
+import sys
+import time
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import fakestrava  # noqa: E402
+
+from ActivityStore import ActivityStore  # noqa: E402
+from Config import Config  # noqa: E402
+from OAuth2CachedSession import OAuth2CachedSession  # noqa: E402
+from Strava import Strava, TokenStorage  # noqa: E402
+from SyncJob import SyncJob  # noqa: E402
+
+PAGE_SIZE = 20
+FULL_PAGES = 6
+LAST_PAGE = FULL_PAGES + 1
+LATENCY = 0.05
+MAX_CONCURRENT_PAGES = 4
+
+ACTIVITIES_PATH = '/api/v3/athlete/activities'
+
+
+@pytest.fixture
+def server():
+    # every page full, then one short page
+    server = fakestrava.serve(
+        activities=FULL_PAGES * PAGE_SIZE + PAGE_SIZE // 2, latency=LATENCY)
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def executors(monkeypatch):
+    """
+    The executors the syncs fetch pages with, so the tests can wait for the
+    requests still in flight when a sync returns
+    """
+    executors = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            executors.append(self)
+
+    monkeypatch.setattr('Strava.ThreadPoolExecutor', RecordingExecutor)
+
+    return executors
+
+
+@pytest.fixture
+def strava(server, executors, tmp_path, monkeypatch):
+    monkeypatch.setenv('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(
+        "strava_base_url: 'http://127.0.0.1:%d'\n"
+        "cache_backend: 'sqlite'\n"
+        "cache_data_dir: '%s'\n"
+        "cache_ttl: 86400\n"
+        "max_page_size: %d\n"
+        "max_concurrent_pages: %d\n"
+        % (server.server_port, tmp_path, PAGE_SIZE, MAX_CONCURRENT_PAGES))
+
+    monkeypatch.setattr(Config, 'path', str(config_path))
+    Config.reload()
+
+    yield newStrava('test')
+
+    Config.reload()
+
+
+def newStrava(access_token: str, athlete: dict = None) -> Strava:
+    """
+    Create a Strava with the given access token. Like a refreshed token, it
+    doesn't say which athlete it's for, unless one is given
+    """
+    token = {
+        'token_type': 'Bearer',
+        'access_token': access_token,
+        'refresh_token': access_token + '-refresh',
+        'expires_at': time.time() + 21600,
+    }
+    if (athlete is not None):
+        token['athlete'] = athlete
+
+    token_storage = TokenStorage()
+    token_storage.set(token)
+
+    return Strava(token_storage)
+
+
+def getActivityRequests(server, executors: list,
+                        last_page: int = None) -> int:
+    """
+    Count the activity requests the server has answered, once any that were
+    still in flight have finished
+
+    :param last_page: don't count requests for pages of history after this
+                      one. Which of those are requested depends on the order
+                      the pages before them come back in
+    """
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+    url = 'http://127.0.0.1:%d/fake/stats?by=query' % server.server_port
+    with urllib.request.urlopen(url) as response:
+        stats = json.load(response)
+
+    requests = 0
+    for (key, count) in stats.items():
+        (path, _, query) = key.rsplit(' ', 1)[0].partition('?')
+        query = parse_qs(query)
+
+        if (path != ACTIVITIES_PATH):
+            continue
+
+        if (last_page is not None and 'before' in query
+                and int(query['page'][0]) > last_page):
+            continue
+
+        requests += count
+
+    return requests
+
+
+def test_all_pages_in_order(server, strava):
+    pages = strava.getAllActivitiesPages(PAGE_SIZE)
+    activities = [activity for page in pages for activity in page]
+
+    assert [activity['id'] for activity in activities] == [
+        activity['id'] for activity in server.activities]
+    assert [len(page) for page in pages][-2:] == [PAGE_SIZE, PAGE_SIZE // 2]
+
+
+def test_pages_after_short_page_dropped(server, strava, executors):
+    pages = strava.getAllActivitiesPages(PAGE_SIZE)
+
+    # there is nothing after the history boundary, so the head is a single
+    # empty page
+    assert [len(page) for page in pages if page] == (
+        [PAGE_SIZE] * FULL_PAGES + [PAGE_SIZE // 2])
+
+    # the head and the first page of history are fetched alone, and at most
+    # max_concurrent_pages - 1 speculative requests for pages after the short
+    # page can have started before it came back. The rest must have been
+    # cancelled
+    assert getActivityRequests(server, executors) <= (
+        1 + FULL_PAGES + 1 + MAX_CONCURRENT_PAGES - 1)
+
+
+def test_sync_uses_cached_session(server, strava, executors):
+    assert isinstance(strava.oauth, OAuth2CachedSession)
+
+    strava.getAllActivitiesPages(PAGE_SIZE)
+    requests = getActivityRequests(server, executors, LAST_PAGE)
+
+    # the history pages are in the requests cache, so a second sync makes no
+    # requests for them
+    pages = strava.getAllActivitiesPages(PAGE_SIZE)
+
+    assert getActivityRequests(server, executors, LAST_PAGE) == requests
+    assert sum(len(page) for page in pages) == len(server.activities)
+
+
+def test_history_cached_across_tokens(server, strava, executors):
+    strava.getAllActivitiesPages(PAGE_SIZE)
+    requests = getActivityRequests(server, executors, LAST_PAGE)
+
+    # without the index of history pages, each page is looked up by its
+    # cache key
+    strava.getPageIndex().delete(strava.getHistoryPageIndexKey(
+        strava.getHistoryBoundary(), PAGE_SIZE))
+
+    # after the token is refreshed, the pages are still in the cache
+    pages = newStrava('refreshed').getAllActivitiesPages(PAGE_SIZE)
+
+    assert getActivityRequests(server, executors, LAST_PAGE) == requests
+    assert sum(len(page) for page in pages) == len(server.activities)
+
+
+def test_athlete_in_token_not_trusted(server, strava):
+    # another athlete's store, synced just now
+    victim = ActivityStore.newFromCache(
+        strava.oauth.cache, server.athlete_id + 1)
+    victim.merge([{
+        key: value for (key, value) in server.activities[0].items()
+        if key[0] != '_'
+    }])
+    victim.activities[0]['id'] = 0
+    victim.save()
+
+    # the token cookie comes from the browser, so it can name any athlete
+    forged = newStrava('forged', {'id': server.athlete_id + 1})
+    activities = forged.getActivities(len(server.activities))
+
+    assert forged.getActivityStore().athlete_id == server.athlete_id
+    assert len(activities) == len(server.activities)
+
+
+def test_sync_job_unauthorized(server, strava):
+    strava.getVerifiedAthleteId()
+
+    # strava refuses the token once the sync has started
+    server.revoked.add('test')
+    job = SyncJob.start(strava)
+
+    deadline = time.time() + 10
+    while (SyncJob.getStatus(strava)['state'] == SyncJob.RUNNING
+            and time.time() < deadline):
+        time.sleep(LATENCY)
+
+    status = SyncJob.getStatus(strava)
+
+    assert status['state'] == SyncJob.UNAUTHORIZED
+    assert not SyncJob.isStale(status)
+    assert job.key not in SyncJob._running